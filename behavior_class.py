@@ -2,6 +2,8 @@ import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 
+from sync_class import get_blocks
+
 class BehaviorAnalysis():
     """[behaviour analysis class for phenosys Behavior Recording and Neuron Electrophysiology Recording]
     """    
@@ -19,45 +21,97 @@ class BehaviorAnalysis():
         self.gamble_side = sync_obj.gamble_side
         self.deselect_trials = deselect_trials
 
+        # trial tables are shared with sync_obj and never changed, selection is a mask over good_trials_df
         self.all_trials_df = sync_obj.all_trials_df
         self.good_trials_df = sync_obj.good_trials_df
+        self.set_selection(deselect_trials)
+
+        # per trial behavior outcome, shared with downstream analysis
+        self.get_wheel_and_resp()
+
+    # trial selection =================
+    def get_selection_mask(self, deselect_trials=[], mask=None):
+        """bool mask over good_trials_df with deselected trial ranges set to False
+
+        Args:
+            deselect_trials (list, optional): list of (a, b) good trial index ranges, b inclusive or 'end'. Defaults to [].
+            mask (np ar, optional): mask to start from, e.g. from another selection. Defaults to all trials.
 
+        Returns:
+            np ar: bool array with one element per good trial
+        """
+        index = self.good_trials_df.index.values
+        if mask is None:
+            mask = np.ones(index.size, dtype=bool)
+        else:
+            mask = mask.copy()
         for a,b in deselect_trials:
             if b == 'end':
-                self.good_trials_df.loc[a:,'select'] = False
+                mask &= index < a
             else:
-                self.good_trials_df.loc[a:b,'select'] = False
-
-        self.selected_trials_df = self.good_trials_df.loc[self.good_trials_df['select'],:]
-        self.selected_trials_df.reset_index(drop=True,inplace=True)
-
-    def get_wheel_and_resp(self):
-        wheel = []
-        response = []
-        working = self.combined.copy()
-        working.reset_index(inplace=True)
-        for index, row in working.iterrows():
-            if index+4 == working.shape[0]:
-                break 
-            if (row['CSV Event'] == 'start') & ( (working.loc[index+1,'CSV Event'])=='wheel not stopping'):
-                wheel.append(1)
-                response.append(0)
-            elif (row['CSV Event'] == 'start') & ( (working.loc[index+4,'CSV Event']) == 'no response in time'):
-                response.append(1)
-                wheel.append(0)
-            elif (row['CSV Event'] == 'start') and ( ((working.loc[index+1,'CSV Event'])!='wheel not stopping') or  ((working.loc[index+4,'CSV Event']) != 'no response in time') ):
-                wheel.append(0)
-                response.append(0)
-        
-        self.behav_df = pd.DataFrame({'resp':response, 'wheel':wheel})
+                mask &= (index < a) | (index > b)
+        return mask
+
+    def get_selected_trials(self, mask):
+        """trial table for mask over good_trials_df, index 0..n-1 like selected_trials_df
+
+        Args:
+            mask (np ar): bool mask from get_selection_mask
+
+        Returns:
+            pd.DataFrame: selected trials
+        """
+        return self.good_trials_df.loc[mask].reset_index(drop=True)
+
+    def set_selection(self, deselect_trials):
+        """change deselected trials without rebuilding the sync object
+
+        Args:
+            deselect_trials (list): list of (a, b) good trial index ranges, b inclusive or 'end'
+        """
+        self.deselect_trials = deselect_trials
+        self.select_ar = self.get_selection_mask(deselect_trials)
+        self.selected_trials_df = self.get_selected_trials(self.select_ar)
+
+    def get_wheel_and_resp(self, window=10):
+        """wheel not stopping and no response flags for every trial, with rolling average and rate per probability block
+
+        Args:
+            window (int, optional): trials for rolling average. Defaults to 10.
+
+        Returns:
+            pd.DataFrame: one row per trial (all trials), columns ['resp', 'wheel', 'resp_rol', 'wheel_rol', 'probability']
+                also sets behav_df and behav_block_df (rates per probability block, see sync_class.get_blocks)
+        """
+        # integer coded events, -1 = nan
+        codes, names = pd.factorize(self.combined_df['CSV Event'])
+        def code(name):
+            return names.get_loc(name) if name in names else -2
+        # pad so that shifted lookups after the last row are -1
+        padded = np.append(codes, np.full(4, -1))
+
+        # each start row is a trial, wheel not stopping follows directly, no response in time is the 5. event
+        start_idx = np.flatnonzero(codes == code('start'))
+        wheel = padded[start_idx+1] == code('wheel not stopping')
+        response = (padded[start_idx+4] == code('no response in time')) & ~wheel
+
+        self.behav_df = pd.DataFrame({'resp':response.astype(int), 'wheel':wheel.astype(int)})
         # add rolling average
-        resp_rol_df = pd.DataFrame(self.behav_df.resp.rolling(window=10).mean())
-        resp_rol_df.fillna(0, inplace=True)
-        wheel_rol_df = pd.DataFrame(self.behav_df.wheel.rolling(window=10).mean())
-        wheel_rol_df.fillna(0, inplace=True)
-        # add to dataframe
-        self.behav_df['resp_rol']=resp_rol_df.values
-        self.behav_df['wheel_rol']=wheel_rol_df.values
+        self.behav_df['resp_rol'] = self.behav_df['resp'].rolling(window=window).mean().fillna(0).values
+        self.behav_df['wheel_rol'] = self.behav_df['wheel'].rolling(window=window).mean().fillna(0).values
+        self.behav_df['probability'] = self.combined_df['CSV Probability'].values[start_idx].astype(float)
+        self.behav_df.index.name = 'trial'
+
+        # rate per probability block
+        starts, stops, probability = get_blocks(self.behav_df['probability'].values)
+        n = stops-starts
+        self.behav_block_df = pd.DataFrame({
+            'probability': probability,
+            'start': starts,
+            'trials': n,
+            'resp_rate': np.add.reduceat(response.astype(int), starts)/n,
+            'wheel_rate': np.add.reduceat(wheel.astype(int), starts)/n,
+        }, index=pd.RangeIndex(n.shape[0], name='block'))
 
         return self.behav_df
 
@@ -0,0 +1,338 @@
+import numpy as np
+import pandas as pd
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import argparse
+import datetime
+import os
+import platform
+import subprocess
+import time
+import warnings
+
+from synthetic_class import SyntheticSession
+from sync_class import SyncPhenosys
+from behavior_class import BehaviorAnalysis
+from eda_class import SpikesEDA
+from sda_class import SpikesSDA, bin_trial_spike_times
+from report_class import SpikesReport
+from export_class import SpikesExport
+from parallel_class import ParallelSDA
+from decoding_class import SpikesDecoding
+from population_class import SpikesPopulation
+from glm_class import SpikesGLM
+
+
+# session sizes used for the benchmark runs
+SCALES = dict()
+SCALES['small'] = dict(session_length=300, n_trials=40, n_clusters=10, lick_channel=2, dropped_ttl=3)
+SCALES['medium'] = dict(session_length=1200, n_trials=150, n_clusters=40, lick_channel=2, dropped_ttl=3)
+SCALES['large'] = dict(session_length=3600, n_trials=450, n_clusters=120, lick_channel=2, dropped_ttl=3)
+
+# stage registry in pipeline order: (class, method prefix, stages), stage <name> runs SpikesBenchmark.<prefix>_<name>
+STAGES = [
+    ('SyncPhenosys', 'sync', ['init', 'load_digitalin', 'ttl_create_ticks', 'convert_ttl_to_event', 'decode_channels', 'load_csv',
+                              'combine_dataframes', 'get_trials', 'get_events_per_trial']),
+    ('BehaviorAnalysis', 'behavior', ['init']),
+    ('SpikesEDA', 'eda', ['init', 'load_files', 'gen_spike_per_cluster_matrix', 'gen_spike_buffer', 'gen_trial_spike_idx',
+                          'gen_spike_per_trial_matrix', 'bin_count_per_cluster', 'bin_count_all_clusters', 'gen_psth_cubes',
+                          'gen_count_table', 'gen_isi_stats', 'gen_ccg', 'set_selection']),
+    ('SpikesSDA', 'sda', ['init', 'get_randomized_windows', 'bin_trial_spike_times', 'test_event', 'sequential_test',
+                          'analytic_test', 'compare_nulls']),
+    ('ParallelSDA', 'parallel', ['test_event']),
+    ('SpikesExport', 'export', ['export']),
+    ('SpikesDecoding', 'decoding', ['decode']),
+    ('SpikesPopulation', 'population', ['fit_pca']),
+    ('SpikesGLM', 'glm', ['init', 'fit']),
+    ('SpikesReport', 'report', ['init', 'generate_plots', 'generate_report']),
+]
+
+
+# class ###################################################################################################################
+class SpikesBenchmark():
+    """[# benchmark for all stages of SyncPhenosys, SpikesEDA, SpikesSDA and SpikesReport on synthetic sessions]
+    """
+    def __init__(self, folder, scales=['small', 'medium'], repeat=1, window=200, iterations=100, report=True, seed=0):
+        """[summary]
+
+        Args:
+            folder (str): scratch folder, one synthetic session is written per scale
+            scales (list, optional): keys of SCALES to run. Defaults to ['small', 'medium'].
+            repeat (int, optional): number of runs for each scale. Defaults to 1.
+            window (int, optional): 1/2 window width in ms for bin count and SDA. Defaults to 200.
+            iterations (int, optional): number of SDA random iterations. Defaults to 100.
+            report (bool, optional): include SpikesReport stages. Defaults to True.
+            seed (int, optional): random seed of the synthetic sessions. Defaults to 0.
+        """
+        self.folder = folder
+        self.scales = scales
+        self.repeat = repeat
+        self.window = window
+        self.iterations = iterations
+        self.report = report
+        self.seed = seed
+
+    # stages =================================================================================================================
+    def create_stages(self):
+        """list of (class, stage, function) in pipeline order from STAGES, each function works on self.state
+
+        Returns:
+            list: stages
+        """
+        stages = []
+        for cls, prefix, names in STAGES:
+            if cls == 'SpikesReport' and not self.report:
+                continue
+            stages += [(cls, name, getattr(self, prefix+'_'+name)) for name in names]
+        return stages
+
+    # SyncPhenosys stages, single stages are timed again on the constructed object ===========================================
+    def sync_init(self):
+        self.state['sync'] = SyncPhenosys(self.state['session'], self.state['folder'], rows_missing_ttl='clock')
+
+    def sync_load_digitalin(self):
+        self.state['sync'].ttl_channels = self.state['sync'].load_digitalin()
+
+    def sync_ttl_create_ticks(self):
+        self.state['sync'].ttl_signals = self.state['sync'].ttl_create_ticks()
+
+    def sync_convert_ttl_to_event(self):
+        sync = self.state['sync']
+        sync.ttl_event_dict = sync.create_dict()
+        sync.ttl_info_channel = sync.convert_ttl_to_event('channel '+str(sync.info_channel))
+
+    def sync_decode_channels(self):
+        sync = self.state['sync']
+        sync.ttl_events_df = sync.decode_channels({1: sync.ttl_event_dict, 2: 'lick'})
+
+    def sync_load_csv(self):
+        self.state['sync'].csv = self.state['sync'].load_csv()
+
+    def sync_combine_dataframes(self):
+        self.state['sync'].combined_df = self.state['sync'].combine_dataframes()
+
+    def sync_get_trials(self):
+        sync = self.state['sync']
+        sync.all_trials_df, sync.good_trials_df = sync.get_trials()
+
+    def sync_get_events_per_trial(self):
+        self.state['sync'].get_events_per_trial()
+
+    # BehaviorAnalysis stages ================================================================================================
+    def behavior_init(self):
+        self.state['behavior'] = BehaviorAnalysis(self.state['sync'])
+
+    # SpikesEDA stages, single stages are timed again on the constructed object ==============================================
+    def eda_init(self):
+        self.state['eda'] = SpikesEDA(self.state['behavior'])
+
+    def eda_load_files(self):
+        eda = self.state['eda']
+        eda.spikes_df, eda.clusters_df = eda.load_files()
+
+    def eda_gen_spike_per_cluster_matrix(self):
+        self.state['eda'].spikes_per_cluster_ar = self.state['eda'].gen_spike_per_cluster_matrix()
+
+    def eda_gen_spike_buffer(self):
+        eda = self.state['eda']
+        eda.spikes_buffer_ar, eda.spikes_offsets_ar = eda.gen_spike_buffer()
+
+    def eda_gen_trial_spike_idx(self):
+        self.state['eda'].trial_spike_idx_ar = self.state['eda'].gen_trial_spike_idx()
+
+    def eda_gen_spike_per_trial_matrix(self):
+        self.state['eda'].spikes_per_trial_ar = self.state['eda'].gen_spike_per_trial_matrix()
+
+    def eda_bin_count_per_cluster(self):
+        eda = self.state['eda']
+        for cluster in eda.clusters_df.loc[eda.clusters_df['group']=='good'].index:
+            eda.bin_count_per_cluster(self.window, cluster)
+
+    def eda_bin_count_all_clusters(self):
+        self.state['eda'].bin_count_all_clusters(self.window, step=self.window/4, kernel='gaussian')
+
+    def eda_gen_psth_cubes(self):
+        self.state['eda'].gen_psth_cubes(2000)
+
+    def eda_gen_count_table(self):
+        eda = self.state['eda']
+        windows = [('cue', -500, 0), ('sound', 0, 500), ('reward', 0, 1000)]
+        eda.get_count_stats(eda.gen_count_table(windows), by=['block', 'side', 'reward'], windows=windows)
+
+    def eda_gen_isi_stats(self):
+        self.state['eda'].gen_isi_stats()
+
+    def eda_gen_ccg(self):
+        self.state['eda'].gen_ccg(trials_only=True)
+
+    def eda_set_selection(self):
+        eda = self.state['eda']
+        eda.set_selection([(0, 2)])
+        eda.set_selection([])
+
+    # SpikesSDA stages =======================================================================================================
+    def sda_init(self):
+        self.state['sda'] = SpikesSDA(self.state['eda'])
+
+    def sda_get_randomized_windows(self):
+        self.state['random_ar'] = self.state['sda'].get_randomized_windows(self.window, self.iterations)
+
+    def sda_bin_trial_spike_times(self):
+        self.state['binned_ar'] = bin_trial_spike_times(self.state['random_ar'], 50)
+
+    def sda_test_event(self):
+        self.state['sda'].test_event('reward', self.window, self.iterations, n_bins=20)
+
+    def sda_sequential_test(self):
+        self.state['sda'].sequential_test('reward', self.window, max_iterations=10*self.iterations, n_bins=20)
+
+    def sda_analytic_test(self):
+        self.state['sda'].analytic_test('reward', self.window, n_bins=20)
+
+    def sda_compare_nulls(self):
+        self.state['sda'].compare_nulls('reward', self.window, iterations=self.iterations, n_bins=20)
+
+    # analysis stages ========================================================================================================
+    def parallel_test_event(self):
+        with ParallelSDA(self.state['sda']) as parallel:
+            parallel.test_event('reward', self.window, self.iterations, n_bins=20)
+
+    def export_export(self):
+        SpikesExport(self.state['eda']).export(self.folder+'/dataset')
+
+    def decoding_decode(self):
+        SpikesDecoding(self.state['eda']).decode('reward', 'reward_given', window=self.window*10, n_bins=40, width=4)
+
+    def population_fit_pca(self):
+        population = SpikesPopulation(self.state['eda'])
+        population.fit_pca('all', window=self.window*10, n_bins=40, n_components=3)
+        population.project('all', 'reward', by=['probability'])
+
+    def glm_init(self):
+        self.state['glm'] = SpikesGLM(self.state['eda'])
+
+    def glm_fit(self):
+        self.state['glm'].fit(l2=1.0, holdout=0.2)
+
+    # SpikesReport stages ====================================================================================================
+    def report_init(self):
+        self.state['report'] = SpikesReport(self.state['eda'])
+
+    def report_generate_plots(self):
+        self.state['report'].generate_plots()
+
+    def report_generate_report(self):
+        self.state['report'].generate_report()
+
+    # run ====================================================================================================================
+    def generate_session(self, scale):
+        """write synthetic session for scale if it does not exist yet
+
+        Args:
+            scale (str): key of SCALES
+
+        Returns:
+            str: session folder
+        """
+        folder = self.folder+'/'+scale+'_'+str(self.seed)
+        if not os.path.isfile(folder+'/electrophysiology/cluster_info.tsv'):
+            SyntheticSession(folder, session=scale, seed=self.seed, **SCALES[scale]).generate()
+        return folder
+
+    def run(self, label=''):
+        """time all stages for all scales
+
+        a failing stage is recorded with status 'error', all later stages of this run are skipped
+
+        Args:
+            label (str, optional): name of the run, e.g. branch or change. Defaults to ''.
+
+        Returns:
+            pd.DataFrame: one row per scale, repeat and stage
+        """
+        run = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+        commit = self.get_commit()
+        rows = []
+        for scale in self.scales:
+            folder = self.generate_session(scale)
+            for rep in range(self.repeat):
+                self.state = dict(session=scale, folder=folder)
+                failed = False
+                for cls, stage, func in self.create_stages():
+                    if failed:
+                        seconds, status = np.nan, 'skipped'
+                    else:
+                        start = time.perf_counter()
+                        try:
+                            with warnings.catch_warnings():
+                                warnings.simplefilter('ignore')
+                                func()
+                            status = 'ok'
+                        except Exception as e:
+                            status = 'error: '+type(e).__name__+': '+str(e).split('\n')[0][:200]
+                            failed = True
+                        seconds = time.perf_counter()-start
+                    rows.append([run, label, commit, platform.node(), scale, rep, cls, stage, seconds, status])
+                    print(f"{scale:>8} {rep} {cls:>16}.{stage:<28} {seconds:10.4f}s  {status}")
+                plt.close('all')
+
+        results_df = pd.DataFrame(rows, columns=['run', 'label', 'commit', 'host', 'scale', 'repeat', 'class', 'stage', 'seconds', 'status'])
+        return results_df
+
+    def get_commit(self):
+        try:
+            return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                  cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+        except OSError:
+            return ''
+
+    # store & compare ========================================================================================================
+    def save_results(self, results_df, results_file):
+        """append results to csv file"""
+        header = not os.path.isfile(results_file)
+        results_df.to_csv(results_file, mode='a', header=header, index=False)
+
+    def load_results(self, results_file):
+        return pd.read_csv(results_file)
+
+    def compare_runs(self, results_df, base, new):
+        """compare median stage time of two runs
+
+        Args:
+            results_df (pd.DataFrame): all results, from load_results
+            base (str): run id or label of the reference run
+            new (str): run id or label of the run to compare
+
+        Returns:
+            pd.DataFrame: index (scale, class, stage), columns [base, new, speedup]
+        """
+        def select(key):
+            df = results_df.loc[(results_df['run']==key) | (results_df['label']==key)]
+            # latest run if label was used multiple times
+            df = df.loc[df['run']==df['run'].max()]
+            return df.loc[df['status']=='ok'].groupby(['scale', 'class', 'stage'], sort=False)['seconds'].median()
+
+        compare_df = pd.concat([select(base), select(new)], axis=1, keys=[base, new])
+        compare_df['speedup'] = compare_df[base]/compare_df[new]
+        return compare_df
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmark spikes pipeline on synthetic sessions')
+    parser.add_argument('--folder', default='bench_sessions', help='scratch folder for synthetic sessions')
+    parser.add_argument('--scales', nargs='+', default=['small', 'medium'], choices=list(SCALES.keys()))
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--iterations', type=int, default=100, help='SDA random iterations')
+    parser.add_argument('--no-report', action='store_true', help='skip SpikesReport stages')
+    parser.add_argument('--label', default='')
+    parser.add_argument('--results', default='bench_results.csv', help='csv file results are appended to')
+    parser.add_argument('--compare', default=None, help='run id or label to compare this run against')
+    args = parser.parse_args()
+
+    bench = SpikesBenchmark(args.folder, scales=args.scales, repeat=args.repeat, iterations=args.iterations, report=not args.no_report)
+    results_df = bench.run(label=args.label)
+    bench.save_results(results_df, args.results)
+    if args.compare is not None:
+        all_df = bench.load_results(args.results)
+        print(bench.compare_runs(all_df, args.compare, results_df['run'].iloc[0]).to_string())
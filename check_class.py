@@ -0,0 +1,142 @@
+import numpy as np
+import argparse
+import tempfile
+
+from synthetic_class import SyntheticSession
+from sync_class import SyncPhenosys
+from eda_class import crosscorrelogram_counts
+from sda_class import jitter_spike_buffer, shuffle_isi_buffer
+
+
+# brute force reference checks of the vectorized / numba kernels, small deterministic inputs:
+#     python check_class.py
+
+
+def random_spike_buffer(n_clusters=4, n_spikes=200, length=20000, seed=0):
+    """flat spike buffer with unique sorted spike times per cluster
+
+    Returns:
+        tuple: (spikes_ar, offsets_ar)
+    """
+    rng = np.random.default_rng(seed)
+    clusters = [np.sort(rng.choice(length, size=rng.integers(n_spikes//2, n_spikes), replace=False)) for _ in range(n_clusters)]
+    offsets_ar = np.concatenate([[0], np.cumsum([cluster.size for cluster in clusters])]).astype(np.int64)
+    return np.concatenate(clusters).astype(np.int64), offsets_ar
+
+
+# sync_class ##############################################################################################################
+def check_find_missing_ttl(dropped_ttl=4, extra_ttl=2, seeds=range(2)):
+    """find_missing_ttl (banded_alignment) recovers the dropped and extra pulses of synthetic sessions, also a dropped first pulse"""
+    for seed in seeds:
+        for drop_first_ttl in (False, True):
+            with tempfile.TemporaryDirectory() as folder:
+                session = SyntheticSession(folder, session='check', session_length=600, n_trials=60, n_clusters=2,
+                                           dropped_ttl=dropped_ttl, extra_ttl=extra_ttl, drop_first_ttl=drop_first_ttl, seed=seed)
+                session.generate()
+                # combine_dataframes stores the rows of find_missing_ttl
+                sync = SyncPhenosys('check', folder, rows_missing_ttl='auto')
+                missing, extra = sync.rows_missing_ttl_found, sync.rows_extra_ttl
+
+            # csv task events are the ttl events of the generator, pulses that match no kept event are extra
+            events_df = session.events_df.loc[session.events_df['in_ttl']].reset_index(drop=True)
+            expected_missing = np.flatnonzero(events_df['dropped'].values).tolist()
+            kept = np.sort(events_df.loc[~events_df['dropped'], 'ttl_start'].values)
+            starts = sync.ttl_signals['channel '+str(sync.info_channel)]['Start'].values
+            expected_extra = np.flatnonzero(np.abs(starts[:, None]-kept[None, :]).min(axis=1) > 2).tolist()
+            if missing != expected_missing or extra != expected_extra:
+                raise AssertionError(f"find_missing_ttl found missing {missing}, extra {extra}, expected {expected_missing}, "
+                                     f"{expected_extra} (seed {seed}, drop_first_ttl {drop_first_ttl})")
+    return True
+
+
+# eda_class ###############################################################################################################
+def check_crosscorrelogram_counts(max_lag=400, bin_size=20):
+    """crosscorrelogram_counts against a histogram of all pairwise lags from np.subtract.outer, incl. a self pair"""
+    spikes_ar, offsets_ar = random_spike_buffer()
+    # dense cluster so that lags on the bin edges and on -max_lag occur
+    spikes_ar = np.concatenate([spikes_ar, np.arange(0, 20000, 7, dtype=np.int64)])
+    offsets_ar = np.append(offsets_ar, spikes_ar.size)
+    n_clusters = offsets_ar.size-1
+    pairs_ar = np.array([(a, b) for a in range(n_clusters) for b in range(n_clusters)], dtype=np.int64)
+    ccg_ar = crosscorrelogram_counts(spikes_ar, offsets_ar, pairs_ar, max_lag, bin_size)
+
+    lag = max_lag//bin_size*bin_size
+    edges = np.arange(-lag, lag+1, bin_size)
+    for p, (a, b) in enumerate(pairs_ar):
+        lags = np.subtract.outer(spikes_ar[offsets_ar[b]:offsets_ar[b+1]], spikes_ar[offsets_ar[a]:offsets_ar[a+1]]).ravel()
+        # -lag <= lag < lag, np.histogram closes the last bin
+        expected = np.histogram(lags[(lags >= -lag) & (lags < lag)], bins=edges)[0]
+        if not np.array_equal(ccg_ar[p], expected):
+            raise AssertionError(f"ccg of pair ({a}, {b}) differs from pairwise lag histogram")
+    return True
+
+
+# sda_class ###############################################################################################################
+def check_shuffle_isi_buffer(seeds=range(5)):
+    """shuffle_isi_buffer against a per (cluster, segment) loop
+
+    every (cluster, segment) keeps its first and last spike and its multiset of inter spike intervals,
+    spikes outside of the segments are not moved
+    """
+    spikes_ar, offsets_ar = random_spike_buffer()
+    bounds_ar = np.array([[1000, 5000], [6000, 9000], [9000, 9500], [12000, 17000]], dtype=np.int64)
+    for seed in seeds:
+        shuffled_ar = shuffle_isi_buffer(spikes_ar, offsets_ar, bounds_ar, np.random.default_rng(seed))
+        for cl in range(offsets_ar.size-1):
+            spikes = spikes_ar[offsets_ar[cl]:offsets_ar[cl+1]]
+            shuffled = shuffled_ar[offsets_ar[cl]:offsets_ar[cl+1]]
+            if np.any(np.diff(shuffled) <= 0):
+                raise AssertionError(f"cluster {cl} is not strictly sorted after isi shuffle, seed {seed}")
+            outside = np.ones(spikes.size, dtype=bool)
+            for start, end in bounds_ar:
+                inside = (spikes >= start) & (spikes < end)
+                outside &= ~inside
+                if inside.sum() == 0:
+                    continue
+                a, b = spikes[inside], shuffled[inside]
+                if a[0] != b[0] or a[-1] != b[-1]:
+                    raise AssertionError(f"first / last spike of cluster {cl} in [{start}, {end}) moved, seed {seed}")
+                if not np.array_equal(np.sort(np.diff(a)), np.sort(np.diff(b))):
+                    raise AssertionError(f"isi multiset of cluster {cl} in [{start}, {end}) changed, seed {seed}")
+            if not np.array_equal(spikes[outside], shuffled[outside]):
+                raise AssertionError(f"spikes of cluster {cl} outside of the segments moved, seed {seed}")
+    return True
+
+
+def check_jitter_spike_buffer(jitter=30, seeds=range(5)):
+    """jitter_spike_buffer against shifting and sorting every cluster on its own, same random draws"""
+    spikes_ar, offsets_ar = random_spike_buffer()
+    for seed in seeds:
+        jittered_ar = jitter_spike_buffer(spikes_ar, offsets_ar, jitter, np.random.default_rng(seed))
+        shift = np.random.default_rng(seed).integers(-jitter, jitter+1, size=spikes_ar.size)
+        for cl in range(offsets_ar.size-1):
+            a, b = offsets_ar[cl], offsets_ar[cl+1]
+            expected = np.sort(np.maximum(spikes_ar[a:b]+shift[a:b], 0))
+            if not np.array_equal(jittered_ar[a:b], expected):
+                raise AssertionError(f"jittered spikes of cluster {cl} differ from reference, seed {seed}")
+            if np.abs(jittered_ar[a:b]-spikes_ar[a:b]).max(initial=0) > jitter:
+                raise AssertionError(f"sorted spikes of cluster {cl} moved more than jitter, seed {seed}")
+    return True
+
+
+# run #####################################################################################################################
+CHECKS = {
+    'find_missing_ttl': check_find_missing_ttl,
+    'crosscorrelogram_counts': check_crosscorrelogram_counts,
+    'shuffle_isi_buffer': check_shuffle_isi_buffer,
+    'jitter_spike_buffer': check_jitter_spike_buffer,
+}
+
+
+def run_checks(names=None):
+    """run checks by name, a failing check raises AssertionError"""
+    for name in names or CHECKS.keys():
+        CHECKS[name]()
+        print(f"{name:<28} ok")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='brute force reference checks of the spike kernels')
+    parser.add_argument('checks', nargs='*', help='names of CHECKS, default all: '+' '.join(CHECKS.keys()))
+    args = parser.parse_args()
+    run_checks(args.checks)
@@ -0,0 +1,216 @@
+import numpy as np
+import pandas as pd
+import os
+
+from export_class import SessionDataset, write_table, read_table
+
+
+# class ###################################################################################################################
+class CohortIndex():
+    """[# per session and per cluster summary of a dataset written by SpikesExport, with queries over all sessions]
+
+    spike times and psth cubes are only loaded for the clusters of a query result:
+
+        index = CohortIndex('dataset')
+        index.build()
+        result_df = index.query("group == 'good' and reward_gamble_peak_hz > surrogate_gamble_p99_hz")
+        spikes = index.load_spikes(result_df)
+    """
+    def __init__(self, dataset, events=['reward'], window=2000, n_bins=60, surrogate='surrogate', surrogate_subset='all', percentile=99):
+        """[summary]
+
+        Args:
+            dataset (str): dataset folder of SpikesExport
+            events (list, optional): psth events summarized per cluster. Defaults to ['reward'].
+            window (int, optional): 1/2 window width in ms of the summarized psth cubes. Defaults to 2000.
+            n_bins (int, optional): number of psth bins. Defaults to 60.
+            surrogate (str, optional): name of the exported surrogate array (i=good cluster, j=bin, k=iteration) from
+                SpikesSDA.gen_surrogate_cube with window and n_bins of the index. Defaults to 'surrogate'.
+            surrogate_subset (str, optional): trial subset of the surrogate array, its trials_mask has to be the same subset
+                ('all', 'gamble', 'save', 'reward' or 'gamble_reward'), e.g. get_trial_mask(side='gamble'). Defaults to 'all'.
+            percentile (int, optional): percentile of surrogate peak rates. Defaults to 99.
+        """
+        self.dataset = dataset
+        self.data = SessionDataset(dataset)
+        self.events = events
+        self.window = window
+        self.n_bins = n_bins
+        self.surrogate = surrogate
+        self.surrogate_subset = surrogate_subset
+        self.percentile = percentile
+        self.index_folder = os.path.join(dataset, 'index')
+
+        self.sessions_df, self.clusters_df = self.load_index()
+
+    # index ==================================================================================================================
+    def load_index(self):
+        """stored index tables, empty if there is no index yet"""
+        if not os.path.isdir(os.path.join(self.index_folder, 'clusters')):
+            return pd.DataFrame(), pd.DataFrame()
+        sessions_df = read_table(os.path.join(self.index_folder, 'sessions'), mmap=False)
+        clusters_df = read_table(os.path.join(self.index_folder, 'clusters'), mmap=False)
+        return sessions_df, clusters_df
+
+    def save_index(self):
+        write_table(os.path.join(self.index_folder, 'sessions'), self.sessions_df)
+        write_table(os.path.join(self.index_folder, 'clusters'), self.clusters_df)
+
+    def build(self, sessions=None, update=False):
+        """summarize sessions and store the index
+
+        Args:
+            sessions (list, optional): sessions to index. Defaults to all sessions of the dataset.
+            update (bool, optional): index again sessions that are already in the index. Defaults to False.
+
+        Returns:
+            pd.DataFrame: cluster index
+        """
+        if sessions is None:
+            sessions = self.data.sessions()
+        indexed = set(self.sessions_df['session'].astype(str)) if self.sessions_df.shape[0] > 0 else set()
+        sessions = [session for session in sessions if update or session not in indexed]
+        if len(sessions) == 0:
+            return self.clusters_df
+
+        rows = [self.summarize_session(session) for session in sessions]
+        sessions_df = pd.DataFrame([row[0] for row in rows])
+        clusters_df = pd.concat([row[1] for row in rows], ignore_index=True)
+
+        # replace old rows of the sessions
+        if self.sessions_df.shape[0] > 0:
+            keep = ~self.sessions_df['session'].astype(str).isin(sessions)
+            sessions_df = pd.concat([self.sessions_df.loc[keep], sessions_df], ignore_index=True)
+            keep = ~self.clusters_df['session'].astype(str).isin(sessions)
+            clusters_df = pd.concat([self.clusters_df.loc[keep].astype({'session':str}), clusters_df], ignore_index=True)
+        sessions_df['session'] = sessions_df['session'].astype(str).astype('category')
+        clusters_df['session'] = clusters_df['session'].astype(str).astype('category')
+        self.sessions_df, self.clusters_df = sessions_df, clusters_df
+        self.save_index()
+        return self.clusters_df
+
+    def summarize_session(self, session):
+        """summary of one exported session
+
+        Args:
+            session (str): session
+
+        Returns:
+            tuple: (session dict, pd.DataFrame with one row per cluster)
+        """
+        meta = self.data.load_meta(session)
+        partition = self.data.get_partition(session)
+        trials_df = read_table(os.path.join(partition, 'trials'))
+        clusters_df = read_table(os.path.join(partition, 'clusters'), mmap=False)
+        clusters_df = clusters_df.drop([c for c in ['session'] if c in clusters_df.columns], axis=1)
+        clusters_df.insert(0, 'session', session)
+
+        good_trials_df = trials_df.loc[trials_df['good'].values.astype(bool)]
+        selected = good_trials_df['selected'].values.astype(bool)
+        gamble = meta['gamble_side']
+        save = 'left' if gamble == 'right' else 'right'
+        subsets = {
+            'all': selected,
+            'gamble': selected & good_trials_df[gamble].values.astype(bool),
+            'save': selected & good_trials_df[save].values.astype(bool),
+            'reward': selected & good_trials_df['reward_given'].values.astype(bool),
+            'gamble_reward': selected & good_trials_df[gamble].values.astype(bool) & good_trials_df['reward_given'].values.astype(bool),
+        }
+
+        good = clusters_df['neuron_idx'].values >= 0
+        bin_s = 2*self.window/self.n_bins/1000
+        for event in self.events:
+            cube = np.asarray(self.data.load_psth(session, event, self.window, self.n_bins))
+            for name, mask in subsets.items():
+                # peak of trial averaged rate over bins
+                peak = np.full(clusters_df.shape[0], np.nan, dtype=np.float32)
+                if mask.sum() > 0:
+                    peak[good] = cube[:, mask, :].mean(axis=1).max(axis=1)/bin_s
+                clusters_df[f"{event}_{name}_peak_hz"] = peak
+
+        # percentile of surrogate peak rates, same bins and trial subset as the psth peaks it is compared to
+        surrogate_p = np.full(clusters_df.shape[0], np.nan, dtype=np.float32)
+        surrogate_file = os.path.join(partition, 'arrays', self.surrogate+'.npy')
+        if os.path.isfile(surrogate_file):
+            surrogate_ar = np.load(surrogate_file, mmap_mode='r')
+            if surrogate_ar.shape[1] != self.n_bins:
+                raise ValueError(f"surrogate of {session} has {surrogate_ar.shape[1]} bins, the index uses n_bins={self.n_bins}")
+            n_trials = subsets[self.surrogate_subset].sum()
+            if n_trials > 0:
+                surrogate_p[good] = np.percentile(np.asarray(surrogate_ar).max(axis=1), self.percentile, axis=1)/n_trials/bin_s
+        clusters_df[f"surrogate_{self.surrogate_subset}_p{self.percentile}_hz"] = surrogate_p
+
+        # isi quality metrics if exported
+        if os.path.isdir(os.path.join(partition, 'qc')):
+            qc_df = read_table(os.path.join(partition, 'qc'), mmap=False)
+            clusters_df = clusters_df.merge(qc_df.drop([c for c in ['n_spikes', 'firing_rate'] if c in qc_df.columns], axis=1),
+                                            how='left', on='cluster id')
+
+        session_dict = {
+            'session': session,
+            'gamble_side': gamble,
+            'n_trials': trials_df.shape[0],
+            'n_good_trials': good_trials_df.shape[0],
+            'n_selected_trials': int(selected.sum()),
+            'n_clusters': clusters_df.shape[0],
+            'n_good_clusters': int(good.sum()),
+            'duration_s': float(trials_df['end'].max()-trials_df['start'].min())/20000,
+            'exported': meta['exported'],
+        }
+        return session_dict, clusters_df
+
+    # query ==================================================================================================================
+    def query(self, expr=None, sessions=None, **columns):
+        """clusters of all sessions matching a filter, no spike data is loaded
+
+        Args:
+            expr (str, optional): pandas query on the cluster index, e.g. "group == 'good' and fr > 2". Defaults to None.
+            sessions (list, optional): only these sessions. Defaults to all.
+            columns: column == value filters, e.g. group='good'
+
+        Returns:
+            pd.DataFrame: matching rows of the cluster index
+        """
+        result_df = self.clusters_df
+        if sessions is not None:
+            result_df = result_df.loc[result_df['session'].isin(sessions)]
+        for column, value in columns.items():
+            result_df = result_df.loc[result_df[column] == value]
+        if expr is not None:
+            result_df = result_df.query(expr)
+        return result_df
+
+    def load_spikes(self, result_df):
+        """spike times of the clusters of a query result, loaded per session
+
+        Args:
+            result_df (pd.DataFrame): from query, good clusters only
+
+        Returns:
+            dict: (session, cluster id) -> spike times in sampling points
+        """
+        spikes = dict()
+        for session, frame in result_df.groupby('session', observed=True):
+            for cluster, spike_times in self.data.load_spikes(str(session), frame['cluster id'].values).items():
+                spikes[(str(session), cluster)] = spike_times
+        return spikes
+
+    def load_psth(self, result_df, event, window=None, n_bins=None):
+        """psth cubes of the clusters of a query result
+
+        Args:
+            result_df (pd.DataFrame): from query, good clusters only
+            event (str): trial event
+            window (int, optional): 1/2 window width in ms. Defaults to window of the index.
+            n_bins (int, optional): number of bins. Defaults to n_bins of the index.
+
+        Returns:
+            dict: (session, cluster id) -> psth (i=good trial, j=bin)
+        """
+        window = self.window if window is None else window
+        n_bins = self.n_bins if n_bins is None else n_bins
+        psth = dict()
+        for session, frame in result_df.groupby('session', observed=True):
+            cube = self.data.load_psth(str(session), event, window, n_bins, clusters=frame['cluster id'].values)
+            for cluster, ar in zip(frame['cluster id'].values, cube):
+                psth[(str(session), cluster)] = ar
+        return psth
@@ -0,0 +1,222 @@
+import numpy as np
+import pandas as pd
+import matplotlib.pyplot as plt
+from concurrent.futures import ThreadPoolExecutor
+
+
+# linear decoder ##########################################################################################################
+def get_folds(labels, n_folds=5, seed=0):
+    """stratified cross validation folds
+
+    Args:
+        labels (np ar): integer class of each trial
+        n_folds (int, optional): number of folds. Defaults to 5.
+        seed (int, optional): random seed. Defaults to 0.
+
+    Returns:
+        np ar: fold of each trial
+    """
+    rng = np.random.default_rng(seed)
+    # random order within each class, trials sorted by class are dealt round robin over the folds,
+    # each class continues where the previous one stopped so the leftover trials rotate over the folds
+    order = np.lexsort((rng.random(labels.size), labels))
+    folds = np.empty(labels.size, dtype=np.int64)
+    folds[order] = (np.arange(labels.size) + rng.integers(n_folds)) % n_folds
+    return folds
+
+
+def fit_predict_ridge(X_train, y_train, X_test, n_classes, alpha=1.0):
+    """ridge classifier (one hot targets) for many feature sets at once, dual form
+
+    features are z-scored with the training trials, the dual form only needs (trial x trial) kernels,
+    so the cost does not grow with clusters x bins beyond one matrix product
+
+    Args:
+        X_train (np ar): float32 (i=feature set, j=train trial, k=feature)
+        y_train (np ar): integer class of the train trials
+        X_test (np ar): float32 (i=feature set, j=test trial, k=feature)
+        n_classes (int): number of classes
+        alpha (float, optional): ridge penalty. Defaults to 1.0.
+
+    Returns:
+        np ar: predicted class (i=feature set, j=test trial)
+    """
+    mean = X_train.mean(axis=1, keepdims=True)
+    std = X_train.std(axis=1, keepdims=True)
+    std = np.where(std > 0, std, 1)
+    X_train = (X_train-mean)/std
+    X_test = (X_test-mean)/std
+
+    Y = np.eye(n_classes)[y_train]
+    y_mean = Y.mean(axis=0)
+    K = np.matmul(X_train, X_train.transpose(0, 2, 1)).astype(np.float64)
+    K += alpha*np.eye(K.shape[1])[None]
+    A = np.linalg.solve(K, np.broadcast_to(Y-y_mean, (K.shape[0],)+Y.shape))
+    scores = np.matmul(np.matmul(X_test, X_train.transpose(0, 2, 1)).astype(np.float64), A) + y_mean
+    return scores.argmax(axis=2)
+
+
+# class ###################################################################################################################
+class SpikesDecoding():
+    """[# cross validated, time resolved decoding of trial variables from binned population activity]
+
+    design matrix of an event is (trial, cluster x bin) from the psth cube of SpikesEDA:
+
+        decoding_obj = SpikesDecoding(spikes_obj)
+        decode_df = decoding_obj.decode('reward', 'reward_given', window=2000, n_bins=40, width=4)
+    """
+    def __init__(self, spikes_obj):
+        self.session = spikes_obj.session
+        self.folder = spikes_obj.folder
+        self.gamble_side = spikes_obj.gamble_side
+
+        # trial table and psth cubes are read from spikes_obj on every call, set_selection of spikes_obj applies
+        self.clusters_df = spikes_obj.clusters_df
+        self.spikes_obj = spikes_obj
+        self.decode_dict = dict()
+
+    # design matrix ==========================================================================================================
+    def get_design_cube(self, event, window, n_bins=60, trials_mask=None):
+        """binned counts around event as float32 (i=trial, j=good cluster, k=bin)"""
+        cube = self.spikes_obj.gen_psth_cube(event, window, n_bins)
+        if trials_mask is not None:
+            cube = cube[:, trials_mask, :]
+        return cube.transpose(1, 0, 2).astype(np.float32)
+
+    def get_design_matrix(self, event, window, n_bins=60, trials_mask=None):
+        """design matrix of the whole window
+
+        Args:
+            event (str): event column of selected_trials_df
+            window (int): 1/2 window width in ms
+            n_bins (int, optional): number of bins over the whole window. Defaults to 60.
+            trials_mask (np ar, optional): bool mask over selected trials. Defaults to all selected trials.
+
+        Returns:
+            np ar: float32 (i=trial, j=good cluster x bin), bins of a cluster are adjacent
+        """
+        cube = self.get_design_cube(event, window, n_bins, trials_mask)
+        return cube.reshape(cube.shape[0], -1)
+
+    def get_labels(self, target):
+        """class of every selected trial
+
+        Args:
+            target (str): 'side' (gamble / save), 'reward_given', 'probability', 'block' or any column of selected_trials_df
+
+        Returns:
+            tuple: (integer class per selected trial, class names, bool mask of trials with a class)
+        """
+        trials_df = self.spikes_obj.selected_trials_df
+        if target == 'side':
+            save = 'left' if self.gamble_side == 'right' else 'right'
+            gamble = trials_df[self.gamble_side].values.astype(bool)
+            valid = gamble | trials_df[save].values.astype(bool)
+            return np.where(gamble, 0, 1), np.array(['gamble', 'save']), valid
+        codes, names = pd.factorize(trials_df[target], sort=True)
+        return codes, np.asarray(names), codes >= 0
+
+    # decoding ===============================================================================================================
+    def decode(self, event, target, window=2000, n_bins=60, width=5, step=1, n_folds=5, alpha=1.0,
+               trials_mask=None, n_shuffles=0, max_workers=None, seed=0):
+        """time resolved decoding with sliding windows of width bins, cached in decode_dict
+
+        all sliding windows of a fold are fitted at once, folds run in parallel threads
+
+        Args:
+            event (str): event column of selected_trials_df
+            target (str): trial variable, see get_labels
+            window (int, optional): 1/2 window width in ms. Defaults to 2000.
+            n_bins (int, optional): number of bins over the whole window. Defaults to 60.
+            width (int, optional): bins per sliding window. Defaults to 5.
+            step (int, optional): bins between sliding windows. Defaults to 1.
+            n_folds (int, optional): cross validation folds. Defaults to 5.
+            alpha (float, optional): ridge penalty. Defaults to 1.0.
+            trials_mask (np ar, optional): bool mask over selected trials. Defaults to all selected trials.
+            n_shuffles (int, optional): label shuffles for the chance distribution. Defaults to 0.
+            max_workers (int, optional): threads for the folds. Defaults to n_folds.
+            seed (int, optional): random seed. Defaults to 0.
+
+        Returns:
+            pd.DataFrame: one row per sliding window, index = window center in ms,
+                columns ['accuracy', 'accuracy_sem', 'chance'] (+ ['shuffle_mean', 'shuffle_p95', 'p'] with shuffles)
+        """
+        mask_key = None if trials_mask is None else np.asarray(trials_mask, dtype=bool).tobytes()
+        key = (event, target, window, n_bins, width, step, n_folds, alpha, self.spikes_obj.select_ar.tobytes(), mask_key, n_shuffles, seed)
+        if key in self.decode_dict:
+            return self.decode_dict[key]
+
+        labels, names, valid = self.get_labels(target)
+        if trials_mask is not None:
+            valid &= np.asarray(trials_mask, dtype=bool)
+        labels = labels[valid]
+        n_classes = names.size
+        if np.bincount(labels, minlength=n_classes).min() < n_folds:
+            raise ValueError(f"every class of '{target}' needs at least {n_folds} trials")
+
+        # sliding windows (i=window, j=trial, k=cluster x bin of the window)
+        cube = self.get_design_cube(event, window, n_bins, valid)
+        windows = np.lib.stride_tricks.sliding_window_view(cube, width, axis=2)[:, :, ::step]
+        X = np.ascontiguousarray(windows.transpose(2, 0, 1, 3)).reshape(windows.shape[2], cube.shape[0], -1)
+
+        rng = np.random.default_rng(seed)
+        folds = get_folds(labels, n_folds, seed)
+
+        def accuracy(y):
+            def fit_fold(fold):
+                test = folds == fold
+                predicted = fit_predict_ridge(X[:, ~test], y[~test], X[:, test], n_classes, alpha)
+                return (predicted == y[test][None, :]).mean(axis=1)
+            with ThreadPoolExecutor(max_workers or n_folds) as executor:
+                return np.stack(list(executor.map(fit_fold, range(n_folds))), axis=1)
+
+        fold_ar = accuracy(labels)
+        edges = self.spikes_obj.get_psth_edges(window, n_bins)/20
+        centers = (edges[:-1]+edges[1:])/2
+        decode_df = pd.DataFrame({
+            'accuracy': fold_ar.mean(axis=1),
+            'accuracy_sem': fold_ar.std(axis=1)/np.sqrt(n_folds),
+            'chance': np.bincount(labels).max()/labels.size,
+        }, index=pd.Index(np.lib.stride_tricks.sliding_window_view(centers, width)[::step].mean(axis=1), name='time'))
+
+        if n_shuffles > 0:
+            shuffle_ar = np.stack([accuracy(rng.permutation(labels)).mean(axis=1) for _ in range(n_shuffles)], axis=1)
+            decode_df['shuffle_mean'] = shuffle_ar.mean(axis=1)
+            decode_df['shuffle_p95'] = np.percentile(shuffle_ar, 95, axis=1)
+            decode_df['p'] = ((shuffle_ar >= decode_df['accuracy'].values[:, None]).sum(axis=1)+1)/(n_shuffles+1)
+
+        self.decode_dict[key] = decode_df
+        return decode_df
+
+    def decode_events(self, target, events=['cue', 'sound', 'openloop', 'reward'], **kwargs):
+        """decode for several events, kwargs are passed to decode
+
+        Returns:
+            pd.DataFrame: decode results with (event, time) index
+        """
+        return pd.concat({event: self.decode(event, target, **kwargs) for event in events}, names=['event'])
+
+    # plotting ===============================================================================================================
+    def plt_decoding(self, decode_df, title=None):
+        """accuracy over time with sem and chance level
+
+        Args:
+            decode_df (pd.DataFrame): from decode
+
+        Returns:
+            fig, ax:
+        """
+        fig, ax = plt.subplots(figsize=(6, 3))
+        time = decode_df.index.values
+        ax.plot(time, decode_df['accuracy'], color='k', label='accuracy')
+        ax.fill_between(time, decode_df['accuracy']-decode_df['accuracy_sem'], decode_df['accuracy']+decode_df['accuracy_sem'], color='k', alpha=0.2)
+        ax.plot(time, decode_df['chance'], color='grey', linestyle='--', label='chance')
+        if 'shuffle_p95' in decode_df.columns:
+            ax.plot(time, decode_df['shuffle_p95'], color='tab:red', linestyle=':', label='shuffle 95%')
+        ax.axvline(0, color='grey', linewidth=0.5)
+        ax.set_xlabel('time [ms]')
+        ax.set_ylabel('accuracy')
+        ax.legend(loc='upper right', fontsize=8)
+        if title is not None:
+            ax.set_title(title)
+        return fig, ax
@@ -7,12 +7,101 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import csv
 import scipy.stats as st
+from scipy.signal import fftconvolve
 import platform
 import os
 from mpl_toolkits.mplot3d import Axes3D
 from matplotlib import cm
 from matplotlib.ticker import LinearLocator, FormatStrFormatter
 
+# numba helper functions
+from numba import njit, prange
+
+from sync_class import get_blocks
+
+
+@njit()
+def autocorrelogram_counts(spikes_ar, offsets_ar, max_lag, bin_size):
+    """count spike pairs of each cluster with lag < max_lag, two pointer sweep over the sorted spikes
+
+    Args:
+        spikes_ar (np ar): flat spike buffer, sorted within each cluster
+        offsets_ar (np ar): cluster i = spikes_ar[offsets_ar[i]:offsets_ar[i+1]]
+        max_lag (int): max lag in sampling points
+        bin_size (int): bin width in sampling points
+
+    Returns:
+        np ar: array (i=cluster, j=lag bin), bins from -max_lag to max_lag
+    """
+    half = max_lag//bin_size
+    acg_ar = np.zeros((offsets_ar.size-1, 2*half), dtype=np.int64)
+    for cl in range(offsets_ar.size-1):
+        for i in range(offsets_ar[cl], offsets_ar[cl+1]):
+            j = i+1
+            while j < offsets_ar[cl+1] and spikes_ar[j]-spikes_ar[i] < half*bin_size:
+                k = (spikes_ar[j]-spikes_ar[i])//bin_size
+                # symmetric, count pair for +lag and -lag
+                acg_ar[cl, half+k] += 1
+                acg_ar[cl, half-1-k] += 1
+                j += 1
+    return acg_ar
+
+
+@njit(parallel=True)
+def crosscorrelogram_counts(spikes_ar, offsets_ar, pairs_ar, max_lag, bin_size):
+    """count spike pairs between two clusters with -max_lag <= lag < max_lag, merge sweep per pair, pairs run in parallel
+
+    Args:
+        spikes_ar (np ar): flat spike buffer, sorted within each cluster
+        offsets_ar (np ar): cluster i = spikes_ar[offsets_ar[i]:offsets_ar[i+1]]
+        pairs_ar (np ar): array (i=pair, j=[cluster a, cluster b])
+        max_lag (int): max lag in sampling points
+        bin_size (int): bin width in sampling points
+
+    Returns:
+        np ar: array (i=pair, j=lag bin), lag = spike time b - spike time a
+    """
+    half = max_lag//bin_size
+    lag = half*bin_size
+    ccg_ar = np.zeros((pairs_ar.shape[0], 2*half), dtype=np.int64)
+    for p in prange(pairs_ar.shape[0]):
+        a_start, a_end = offsets_ar[pairs_ar[p, 0]], offsets_ar[pairs_ar[p, 0]+1]
+        b_start, b_end = offsets_ar[pairs_ar[p, 1]], offsets_ar[pairs_ar[p, 1]+1]
+        # first spike of b inside the lag window of the current spike of a, only moves forward
+        j = b_start
+        for i in range(a_start, a_end):
+            t = spikes_ar[i]
+            while j < b_end and spikes_ar[j] < t-lag:
+                j += 1
+            k = j
+            while k < b_end and spikes_ar[k]-t < lag:
+                ccg_ar[p, (spikes_ar[k]-t)//bin_size + half] += 1
+                k += 1
+    return ccg_ar
+
+
+def search_spike_buffer(spikes_ar, offsets_ar, times, span):
+    """searchsorted of times into every cluster of a flat spike buffer at once
+
+    Args:
+        spikes_ar (np ar): flat spike buffer, sorted within each cluster
+        offsets_ar (np ar): cluster i = spikes_ar[offsets_ar[i]:offsets_ar[i+1]]
+        times (np ar): time points in sampling points, any shape
+        span (int): larger than any spike time and time point
+
+    Returns:
+        np ar: int64 array (i=cluster, *times.shape), number of spikes of the cluster before each time point
+    """
+    # spikes of all clusters in one sorted array: key = cluster * span + spike time
+    n_clusters = offsets_ar.size-1
+    cluster_ar = np.repeat(np.arange(n_clusters, dtype=np.int64), np.diff(offsets_ar))
+    keys_ar = cluster_ar*span + spikes_ar
+    # times outside of the recording must not leak into the neighbouring cluster
+    times = np.clip(np.asarray(times, dtype=np.int64), 0, span-1)
+    shape = (n_clusters,)+(1,)*times.ndim
+    offset = (np.arange(n_clusters, dtype=np.int64)*span).reshape(shape)
+    idx = np.searchsorted(keys_ar, offset + times[None], side='left')
+    return idx - offsets_ar[:-1].reshape(shape)
 
 
 # class ###################################################################################################################
@@ -21,15 +110,26 @@ class SpikesEDA():
         self.session = behavior_obj.session
         self.folder = behavior_obj.folder
         self.gamble_side = behavior_obj.gamble_side
+        # trial selection lives in the behavior object, see set_selection
+        self.behavior_obj = behavior_obj
 
         self.all_trials_df = behavior_obj.all_trials_df
         self.good_trials_df = behavior_obj.good_trials_df
         self.selected_trials_df = behavior_obj.selected_trials_df
+        self.select_ar = behavior_obj.select_ar
+        self.behav_df = behavior_obj.behav_df
         self.skip_clusters = skip_clusters
         self.spikes_df, self.clusters_df = self.load_files()
         
-        self.spikes_per_trial_ar = self.gen_spike_per_trial_matrix()
         self.spikes_per_cluster_ar = self.gen_spike_per_cluster_matrix()
+        self.spikes_buffer_ar, self.spikes_offsets_ar = self.gen_spike_buffer()
+        self.trial_spike_idx_ar = self.gen_trial_spike_idx()
+        self.spikes_per_trial_ar = self.gen_spike_per_trial_matrix()
+        # psth cubes over all good trials, psth_cube_dict holds the selected trials
+        self.psth_cube_all_dict = dict()
+        self.psth_cube_dict = dict()
+        self.isi_stats_dict = dict()
+        self.ccg_dict = dict()
         #self.randomized_bins_ar = self.get_randomized_samples(200, 1000)
 
     # load files from kilosort & behavior files
@@ -119,16 +219,19 @@ class SpikesEDA():
         return ar 
 
     # get all spikes for specified clusters
-    def get_spikes_for_cluster(self, trials_df, cluster):
+    def get_spikes_for_cluster(self, trials_df, cluster, mask=None):
         '''
         params: trials_df = array with all trials, start and stop times
                 sikes_times = df with all the spike times indext by cluster
                 cluster = integer of cluster
+                mask = bool array over trials_df rows, e.g. select_ar for good_trials_df, None = all rows
         return: DataFrame with all spikes
         '''
+        if mask is None:
+            mask = np.ones(trials_df.shape[0], dtype=bool)
         df = pd.DataFrame(index=[0])
-        for row in trials_df.index[trials_df['select'] == True]:
-            # create empty data frame indext by trials, but only one which have select = true
+        for row in trials_df.index[mask]:
+            # create empty data frame indext by trials, but only the ones in mask
             start = trials_df.loc[row, 'start']
             stop = trials_df.loc[row, 'end']
             df1 = pd.DataFrame({row:self.get_spikes_for_trial(cluster, start, stop)}, dtype="Int64")
@@ -142,63 +245,535 @@ class SpikesEDA():
         """
         calculate sliding bin count of spikes in bins for given bin length in ms
         cluster
-        ste step between two bins 
-            if none -> sliding bin with step 1
+        step between two bins in ms
+            if none -> bins next to each other, no overlap
             if 1/2 window ->   1/2 overlap of each sliding bin window
         """
-        bwidth_cl = window*20
-        cluster = self.spikes_df.loc[self.spikes_df['cluster']==cluster]['spike_times']
-        start = cluster.iloc[0].astype(int)
-        end = cluster.iloc[-1].astype(int)
-        if step == None:
-            step = bwidth_cl+1
+        spikes = np.sort(np.asarray(self.clusters_df.loc[cluster, 'spikes'], dtype=np.int64))
+        if spikes.size == 0:
+            # cluster without spikes, one zero count bin at the start of the first selected trial
+            start = int(self.selected_trials_df['start'].iloc[0])
+            bin_starts, bin_ends = self.get_bin_edges(window, step, start, start+int(round(window*20)))
         else:
-            step = step*20000
-        # calculate
-        # start of each bin
-        bin_starts = np.arange(start, end+1-bwidth_cl, step)
-        # end of each bin
-        bin_ends = bin_starts + bwidth_cl
+            bin_starts, bin_ends = self.get_bin_edges(window, step, spikes[0], spikes[-1])
         # calculate index of last spike for each bin end
-        last_idx = cluster.searchsorted(bin_ends, side='left').astype(int)
+        last_idx = spikes.searchsorted(bin_ends, side='left')
         # calculate index of first spike for each bin start
-        first_idx = cluster.searchsorted(bin_starts, side='left')
+        first_idx = spikes.searchsorted(bin_starts, side='left')
+        count = last_idx - first_idx
+        # last spike in bin, -1 for empty bins
+        last_spike = np.where(count > 0, spikes[np.maximum(last_idx-1, 0)], -1) if spikes.size > 0 else np.full(count.size, -1, dtype=np.int64)
         # return number of indexes in between start and end = number of spikes in between
-        df = pd.DataFrame({'count':(last_idx - first_idx), 'start index':first_idx, 'bin end time':bin_ends ,'last spike in bin':cluster.iloc[last_idx-1].values})
+        df = pd.DataFrame({'count':count, 'start index':first_idx, 'bin end time':bin_ends ,'last spike in bin':last_spike})
         df.index.name = 'bin'
-        # add trial indexes
-        bins = self.selected_trials_df['end'].values
-        bins = np.insert(bins, 0, 0)
-        # labels
-        labels = self.selected_trials_df.index.values
         # add trial index
-        df['trial'] = pd.cut(df['bin end time'], bins, labels=labels, right=True, include_lowest=True)
+        df['trial'] = self.get_bin_trials(bin_ends)
         df.set_index('trial', append=True, inplace=True)
         df = df.swaplevel(0, 1)
         return df
 
+    # firing rate engine =================
+    def get_bin_edges(self, window, step, start, end):
+        """start and end of all bins between start and end
+
+        Args:
+            window (float): bin width in ms
+            step (float): ms between two bin starts, if None -> step = window
+            start (int): first bin start in sampling points
+            end (int): last bin end in sampling points
+
+        Returns:
+            tuple: (bin_starts, bin_ends) in sampling points, bins are [start, end)
+        """
+        bwidth = int(round(window*20))
+        if step == None:
+            step = bwidth
+        else:
+            step = int(round(step*20))
+        bin_starts = np.arange(int(start), int(end)+1-bwidth, step, dtype=np.int64)
+        bin_ends = bin_starts + bwidth
+        return bin_starts, bin_ends
+
+    def get_bin_trials(self, bin_ends):
+        """selected trial each bin belongs to, trial i holds all bins with end in (end[i-1], end[i]]
+
+        Args:
+            bin_ends (np ar): end of bins in sampling points
+
+        Returns:
+            np ar: index of selected_trials_df for each bin, -1 after the last trial
+        """
+        ends = self.selected_trials_df['end'].values
+        trial_idx = np.searchsorted(ends, bin_ends, side='left')
+        labels = np.append(self.selected_trials_df.index.values, -1)
+        return labels[trial_idx]
+
+    def gen_spike_buffer(self):
+        """flat buffer with spike times of all good clusters (CSR layout)
+
+        Returns:
+            tuple: (spikes_buffer_ar, spikes_offsets_ar)
+                spike times of good cluster i (neuron_idx) are
+                spikes_buffer_ar[spikes_offsets_ar[i]:spikes_offsets_ar[i+1]], sorted, in sampling points
+        """
+        # clusters without spikes have 0 instead of an array in clusters_df
+        spikes_li = [np.sort(np.asarray(spikes, dtype=np.int64)) if isinstance(spikes, np.ndarray) else np.zeros(0, dtype=np.int64)
+                     for spikes in self.spikes_per_cluster_ar]
+        offsets_ar = np.zeros(len(spikes_li)+1, dtype=np.int64)
+        offsets_ar[1:] = np.cumsum([spikes.size for spikes in spikes_li])
+        if len(spikes_li) > 0:
+            buffer_ar = np.concatenate(spikes_li)
+        else:
+            buffer_ar = np.zeros(0, dtype=np.int64)
+        return buffer_ar, offsets_ar
+
+    def get_spike_idx(self, times, neuron_idx=None):
+        """searchsorted of times into the spikes of every good cluster at once
+
+        Args:
+            times (np ar): time points in sampling points, any shape
+            neuron_idx (np ar, optional): only these good clusters. Defaults to all good clusters.
+
+        Returns:
+            np ar: int64 array (i=good cluster, *times.shape), number of spikes of the cluster before each time point
+        """
+        spikes_ar, offsets_ar = self.spikes_buffer_ar, self.spikes_offsets_ar
+        if neuron_idx is not None:
+            spikes_ar, offsets_ar = self.get_spike_buffer_clusters(neuron_idx)
+        return search_spike_buffer(spikes_ar, offsets_ar, times, int(self.spikes_buffer_ar.max(initial=0))+2)
+
+    def get_spike_buffer_clusters(self, neuron_idx):
+        """spike buffer of a subset of good clusters
+
+        Args:
+            neuron_idx (np ar): good cluster indices
+
+        Returns:
+            tuple: (spikes_ar, offsets_ar) for the clusters in the given order
+        """
+        neuron_idx = np.asarray(neuron_idx, dtype=np.int64)
+        starts = self.spikes_offsets_ar[neuron_idx]
+        n_spikes = self.spikes_offsets_ar[neuron_idx+1]-starts
+        offsets_ar = np.concatenate([[0], np.cumsum(n_spikes)]).astype(np.int64)
+        idx = np.repeat(starts-offsets_ar[:-1], n_spikes) + np.arange(offsets_ar[-1])
+        return self.spikes_buffer_ar[idx], offsets_ar
+
+    def bin_count_all_clusters(self, window, step=None, start=None, end=None, kernel=None, sigma=None, rate=False):
+        """binned (step=None) or sliding window spike count for all good clusters at once
+
+        Args:
+            window (float): bin width in ms
+            step (float, optional): ms between two bin starts, if None -> bins without overlap. Defaults to None.
+            start (int, optional): first bin start in sampling points. Defaults to start of first selected trial.
+            end (int, optional): last bin end in sampling points. Defaults to end of last selected trial.
+            kernel (str, optional): smooth counts with 'gaussian' or 'causal' (exponential) kernel. Defaults to None.
+            sigma (float, optional): kernel width in ms. Defaults to window.
+            rate (bool, optional): return firing rate in Hz instead of spike count. Defaults to False.
+
+        Returns:
+            tuple: (count_ar, bin_starts, trial_ar)
+                count_ar: float32 array (i=good cluster, j=bin)
+                bin_starts: start of each bin in sampling points
+                trial_ar: index of selected_trials_df for each bin, -1 after the last trial
+        """
+        if start == None:
+            start = self.selected_trials_df['start'].values[0]
+        if end == None:
+            end = self.selected_trials_df['end'].values[-1]
+        bin_starts, bin_ends = self.get_bin_edges(window, step, start, end)
+
+        idx = self.get_spike_idx(np.stack([bin_starts, bin_ends]))
+        count_ar = (idx[:, 1, :] - idx[:, 0, :]).astype(np.float32)
+
+        if kernel != None:
+            count_ar = self.smooth_bin_count(count_ar, kernel, window if sigma == None else sigma, window if step == None else step)
+        if rate:
+            count_ar /= np.float32(window/1000)
+
+        return count_ar, bin_starts, self.get_bin_trials(bin_ends)
+
+    def smooth_bin_count(self, count_ar, kernel, sigma, step):
+        """smooth binned counts along the bin axis with fft convolution
+
+        Args:
+            count_ar (np ar): array (i=cluster, j=bin)
+            kernel (str): 'gaussian' (centered) or 'causal' (exponential decay, only past bins)
+            sigma (float): kernel width in ms
+            step (float): ms between two bins
+
+        Returns:
+            np ar: smoothed float32 array with same shape
+        """
+        # kernel support +/- 4 sigma in bins
+        half = max(int(np.ceil(4*sigma/step)), 1)
+        x = np.arange(-half, half+1)*step
+        if kernel == 'gaussian':
+            k = np.exp(-0.5*(x/sigma)**2)
+        elif kernel == 'causal':
+            k = np.where(x >= 0, np.exp(-x/sigma), 0)
+        else:
+            raise ValueError(f"unknown kernel: {kernel}")
+        k = k/k.sum()
+        smoothed = fftconvolve(count_ar, k[None, :], mode='same', axes=1)
+        return smoothed.astype(np.float32)
+
+    # psth cube =================
+    def gen_psth_cube(self, event, window, n_bins=60):
+        """spike count around event for all good clusters and all selected trials, cached in psth_cube_dict
+
+        Args:
+            event (str): event column of selected_trials_df ('start', 'cue', 'sound', 'openloop', 'reward', 'iti', 'end')
+            window (int): 1/2 window width in ms
+            n_bins (int, optional): number of bins over the whole window. Defaults to 60.
+
+        Returns:
+            np ar: int32 array (i=good cluster, j=selected trial, k=bin)
+        """
+        key = (event, window, n_bins)
+        if key not in self.psth_cube_dict:
+            # cube over all good trials is kept so that a new selection is only a re-index
+            if key not in self.psth_cube_all_dict:
+                event_ar = self.good_trials_df[event].values.astype(np.int64)
+                edges = event_ar[:, None] + self.get_psth_edges(window, n_bins)[None, :]
+                idx = self.get_spike_idx(edges)
+                self.psth_cube_all_dict[key] = np.diff(idx, axis=2).astype(np.int32)
+            self.psth_cube_dict[key] = self.psth_cube_all_dict[key][:, self.select_ar, :]
+        return self.psth_cube_dict[key]
+
+    def gen_psth_cubes(self, window, n_bins=60, events=['start', 'cue', 'sound', 'openloop', 'reward', 'iti', 'end']):
+        """psth cubes for all events, see gen_psth_cube
+
+        Returns:
+            dict: event -> psth cube
+        """
+        return {event: self.gen_psth_cube(event, window, n_bins) for event in events}
+
+    def get_psth_edges(self, window, n_bins):
+        """bin edges relative to event in sampling points"""
+        delta = window*20
+        return np.linspace(-delta, delta, n_bins+1).round().astype(np.int64)
+
+    def get_trial_mask(self, side=None, reward=None, probability=None, block=None):
+        """boolean mask over selected_trials_df for a trial subset
+
+        Args:
+            side (str, optional): 'gamble', 'save', 'right' or 'left', None -> both sides. Defaults to None.
+            reward (bool, optional): True -> rewarded, False -> not rewarded, None -> both. Defaults to None.
+            probability (float, optional): only trials of this probability block. Defaults to None.
+            block (int, optional): only trials of this block number, see sync_class.get_blocks. Defaults to None.
+
+        Returns:
+            np ar: bool array with one element per selected trial
+        """
+        trials_df = self.selected_trials_df
+        mask = np.ones(trials_df.shape[0], dtype=bool)
+        if side != None:
+            if side == 'gamble':
+                side = self.gamble_side
+            elif side == 'save':
+                side = 'left' if self.gamble_side == 'right' else 'right'
+            mask &= trials_df[side].values.astype(bool)
+        if reward != None:
+            mask &= trials_df['reward_given'].values.astype(bool) == reward
+        if probability != None:
+            mask &= trials_df['probability'].values == np.float32(probability)
+        if block != None:
+            mask &= trials_df['block'].values == block
+        return mask
+
+    def get_psth(self, event, window, trials_mask=None, n_bins=60):
+        """spike count per bin summed over a trial subset for all good clusters
+
+        Args:
+            event (str): event column of selected_trials_df
+            window (int): 1/2 window width in ms
+            trials_mask (np ar, optional): bool mask over selected trials, from get_trial_mask. Defaults to all trials.
+            n_bins (int, optional): number of bins. Defaults to 60.
+
+        Returns:
+            np ar: int64 array (i=good cluster, j=bin)
+        """
+        cube = self.gen_psth_cube(event, window, n_bins)
+        if trials_mask is None:
+            return cube.sum(axis=1, dtype=np.int64)
+        return cube[:, trials_mask, :].sum(axis=1, dtype=np.int64)
+
+    # spike count table =================
+    def gen_count_table(self, windows, trials_mask=None):
+        """spike count of all good clusters in several windows of every selected trial, one searchsorted for all windows
+
+        Args:
+            windows (list): (event, start ms, end ms) relative to the event, spikes in [event+start, event+end)
+            trials_mask (np ar, optional): bool mask over selected trials, from get_trial_mask. Defaults to all trials.
+
+        Returns:
+            np ar: int32 array (i=selected trial, j=good cluster, k=window)
+        """
+        trials_df = self.selected_trials_df if trials_mask is None else self.selected_trials_df.loc[trials_mask]
+        event_ar = np.stack([trials_df[event].values.astype(np.int64) for event, _, _ in windows], axis=1)
+        offset_ar = np.array([[start*20, end*20] for _, start, end in windows], dtype=np.int64)
+        # (i=good cluster, j=trial, k=window, l=[start, end])
+        idx = self.get_spike_idx(event_ar[:, :, None] + offset_ar[None, :, :])
+        return (idx[..., 1]-idx[..., 0]).transpose(1, 0, 2).astype(np.int32)
+
+    def get_trial_groups(self, by):
+        """group label of every selected trial
+
+        Args:
+            by (str): 'block', 'probability', 'side' (gamble / save / none), 'reward' (reward / no reward) or any trial column
+
+        Returns:
+            np ar: labels
+        """
+        trials_df = self.selected_trials_df
+        if by == 'side':
+            save = 'left' if self.gamble_side == 'right' else 'right'
+            return np.where(trials_df[self.gamble_side].values.astype(bool), 'gamble',
+                            np.where(trials_df[save].values.astype(bool), 'save', 'none'))
+        if by == 'reward':
+            return np.where(trials_df['reward_given'].values.astype(bool), 'reward', 'no reward')
+        return trials_df[by].values
+
+    def get_count_stats(self, count_ar, by=['block'], windows=None, trials_mask=None):
+        """mean, variance and fano factor of trial spike counts per trial group, matrix products instead of groupby
+
+        Args:
+            count_ar (np ar): from gen_count_table (i=trial, j=good cluster, k=window)
+            by (list, optional): grouping, see get_trial_groups. Defaults to ['block'].
+            windows (list, optional): windows of count_ar for the index. Defaults to window numbers.
+            trials_mask (np ar, optional): mask that was used for count_ar. Defaults to all trials.
+
+        Returns:
+            pd.DataFrame: index (groups..., cluster id, window), columns ['trials', 'mean', 'var', 'fano']
+        """
+        labels = [self.get_trial_groups(group) for group in by]
+        if trials_mask is not None:
+            labels = [label[trials_mask] for label in labels]
+        codes, uniques = zip(*[pd.factorize(label, sort=True) for label in labels])
+        group_code, group_idx = np.unique(np.stack(codes, axis=1), axis=0, return_inverse=True)
+        group_idx = group_idx.ravel()
+
+        # (group, trial) indicator times (trial, cluster x window)
+        n_groups = group_code.shape[0]
+        onehot = np.zeros((n_groups, count_ar.shape[0]))
+        onehot[group_idx, np.arange(count_ar.shape[0])] = 1
+        flat = count_ar.reshape(count_ar.shape[0], -1).astype(np.float64)
+        n = onehot.sum(axis=1)[:, None]
+        mean = onehot @ flat / n
+        var = (onehot @ flat**2 - n*mean**2) / np.maximum(n-1, 1)
+        var = np.where(n > 1, np.maximum(var, 0), np.nan)
+
+        clusters = self.clusters_df.loc[self.clusters_df['group']=='good'].index
+        windows = [f"{event} {start}:{end}" for event, start, end in windows] if windows is not None else np.arange(count_ar.shape[2])
+        n_cells = count_ar.shape[1]*count_ar.shape[2]
+        index = pd.MultiIndex.from_arrays(
+            [np.repeat(np.asarray(unique)[group_code[:, i]], n_cells) for i, unique in enumerate(uniques)]
+            + [np.tile(np.repeat(clusters.values, count_ar.shape[2]), n_groups), np.tile(windows, n_groups*count_ar.shape[1])],
+            names=list(by)+['cluster id', 'window'])
+        return pd.DataFrame({
+            'trials': np.repeat(n[:, 0], n_cells).astype(np.int64),
+            'mean': mean.ravel(),
+            'var': var.ravel(),
+            'fano': np.where(mean > 0, var/np.where(mean > 0, mean, 1), np.nan).ravel(),
+        }, index=index)
+
+    def get_event_spikes(self, neuron_idx, event_ar, window):
+        """spike times of one good cluster around each event
+
+        Args:
+            neuron_idx (int): index of the good cluster
+            event_ar (np ar): event times in sampling points
+            window (int): 1/2 window width in ms
+
+        Returns:
+            list: one array per event with spike times relative to the event
+        """
+        delta = window*20
+        spikes = self.spikes_buffer_ar[self.spikes_offsets_ar[neuron_idx]:self.spikes_offsets_ar[neuron_idx+1]]
+        event_ar = np.asarray(event_ar, dtype=np.int64)
+        first_idx = spikes.searchsorted(event_ar-delta, side='left')
+        last_idx = spikes.searchsorted(event_ar+delta, side='right')
+        return [spikes[a:b]-ev for a, b, ev in zip(first_idx, last_idx, event_ar)]
+
     #  Compute a vector of ISIs for a single neuron given spike times.
     def compute_single_neuron_isis(self, spike_times, neuron_idx):
         """
         Compute a vector of ISIs for a single neuron given spike times.
         Args:
             spike_times (list of 1D arrays): Spike time dataset, with the first
-            dimension corresponding to different neurons.
+            dimension corresponding to different neurons, None -> spikes of good clusters from spike buffer.
             neuron_idx (int): Index of the unit to compute ISIs for.
 
         Returns:
             isis (1D array): Duration of time between each spike from one neuron.
         """
         # Extract the spike times for the specified neuron
-        single_neuron_spikes = self.spike_times.loc[neuron_idx]['spikes']
+        if spike_times is None:
+            single_neuron_spikes = self.spikes_buffer_ar[self.spikes_offsets_ar[neuron_idx]:self.spikes_offsets_ar[neuron_idx+1]]
+        else:
+            single_neuron_spikes = spike_times[neuron_idx]
 
         # Compute the ISIs for this set of spikes
-        # Hint: the function np.diff computes discrete differences along an array
         isis = np.diff(single_neuron_spikes)
 
         return isis
 
+    # isi & autocorrelogram ===============
+    def get_spike_buffer_range(self, start, end):
+        """spike buffer restricted to spikes between start and end
+
+        Args:
+            start (int): sampling points
+            end (int): sampling points
+
+        Returns:
+            tuple: (spikes_buffer_ar, spikes_offsets_ar) in same layout as gen_spike_buffer
+        """
+        idx = self.get_spike_idx(np.array([start, end+1])) + self.spikes_offsets_ar[:-1, None]
+        counts = idx[:, 1]-idx[:, 0]
+        offsets_ar = np.zeros(counts.size+1, dtype=np.int64)
+        offsets_ar[1:] = np.cumsum(counts)
+        # index of all spikes that are kept
+        keep = np.repeat(idx[:, 0]-offsets_ar[:-1], counts) + np.arange(offsets_ar[-1])
+        return self.spikes_buffer_ar[keep], offsets_ar
+
+    def gen_isi_stats(self, bin_size=1, max_isi=100, refractory=2, acg_bin_size=1, max_lag=50, start=None, end=None):
+        """isi histogram, quality metrics and autocorrelogram for all good clusters, cached in isi_stats_dict
+
+        Args:
+            bin_size (float, optional): isi histogram bin width in ms. Defaults to 1.
+            max_isi (float, optional): isi histogram range in ms. Defaults to 100.
+            refractory (float, optional): isi below refractory in ms is a violation. Defaults to 2.
+            acg_bin_size (float, optional): autocorrelogram bin width in ms. Defaults to 1.
+            max_lag (float, optional): autocorrelogram range +/- ms. Defaults to 50.
+            start (int, optional): only spikes after start in sampling points. Defaults to start of first selected trial.
+            end (int, optional): only spikes before end in sampling points. Defaults to end of last selected trial.
+
+        Returns:
+            dict: 'isi_hist_ar' (i=good cluster, j=isi bin), 'isi_edges' in ms,
+                  'acg_ar' (i=good cluster, j=lag bin), 'acg_edges' in ms,
+                  'qc_df' DataFrame with one row per good cluster
+        """
+        if start is None:
+            start = self.selected_trials_df['start'].values[0]
+        if end is None:
+            end = self.selected_trials_df['end'].values[-1]
+        key = (bin_size, max_isi, refractory, acg_bin_size, max_lag, int(start), int(end))
+        if key in self.isi_stats_dict:
+            return self.isi_stats_dict[key]
+
+        spikes_ar, offsets_ar = self.get_spike_buffer_range(start, end)
+        n_clusters = offsets_ar.size-1
+        n_spikes = np.diff(offsets_ar)
+        cluster_ar = np.repeat(np.arange(n_clusters), n_spikes)
+
+        # isis within each cluster, in sampling points
+        isi_ar = np.diff(spikes_ar)
+        valid = cluster_ar[1:] == cluster_ar[:-1]
+        isi_cluster_ar = cluster_ar[1:][valid]
+        isi = isi_ar[valid]
+
+        # histogram (cluster, bin)
+        n_bins = int(round(max_isi/bin_size))
+        bin_idx = isi//int(round(bin_size*20))
+        in_range = bin_idx < n_bins
+        isi_hist_ar = np.bincount(isi_cluster_ar[in_range]*n_bins+bin_idx[in_range], minlength=n_clusters*n_bins).reshape(n_clusters, n_bins)
+
+        # quality metrics
+        n_isi = np.bincount(isi_cluster_ar, minlength=n_clusters)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean_isi = np.bincount(isi_cluster_ar, weights=isi, minlength=n_clusters)/n_isi
+            var_isi = np.bincount(isi_cluster_ar, weights=isi.astype(float)**2, minlength=n_clusters)/n_isi - mean_isi**2
+            violations = np.bincount(isi_cluster_ar, weights=isi < refractory*20, minlength=n_clusters)/n_isi
+            # cv2 of consecutive isis in the same cluster
+            pair = valid[1:] & valid[:-1]
+            isi_1, isi_2 = isi_ar[:-1][pair], isi_ar[1:][pair]
+            cv2_cluster_ar = cluster_ar[1:-1][pair]
+            cv2 = np.where(isi_1+isi_2 > 0, 2*np.abs(isi_2-isi_1)/(isi_1+isi_2), 0)
+            cv2_mean = np.bincount(cv2_cluster_ar, weights=cv2, minlength=n_clusters)/np.bincount(cv2_cluster_ar, minlength=n_clusters)
+            qc_df = pd.DataFrame({
+                'n_spikes': n_spikes,
+                'firing_rate': n_spikes/((end-start)/20000),
+                'mean_isi_ms': mean_isi/20,
+                'cv': np.sqrt(np.maximum(var_isi, 0))/mean_isi,
+                'cv2': cv2_mean,
+                'refractory_violations': violations,
+            }, index=self.clusters_df.loc[self.clusters_df['group']=='good'].index)
+
+        # autocorrelogram
+        acg_bin = int(round(acg_bin_size*20))
+        acg_ar = autocorrelogram_counts(spikes_ar, offsets_ar, int(round(max_lag*20)), acg_bin)
+        half = acg_ar.shape[1]//2
+
+        self.isi_stats_dict[key] = {
+            'isi_hist_ar': isi_hist_ar,
+            'isi_edges': np.arange(n_bins+1)*bin_size,
+            'acg_ar': acg_ar,
+            'acg_edges': np.arange(-half, half+1)*acg_bin/20,
+            'qc_df': qc_df,
+        }
+        return self.isi_stats_dict[key]
+
+    # cross-correlogram =================
+    def get_spike_buffer_trials(self):
+        """spike buffer restricted to spikes inside selected trials (start <= spike <= end)
+
+        Returns:
+            tuple: (spikes_buffer_ar, spikes_offsets_ar) in same layout as gen_spike_buffer
+        """
+        starts = self.selected_trials_df['start'].values.astype(np.int64)
+        ends = self.selected_trials_df['end'].values.astype(np.int64)
+        trial_idx = np.searchsorted(starts, self.spikes_buffer_ar, side='right')-1
+        keep = (trial_idx >= 0) & (self.spikes_buffer_ar <= ends[np.maximum(trial_idx, 0)])
+        n_clusters = self.spikes_offsets_ar.size-1
+        cluster_ar = np.repeat(np.arange(n_clusters), np.diff(self.spikes_offsets_ar))
+        offsets_ar = np.zeros(n_clusters+1, dtype=np.int64)
+        offsets_ar[1:] = np.cumsum(np.bincount(cluster_ar[keep], minlength=n_clusters))
+        return self.spikes_buffer_ar[keep], offsets_ar
+
+    def gen_ccg(self, bin_size=1, max_lag=50, trials_only=False):
+        """cross-correlograms between all pairs of good clusters, cached in ccg_dict
+
+        Args:
+            bin_size (float, optional): bin width in ms. Defaults to 1.
+            max_lag (float, optional): lag range +/- ms. Defaults to 50.
+            trials_only (bool, optional): only use spikes inside selected trials. Defaults to False.
+
+        Returns:
+            dict: 'ccg_ar' (i=pair, j=lag bin), 'pairs_ar' (i=pair, j=[neuron_idx a, neuron_idx b]) with a < b,
+                  'edges' lag bin edges in ms, lag = spike time b - spike time a
+        """
+        key = (bin_size, max_lag, trials_only)
+        if key in self.ccg_dict:
+            return self.ccg_dict[key]
+
+        if trials_only:
+            spikes_ar, offsets_ar = self.get_spike_buffer_trials()
+        else:
+            spikes_ar, offsets_ar = self.spikes_buffer_ar, self.spikes_offsets_ar
+        pairs_ar = np.stack(np.triu_indices(offsets_ar.size-1, k=1), axis=1).astype(np.int64)
+        ccg_bin = int(round(bin_size*20))
+        ccg_ar = crosscorrelogram_counts(spikes_ar, offsets_ar, pairs_ar, int(round(max_lag*20)), ccg_bin)
+        half = ccg_ar.shape[1]//2
+
+        self.ccg_dict[key] = {
+            'ccg_ar': ccg_ar,
+            'pairs_ar': pairs_ar,
+            'edges': np.arange(-half, half+1)*ccg_bin/20,
+        }
+        return self.ccg_dict[key]
+
     # generate spike matrix
+    def gen_trial_spike_idx(self):
+        """index of the first and after the last spike of each good cluster in every good trial (start <= spike <= end)
+
+        Returns:
+            np ar: int64 array (i=good cluster, j=[first, after last], k=good trial), relative to spikes_offsets_ar[i]
+        """
+        starts = self.good_trials_df['start'].values.astype(np.int64)
+        ends = self.good_trials_df['end'].values.astype(np.int64)
+        return self.get_spike_idx(np.stack([starts, ends+1]))
+
     def gen_spike_per_trial_matrix(self):
         """numpy array with all spikes for all good clusters, and all selected trials (good cluster, selected trial)
 
@@ -208,29 +783,37 @@ class SpikesEDA():
                             spike times are aligned to each trial 0=start of trial  
                 all times are in sampling points -> 20.000 spl per 1second 
         """
-        trials_df = self.selected_trials_df
-        spikes_df = self.spikes_df.groupby('cluster')
-
-        all_li = []
-        for group, frame in spikes_df:
-            cluster_label = self.clusters_df.loc[group ,'group']
-            if cluster_label == 'good':
-                current_li = []
-                spike_times = frame['spike_times']
-                
-                for row in trials_df.index:
-                    start = trials_df.loc[row, 'start']
-                    stop = trials_df.loc[row, 'end']
-                    # get all spikes that are in the trial between start and stop + align with start of trial
-                    # = spike times - trial start
-                    current_li.append(self.get_spikes_for_trial(spike_times, start, stop))
-
-                cluster_ar = np.array(current_li, dtype='object')
-                all_li.append(cluster_ar)
-            
-        all_ar = np.array(all_li, dtype='object')
+        # spike index of selected trials from the precomputed index of all good trials
+        idx = self.trial_spike_idx_ar[:, :, self.select_ar]
+        starts = self.selected_trials_df['start'].values.astype(np.int64)
+        n_clusters, _, n_trials = idx.shape
+
+        all_ar = np.empty((n_clusters, n_trials), dtype=object)
+        for i in range(n_clusters):
+            spikes = self.spikes_buffer_ar[self.spikes_offsets_ar[i]:self.spikes_offsets_ar[i+1]]
+            for j in range(n_trials):
+                # spike times - trial start
+                all_ar[i, j] = spikes[idx[i, 0, j]:idx[i, 1, j]] - starts[j]
         return all_ar
 
+    def set_selection(self, deselect_trials):
+        """change selected trials in place without reloading spikes
+
+        spike to trial assignment only depends on the trial boundaries, all arrays of the
+        selected trials are re-indexed from the arrays over all good trials
+
+        Args:
+            deselect_trials (list): list of (a, b) good trial index ranges, b inclusive or 'end'
+        """
+        self.behavior_obj.set_selection(deselect_trials)
+        self.select_ar = self.behavior_obj.select_ar
+        self.selected_trials_df = self.behavior_obj.selected_trials_df
+
+        self.spikes_per_trial_ar = self.gen_spike_per_trial_matrix()
+        self.psth_cube_dict = {key: cube[:, self.select_ar, :] for key, cube in self.psth_cube_all_dict.items()}
+        # isi stats are keyed by the trial range, only ccg of spikes inside trials depends on the selection
+        self.ccg_dict = {key: ccg for key, ccg in self.ccg_dict.items() if not key[2]}
+
     def gen_spike_per_cluster_matrix(self):
         all_ar = self.clusters_df.loc[self.clusters_df['group']=='good','spikes'].values
         return all_ar
@@ -271,9 +854,12 @@ class SpikesEDA():
         return fig, ax
 
     # plot spike times
-    def plt_trial_length(self, trials_df):
+    def plt_trial_length(self, trials_df, mask=None):
+        # mask = bool array over trials_df rows, e.g. select_ar for good_trials_df, None = all rows
+        if mask is None:
+            mask = np.ones(trials_df.shape[0], dtype=bool)
         fig, ax = plt.subplots()
-        ax.plot(trials_df.loc[trials_df.loc[:,'select'],'length'])
+        ax.plot(trials_df.loc[mask,'length'])
 
     # plot all spikes histogram
     def plt_all_cluster_spikes_hist_absolt(self):
@@ -342,6 +928,40 @@ class SpikesEDA():
 
         return fig, ax
 
+    # plot isi histogram and autocorrelogram from isi stats
+    def plt_isi_acg(self, cluster_name, **kwargs):
+        """plot isi histogram and autocorrelogram for good cluster, read from gen_isi_stats
+
+        Args:
+            cluster_name (int): good cluster
+            kwargs: parameters of gen_isi_stats
+
+        Returns:
+            fig, ax
+        """
+        neuron_idx = self.get_neuron_idx_from_cluster_name(cluster_name)
+        stats = self.gen_isi_stats(**kwargs)
+        qc = stats['qc_df'].loc[cluster_name]
+
+        fig, ax = plt.subplots(nrows=1, ncols=2, figsize=(8, 3))
+        edges = stats['isi_edges']
+        ax[0].bar(edges[:-1], stats['isi_hist_ar'][neuron_idx], width=np.diff(edges), align='edge')
+        ax[0].axvline(qc['mean_isi_ms'], color="orange", label="Mean ISI")
+        ax[0].axvspan(0, kwargs.get('refractory', 2), color='r', alpha=0.2, label='refractory')
+        ax[0].set_xlim([edges[0], edges[-1]])
+        ax[0].set_xlabel("ISI duration [ms]")
+        ax[0].set_ylabel("Number of spikes")
+        ax[0].legend()
+
+        edges = stats['acg_edges']
+        ax[1].bar(edges[:-1], stats['acg_ar'][neuron_idx], width=np.diff(edges), align='edge', color='k')
+        ax[1].set_xlim([edges[0], edges[-1]])
+        ax[1].set_xlabel("Lag [ms]")
+        ax[1].set_ylabel("Count")
+        fig.tight_layout()
+
+        return fig, ax
+
     #spike trains========================
     # plot spike trains for all trials
     def plt_spike_train(self, cluster_name):
@@ -354,9 +974,10 @@ class SpikesEDA():
         #plot prob change
         x_min = -100
         x_max= ax.get_xlim()[1]
-        for group, frame in self.selected_trials_df.groupby('probability',sort=False):
-            ax.hlines(frame.index[0], x_min, x_max, colors='r',linestyle='--',linewidths=(1,))
-            ax.text(ax.get_xlim()[1]-14000, frame.index[0]+2, f"{group}%", fontsize=10)
+        starts, _, prob = get_blocks(self.selected_trials_df['probability'].values)
+        for y, po in zip(starts, prob):
+            ax.hlines(y, x_min, x_max, colors='r',linestyle='--',linewidths=(1,))
+            ax.text(ax.get_xlim()[1]-14000, y+2, f"{po}%", fontsize=10)
 
         ax.set_xlabel('Trial Length [20kHz]')
         ax.set_ylabel('Probability density')
@@ -551,8 +1172,6 @@ class SpikesEDA():
 
         # loop that iterats trough all indeces in trial df
         y=0
-        prop = selected_trials_df.iloc[0]['probability']
-        prop_li = []
         # get x upper lim
 
         for row in trials.index:
@@ -574,18 +1193,15 @@ class SpikesEDA():
                 ## plot spike train=========================
                 ax[0].plot([col, col], ypos, 'k-', linewidth=0.8)
 
-            # plot probability
-            current_prop = selected_trials_df.loc[row]['probability']
-            if current_prop != prop:
-                prop = current_prop
-                prop_li.append((prop,y))
 
         #x_lim_min = ax[0].get_xlim()[0]
         #x_lim_max = ax[0].get_xlim()[1] #trials[row] + delta#ax[0].get_xlim()[1]
         #_text = x_lim-2500
         #x_text = delta*2#-2500       
         #ax[0].text(x_text, 0+2, f"{selected_trials_df.iloc[0]['probability']}%", fontsize=10)
-        for po, yp in prop_li:
+        # plot probability change
+        starts, _, prob = get_blocks(selected_trials_df['probability'].values)
+        for po, yp in zip(prob[1:], starts[1:]):
             ax[0].hlines(yp, -delta, delta, colors='r',linestyle='--',linewidths=0.8)
             ax[0].text(delta+400, yp-4, f"{po*100}%", fontsize=10)#, colors='r')
 
@@ -650,6 +1266,62 @@ class SpikesEDA():
             hist_sp = 0
         return fig, ax, hist_sp 
 
+    # plot spike trains and psth from psth cube
+    def plt_psth(self, cluster, event, window, trials_mask=None, n_bins=60, fig=None, ax=[None, None]):
+        """
+        def:    plot the spike train around event (0) for a trial subset stacked on each other for event +/- window
+                and the psth of the subset, read from the psth cube
+        params: cluster= integer::good cluster to plot spikes for
+                event= string::event column of selected_trials_df
+                window = integer::half window width in milli seconds
+                trials_mask = bool np ar::trial subset from get_trial_mask, None => all selected trials
+                n_bins = integer::number of bins of the psth
+                fig = pyplot figure, if None => will create one
+                ax = list of two pyplot axis, if None => will create one
+        return: fig, ax
+        """
+        neuron_idx = self.get_neuron_idx_from_cluster_name(cluster)
+        if trials_mask is None:
+            trials_mask = np.ones(self.selected_trials_df.shape[0], dtype=bool)
+        trials = self.selected_trials_df.loc[trials_mask]
+        delta = window*20
+
+        # create plot and axis if none is passed
+        if any(i is None for i in ax) or fig is None:
+            fig, ax = plt.subplots(nrows=2, ncols=1, sharex=True, gridspec_kw={'hspace': 0})
+
+        ## plot spike train===========================
+        if trials.shape[0] > 0:
+            ax[0].eventplot(self.get_event_spikes(neuron_idx, trials[event].values, window), color='k', linewidths=0.8, lineoffsets=np.arange(trials.shape[0])+0.5)
+        # plot probability change
+        starts, _, prob = get_blocks(trials['probability'].values)
+        for y, po in zip(starts[1:], prob[1:]):
+            ax[0].hlines(y, -delta, delta, colors='r', linestyle='--', linewidths=0.8)
+            ax[0].text(delta+400, y, f"{po*100}%", fontsize=10, va='center')
+        ## traw red line at event
+        ax[0].axvline(x=0,ymin=0,ymax=1,c="red",linewidth=0.5)
+        ax[0].set_ylabel('Trial')
+        ax[0].set_ylim([0, max(trials.shape[0], 1)])
+        ax[0].tick_params(axis="x",direction="in")
+        plt.setp(ax[0].get_xticklabels(), visible=False)
+        ax[0].set_title(event, color='red', fontsize=8)
+
+        ## plot histogram from cube===========================
+        edges = self.get_psth_edges(window, n_bins)
+        psth = self.gen_psth_cube(event, window, n_bins)[neuron_idx, trials_mask, :].sum(axis=0)
+        ax[1].bar(edges[:-1], psth, width=np.diff(edges), align='edge')
+        ax[1].axvline(x=0,ymin=0,ymax=1,c="red",linewidth=0.5)
+        ax[1].set_ylabel('Spike Count')
+        # x ticks in seconds
+        x_ticks = np.linspace(-delta, delta, 9)
+        ax[1].set_xticks(x_ticks)
+        ax[1].set_xticklabels(np.round(x_ticks/20000, 2))
+        ax[1].tick_params(axis='x', bottom=True, top=True)
+        ax[1].set_xlim([-delta, delta])
+        ax[1].set_xlabel('Window [s]')
+
+        return fig, ax
+
     def _test_plt_spike_train_hist(self, cluster, selected_trials, event, window, fig=None, ax=[None, None], title=None):
         """
         def:    plot the spike train around event (0) for all trials stacked on each other for event +/- delta
@@ -762,8 +1434,6 @@ class SpikesEDA():
 
         # loop that iterats trough all indeces in trial df
         y=0
-        prop = selected_trials_df.iloc[0]['probability']
-        prop_li = []
         # get x upper lim
 
         for row in trials.index:
@@ -792,11 +1462,6 @@ class SpikesEDA():
                 if ev != 0:
                     ax[0].plot([ev, ev], ypos, c="red",linewidth=0.5)
 
-            # plot probability
-            current_prop = selected_trials_df.loc[row]['probability']
-            if current_prop != prop:
-                prop = current_prop
-                prop_li.append((prop,y))
 
         
         # write all other events
@@ -805,10 +1470,11 @@ class SpikesEDA():
                 ax[0].text(ev_time-5, y+10, ev_name, c='red', fontsize=5, rotation='vertical',)
         
         # plot prop
-        for po, yp in prop_li:
+        # plot probability change
+        starts, _, prob = get_blocks(selected_trials_df['probability'].values)
+        for po, yp in zip(prob[1:], starts[1:]):
             ax[0].hlines(yp, -delta, delta, colors='r',linestyle='--',linewidths=0.8)
             ax[0].text(delta+400, yp-4, f"{po*100}%", fontsize=10)#, colors='r')
-        print(prop_li)
 
         ## traw red line at event ==============
         ax[0].axvline(x=0,ymin=0,ymax=1,c="red",linewidth=0.5)
@@ -895,9 +1561,11 @@ class SpikesEDA():
             ax1, ax2, ax3 = ax
         # loop that iterats trough all indeces in trial df
         y = 0
-        # loop for hist trial plot
-        hist_tr = pd.DataFrame(columns=['spike count'])
-        hist_tr.index.name = 'trial'
+        # spike count per trial for hist trial plot, inclusive window like the spike train
+        spikes_ar = np.sort(cluster_df.values.astype(np.int64))
+        event_ar = trials.values.astype(np.int64)
+        counts = np.searchsorted(spikes_ar, event_ar+delta, side='right') - np.searchsorted(spikes_ar, event_ar-delta, side='left')
+        hist_tr = pd.DataFrame({'spike count': counts}, index=pd.Index(trials.index, name='trial'))
 
         ##spike train plot ========================
         # main loop over each trial
@@ -909,10 +1577,6 @@ class SpikesEDA():
             ar = cluster_df[( ( cluster_df >= (trials[row] - delta) ) & ( cluster_df <= (trials[row] + delta) ) )].values
             ar = ar.astype('int64')
             ar = ar - trials[row]
-            # create hist trial dataframe
-            series = pd.Series([ar.size], index=['spike count'])
-            series.name = row
-            hist_tr = hist_tr.append(series)
             # add to histogram array
             if ar.size > 0:
                 #append to historam data frame
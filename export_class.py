@@ -0,0 +1,241 @@
+import numpy as np
+import pandas as pd
+import datetime
+import glob
+import json
+import os
+import shutil
+
+
+# tables ##################################################################################################################
+def write_table(folder, df):
+    """write data frame as one .npy file per column + schema.json
+
+    object / string columns are stored as categorical codes, the categories are kept in the schema
+
+    Args:
+        folder (str): table folder
+        df (pd.DataFrame): table, index is written as column if it has a name
+    """
+    os.makedirs(folder, exist_ok=True)
+    if df.index.name is not None:
+        df = df.reset_index()
+    schema = dict(rows=int(df.shape[0]), columns=dict())
+    for column in df.columns:
+        values = df[column]
+        info = dict()
+        if values.dtype == object or isinstance(values.dtype, pd.CategoricalDtype):
+            values = values.astype('category')
+            info['categories'] = [str(category) for category in values.cat.categories]
+            values = values.cat.codes
+        ar = values.values
+        np.save(os.path.join(folder, str(column)+'.npy'), ar)
+        info['dtype'] = str(ar.dtype)
+        schema['columns'][str(column)] = info
+    with open(os.path.join(folder, 'schema.json'), 'w') as f:
+        json.dump(schema, f, indent=1)
+
+
+def read_table(folder, columns=None, mmap=True):
+    """read table of write_table, only the requested column files are opened
+
+    Args:
+        folder (str): table folder
+        columns (list, optional): columns to load. Defaults to all.
+        mmap (bool, optional): memory map numeric columns. Defaults to True.
+
+    Returns:
+        pd.DataFrame: table
+    """
+    with open(os.path.join(folder, 'schema.json')) as f:
+        schema = json.load(f)
+    if columns is None:
+        columns = list(schema['columns'].keys())
+    data = dict()
+    for column in columns:
+        info = schema['columns'][column]
+        ar = np.load(os.path.join(folder, column+'.npy'), mmap_mode='r' if mmap else None)
+        if 'categories' in info:
+            ar = pd.Categorical.from_codes(np.asarray(ar), categories=info['categories'])
+        data[column] = ar
+    return pd.DataFrame(data, index=pd.RangeIndex(schema['rows']))
+
+
+# class ###################################################################################################################
+class SpikesExport():
+    """[# write trial table, clusters, spike buffer and psth cubes of a processed session to a columnar dataset]
+
+    dataset layout, one partition per session:
+        <dataset>/session=<session>/meta.json
+        <dataset>/session=<session>/trials/<column>.npy     all trials, incl. good / selected flags
+        <dataset>/session=<session>/clusters/<column>.npy   all clusters, neuron_idx = position in spike buffer or -1
+        <dataset>/session=<session>/qc/<column>.npy         isi quality metrics of good clusters
+        <dataset>/session=<session>/spikes/buffer.npy, offsets.npy
+        <dataset>/session=<session>/psth/<event>_<window>_<n_bins>.npy  (i=good cluster, j=good trial, k=bin)
+        <dataset>/session=<session>/arrays/<name>.npy      any other arrays, e.g. sda cubes
+    """
+    def __init__(self, spikes_obj):
+        self.session = spikes_obj.session
+        self.folder = spikes_obj.folder
+        self.gamble_side = spikes_obj.gamble_side
+
+        self.all_trials_df = spikes_obj.all_trials_df
+        self.good_trials_df = spikes_obj.good_trials_df
+        self.clusters_df = spikes_obj.clusters_df
+        self.spikes_obj = spikes_obj
+
+    def get_trials_table(self):
+        """all trials with 'selected' flag of the current selection"""
+        trials_df = self.all_trials_df.copy()
+        selected = np.zeros(trials_df.shape[0], dtype=bool)
+        good = trials_df['good'].values.astype(bool)
+        selected[good] = self.spikes_obj.select_ar
+        trials_df['selected'] = selected
+        return trials_df
+
+    def get_clusters_table(self):
+        """cluster metadata without spike times, neuron_idx is the position in the spike buffer"""
+        clusters_df = self.clusters_df.drop('spikes', axis=1)
+        good = (clusters_df['group'] == 'good').values
+        neuron_idx = np.full(clusters_df.shape[0], -1, dtype=np.int64)
+        neuron_idx[good] = np.arange(good.sum())
+        clusters_df['neuron_idx'] = neuron_idx
+        clusters_df['n_spikes_buffer'] = np.zeros(clusters_df.shape[0], dtype=np.int64)
+        clusters_df.loc[good, 'n_spikes_buffer'] = np.diff(self.spikes_obj.spikes_offsets_ar)
+        return clusters_df
+
+    def export(self, dataset, windows=[2000], n_bins=60, events=['start', 'cue', 'sound', 'openloop', 'reward', 'iti', 'end'], arrays=dict()):
+        """write session partition, an existing partition of the session is replaced
+
+        Args:
+            dataset (str): dataset folder
+            windows (list, optional): 1/2 window widths in ms of the psth cubes. Defaults to [2000].
+            n_bins (int, optional): number of psth bins. Defaults to 60.
+            events (list, optional): psth events. Defaults to all trial events.
+            arrays (dict, optional): {name: np ar} additional arrays. Defaults to dict().
+
+        Returns:
+            str: session partition folder
+        """
+        partition = os.path.join(dataset, 'session='+str(self.session))
+        tmp = partition+'.tmp'
+        if os.path.isdir(tmp):
+            shutil.rmtree(tmp)
+
+        write_table(os.path.join(tmp, 'trials'), self.get_trials_table())
+        write_table(os.path.join(tmp, 'clusters'), self.get_clusters_table())
+        write_table(os.path.join(tmp, 'qc'), self.spikes_obj.gen_isi_stats()['qc_df'])
+
+        os.makedirs(os.path.join(tmp, 'spikes'))
+        np.save(os.path.join(tmp, 'spikes', 'buffer.npy'), self.spikes_obj.spikes_buffer_ar)
+        np.save(os.path.join(tmp, 'spikes', 'offsets.npy'), self.spikes_obj.spikes_offsets_ar)
+
+        # psth cubes over all good trials, cached ones included
+        os.makedirs(os.path.join(tmp, 'psth'))
+        for window in windows:
+            self.spikes_obj.gen_psth_cubes(window, n_bins, events)
+        for (event, window, bins), cube in self.spikes_obj.psth_cube_all_dict.items():
+            np.save(os.path.join(tmp, 'psth', f"{event}_{window}_{bins}.npy"), cube)
+
+        os.makedirs(os.path.join(tmp, 'arrays'))
+        for name, ar in arrays.items():
+            np.save(os.path.join(tmp, 'arrays', name+'.npy'), ar)
+
+        meta = dict(session=str(self.session), folder=str(self.folder), gamble_side=self.gamble_side,
+                    exported=datetime.datetime.now().isoformat(timespec='seconds'))
+        with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+            json.dump(meta, f, indent=1)
+
+        if os.path.isdir(partition):
+            shutil.rmtree(partition)
+        os.replace(tmp, partition)
+        return partition
+
+
+# class ###################################################################################################################
+class SessionDataset():
+    """[# read columnar dataset written by SpikesExport, only requested sessions and columns are loaded]
+    """
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def get_partition(self, session):
+        return os.path.join(self.dataset, 'session='+str(session))
+
+    def sessions(self):
+        """sessions in the dataset"""
+        folders = sorted(glob.glob(os.path.join(self.dataset, 'session=*')))
+        return [os.path.basename(folder)[len('session='):] for folder in folders if not folder.endswith('.tmp')]
+
+    def load_meta(self, session):
+        with open(os.path.join(self.get_partition(session), 'meta.json')) as f:
+            return json.load(f)
+
+    def load_table(self, table, columns=None, sessions=None):
+        """table of several sessions with 'session' column
+
+        Args:
+            table (str): 'trials' or 'clusters'
+            columns (list, optional): columns to load. Defaults to all.
+            sessions (list, optional): sessions to load. Defaults to all.
+
+        Returns:
+            pd.DataFrame: concatenated table
+        """
+        if sessions is None:
+            sessions = self.sessions()
+        frames = []
+        for session in sessions:
+            df = read_table(os.path.join(self.get_partition(session), table), columns)
+            df.insert(0, 'session', session)
+            frames.append(df)
+        table_df = pd.concat(frames, ignore_index=True)
+        table_df['session'] = table_df['session'].astype('category')
+        return table_df
+
+    def load_spikes(self, session, clusters=None):
+        """spike times of good clusters, memory mapped
+
+        Args:
+            session (str): session
+            clusters (list, optional): cluster ids. Defaults to all good clusters.
+
+        Returns:
+            dict: cluster id -> spike times in sampling points
+        """
+        partition = self.get_partition(session)
+        clusters_df = read_table(os.path.join(partition, 'clusters'), ['cluster id', 'neuron_idx']).set_index('cluster id')
+        if clusters is None:
+            clusters = clusters_df.index[clusters_df['neuron_idx'] >= 0]
+        buffer_ar = np.load(os.path.join(partition, 'spikes', 'buffer.npy'), mmap_mode='r')
+        offsets_ar = np.load(os.path.join(partition, 'spikes', 'offsets.npy'))
+        spikes = dict()
+        for cluster in clusters:
+            idx = clusters_df.loc[cluster, 'neuron_idx']
+            if idx < 0:
+                raise ValueError(f"cluster {cluster} of session {session} is not a good cluster")
+            spikes[cluster] = buffer_ar[offsets_ar[idx]:offsets_ar[idx+1]]
+        return spikes
+
+    def load_psth(self, session, event, window, n_bins=60, clusters=None):
+        """psth cube (i=cluster, j=good trial, k=bin), memory mapped
+
+        Args:
+            session (str): session
+            event (str): trial event
+            window (int): 1/2 window width in ms
+            n_bins (int, optional): number of bins. Defaults to 60.
+            clusters (list, optional): cluster ids. Defaults to all good clusters.
+
+        Returns:
+            np ar: psth cube
+        """
+        partition = self.get_partition(session)
+        cube = np.load(os.path.join(partition, 'psth', f"{event}_{window}_{n_bins}.npy"), mmap_mode='r')
+        if clusters is None:
+            return cube
+        clusters_df = read_table(os.path.join(partition, 'clusters'), ['cluster id', 'neuron_idx']).set_index('cluster id')
+        return cube[clusters_df.loc[list(clusters), 'neuron_idx'].values]
+
+    def load_array(self, session, name):
+        return np.load(os.path.join(self.get_partition(session), 'arrays', name+'.npy'), mmap_mode='r')
@@ -0,0 +1,280 @@
+import numpy as np
+import pandas as pd
+import matplotlib.pyplot as plt
+import scipy.sparse as sp
+from scipy.optimize import minimize
+
+
+# event kernels: name -> (event column of selected_trials_df, trials 'reward' / 'no reward' / None, pre ms, post ms)
+EVENT_KERNELS = {
+    'start': ('start', None, 0, 1000),
+    'cue': ('cue', None, -200, 1000),
+    'sound': ('sound', None, -200, 1000),
+    'openloop': ('openloop', None, -500, 1000),
+    'reward': ('reward', 'reward', -500, 1500),
+    'no reward': ('reward', 'no reward', -500, 1500),
+    'iti': ('iti', None, 0, 1000),
+}
+
+
+def raised_cosine_basis(n_basis, n_lags):
+    """linearly spaced raised cosine bumps that sum to 1 over the inner lags
+
+    Args:
+        n_basis (int): number of basis functions
+        n_lags (int): kernel length in bins
+
+    Returns:
+        np ar: (i=lag, j=basis function)
+    """
+    lags = np.arange(n_lags)
+    centers = np.linspace(0, n_lags-1, n_basis)
+    spacing = centers[1]-centers[0] if n_basis > 1 else n_lags
+    x = np.clip((lags[:, None]-centers[None, :])*np.pi/(2*spacing), -np.pi, np.pi)
+    # every lag is covered by 4 bumps
+    return 0.25*(1+np.cos(x))
+
+
+def poisson_deviance(y, mu):
+    """poisson deviance summed over the first axis"""
+    ratio = np.where(y > 0, y/np.maximum(mu, 1e-12), 1.0)
+    return 2*(y*np.log(ratio) - (y-mu)).sum(axis=0)
+
+
+# class ###################################################################################################################
+class SpikesGLM():
+    """[# poisson glm encoding model of all good clusters with raised cosine event kernels and trial variables]
+
+    the design matrix is sparse, built from the selected trials and shared by all clusters, all clusters are
+    fitted together with one L-BFGS problem (the objective is separable, X @ B is one sparse product), fit rebuilds
+    the design after set_selection of spikes_obj:
+
+        glm_obj = SpikesGLM(spikes_obj, bin_size=20)
+        deviance_df = glm_obj.fit(l2=1.0, holdout=0.2)
+        kernels = glm_obj.get_kernels()
+    """
+    def __init__(self, spikes_obj, bin_size=20, n_basis=8, events=EVENT_KERNELS, trial_variables=['probability', 'side']):
+        """[summary]
+
+        Args:
+            spikes_obj (SpikesEDA): spikes object
+            bin_size (int, optional): bin width in ms. Defaults to 20.
+            n_basis (int, optional): raised cosine functions per event kernel. Defaults to 8.
+            events (dict, optional): event kernels, see EVENT_KERNELS. Defaults to EVENT_KERNELS.
+            trial_variables (list, optional): per trial regressors, 'side' (gamble 1, save -1) or numeric trial columns.
+                Defaults to ['probability', 'side'].
+        """
+        self.session = spikes_obj.session
+        self.folder = spikes_obj.folder
+        self.gamble_side = spikes_obj.gamble_side
+
+        self.clusters_df = spikes_obj.clusters_df
+        self.spikes_obj = spikes_obj
+
+        self.bin_size = bin_size
+        self.n_basis = n_basis
+        self.events = events
+        self.trial_variables = trial_variables
+
+        self.coef_ar = None
+        self.set_selection()
+
+    # design =================================================================================================================
+    def set_selection(self):
+        """rebuild bins, design matrix and counts for the current selection of spikes_obj
+
+        the regressors do not depend on the selection, coef_ar is kept as warm start
+        """
+        self.select_ar = self.spikes_obj.select_ar.copy()
+        self.selected_trials_df = self.spikes_obj.selected_trials_df
+        self.gen_bins()
+        self.gen_design_matrix()
+        self.count_ar = self.gen_counts()
+
+    def gen_bins(self):
+        """time bins of all selected trials, sets n_trial_bins, trial_offsets and trial_of_bin"""
+        bs = self.bin_size*20
+        starts = self.selected_trials_df['start'].values.astype(np.int64)
+        ends = self.selected_trials_df['end'].values.astype(np.int64)
+        self.n_trial_bins = np.maximum((ends-starts)//bs, 0)
+        self.trial_offsets = np.concatenate([[0], np.cumsum(self.n_trial_bins)])
+        self.trial_of_bin = np.repeat(np.arange(starts.size), self.n_trial_bins)
+
+    def gen_counts(self):
+        """spike counts of all good clusters in all bins
+
+        Returns:
+            np ar: float32 (i=bin, j=good cluster)
+        """
+        bs = self.bin_size*20
+        starts = self.selected_trials_df['start'].values.astype(np.int64)
+        # edges of all trials in one array, diffs across trial borders are dropped
+        n_edges = self.n_trial_bins+1
+        edge_offsets = np.concatenate([[0], np.cumsum(n_edges)])
+        local = np.arange(edge_offsets[-1]) - np.repeat(edge_offsets[:-1], n_edges)
+        edges = np.repeat(starts, n_edges) + local*bs
+        counts = np.diff(self.spikes_obj.get_spike_idx(edges), axis=1)
+        keep = np.ones(counts.shape[1], dtype=bool)
+        keep[edge_offsets[1:-1]-1] = False
+        return counts[:, keep].T.astype(np.float32)
+
+    def get_event_trials(self, trials):
+        trials_df = self.selected_trials_df
+        if trials == 'reward':
+            return trials_df['reward_given'].values.astype(bool)
+        if trials == 'no reward':
+            return ~trials_df['reward_given'].values.astype(bool)
+        return np.ones(trials_df.shape[0], dtype=bool)
+
+    def gen_design_matrix(self):
+        """sparse design matrix (i=bin, j=regressor), sets X, columns_df and basis_dict
+
+        columns: intercept, n_basis raised cosines per event kernel, one column per trial variable
+        """
+        bs = self.bin_size*20
+        starts = self.selected_trials_df['start'].values.astype(np.int64)
+        n_bins = self.trial_offsets[-1]
+        rows, cols, data = [np.arange(n_bins)], [np.zeros(n_bins, dtype=np.int64)], [np.ones(n_bins)]
+        columns = [('intercept', 0)]
+        self.basis_dict = dict()
+
+        for name, (column, trials, pre, post) in self.events.items():
+            n_lags = max(int(round((post-pre)/self.bin_size)), 1)
+            basis = raised_cosine_basis(self.n_basis, n_lags)
+            self.basis_dict[name] = basis
+            trial_idx = np.flatnonzero(self.get_event_trials(trials))
+            event_bin = (self.selected_trials_df[column].values.astype(np.int64)[trial_idx]-starts[trial_idx])//bs
+            # (event, lag) bins of the kernel, only inside the trial of the event
+            lag_bin = event_bin[:, None] + int(round(pre/self.bin_size)) + np.arange(n_lags)[None, :]
+            valid = (lag_bin >= 0) & (lag_bin < self.n_trial_bins[trial_idx][:, None])
+            event_idx, lag_idx = np.nonzero(valid)
+            row = self.trial_offsets[trial_idx][event_idx] + lag_bin[event_idx, lag_idx]
+            col0 = len(columns)
+            rows.append(np.repeat(row, self.n_basis))
+            cols.append(np.tile(col0+np.arange(self.n_basis), row.size))
+            data.append(basis[lag_idx].ravel())
+            columns += [(name, k) for k in range(self.n_basis)]
+
+        for variable in self.trial_variables:
+            if variable == 'side':
+                save = 'left' if self.gamble_side == 'right' else 'right'
+                values = self.selected_trials_df[self.gamble_side].values.astype(float) - self.selected_trials_df[save].values.astype(float)
+            else:
+                values = self.selected_trials_df[variable].values.astype(float)
+                values = (values-values.mean())/(values.std() if values.std() > 0 else 1)
+            rows.append(np.arange(n_bins))
+            cols.append(np.full(n_bins, len(columns)))
+            data.append(values[self.trial_of_bin])
+            columns.append((variable, 0))
+
+        self.X = sp.csr_matrix((np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))), shape=(n_bins, len(columns)))
+        self.columns_df = pd.DataFrame(columns, columns=['regressor', 'basis'])
+
+    # fit ====================================================================================================================
+    def get_loss(self, X, Y, l2, penalty):
+        """negative log likelihood + ridge penalty and gradient over all clusters, for scipy.optimize"""
+        n = X.shape[0]
+
+        def loss(b):
+            B = b.reshape(X.shape[1], Y.shape[1])
+            eta = np.minimum(X @ B, 20)
+            mu = np.exp(eta)
+            value = ((mu - Y*eta).sum() + 0.5*l2*(penalty[:, None]*B**2).sum())/n
+            grad = (X.T @ (mu-Y) + l2*penalty[:, None]*B)/n
+            return value, grad.ravel()
+        return loss
+
+    def fit(self, l2=1.0, holdout=0.0, warm_start=True, max_iter=1000, tol=1e-7, seed=0):
+        """fit all good clusters at once
+
+        Args:
+            l2 (float, optional): ridge penalty of all regressors but the intercept. Defaults to 1.0.
+            holdout (float, optional): fraction of trials only used for the test deviance. Defaults to 0.0.
+            warm_start (bool, optional): start from the last fit, e.g. along a l2 path. Defaults to True.
+            max_iter (int, optional): max L-BFGS iterations. Defaults to 1000.
+            tol (float, optional): L-BFGS tolerance. Defaults to 1e-7.
+            seed (int, optional): random seed of the holdout trials. Defaults to 0.
+
+        Returns:
+            pd.DataFrame: one row per good cluster, columns ['n_spikes', 'deviance_explained'] (+ ['test_deviance_explained'])
+        """
+        # selection of spikes_obj changed since the design was built
+        if not np.array_equal(self.select_ar, self.spikes_obj.select_ar):
+            self.set_selection()
+        n_trials = self.selected_trials_df.shape[0]
+        test_trials = np.zeros(n_trials, dtype=bool)
+        if holdout > 0:
+            test_trials[np.random.default_rng(seed).permutation(n_trials)[:int(round(holdout*n_trials))]] = True
+        test = test_trials[self.trial_of_bin]
+        X_train, Y_train = self.X[~test], self.count_ar[~test].astype(np.float64)
+
+        n_regressors, n_clusters = self.X.shape[1], self.count_ar.shape[1]
+        if warm_start and self.coef_ar is not None:
+            B0 = self.coef_ar
+        else:
+            B0 = np.zeros((n_regressors, n_clusters))
+            B0[0] = np.log(Y_train.mean(axis=0)+1e-6)
+        penalty = np.ones(n_regressors)
+        penalty[0] = 0
+
+        result = minimize(self.get_loss(X_train, Y_train, l2, penalty), B0.ravel(), jac=True, method='L-BFGS-B',
+                          options=dict(maxiter=max_iter, ftol=tol, gtol=tol))
+        self.coef_ar = result.x.reshape(n_regressors, n_clusters)
+        self.fit_result = result
+
+        mean = Y_train.mean(axis=0)
+        mu = np.exp(np.minimum(X_train @ self.coef_ar, 20))
+        deviance_df = pd.DataFrame({
+            'n_spikes': Y_train.sum(axis=0).astype(np.int64),
+            'deviance_explained': 1 - poisson_deviance(Y_train, mu)/poisson_deviance(Y_train, np.broadcast_to(mean, Y_train.shape)),
+        }, index=self.clusters_df.loc[self.clusters_df['group']=='good'].index)
+        if holdout > 0:
+            Y_test = self.count_ar[test].astype(np.float64)
+            mu = np.exp(np.minimum(self.X[test] @ self.coef_ar, 20))
+            deviance_df['test_deviance_explained'] = 1 - poisson_deviance(Y_test, mu)/poisson_deviance(Y_test, np.broadcast_to(mean, Y_test.shape))
+        self.deviance_df = deviance_df
+        return deviance_df
+
+    def get_kernels(self):
+        """event kernels of the last fit as log gain
+
+        Returns:
+            dict: event -> pd.DataFrame (index=time relative to event in ms, columns=good cluster ids)
+        """
+        kernels = dict()
+        clusters = self.clusters_df.loc[self.clusters_df['group']=='good'].index
+        for name, (column, trials, pre, post) in self.events.items():
+            idx = self.columns_df.index[self.columns_df['regressor'] == name]
+            basis = self.basis_dict[name]
+            time = pre + np.arange(basis.shape[0])*self.bin_size
+            kernels[name] = pd.DataFrame(basis @ self.coef_ar[idx], index=pd.Index(time, name='time'), columns=clusters)
+        return kernels
+
+    def get_trial_coefficients(self):
+        """coefficients of the trial variables (i=good cluster, j=variable)"""
+        idx = self.columns_df.index[self.columns_df['regressor'].isin(self.trial_variables)]
+        return pd.DataFrame(self.coef_ar[idx].T, index=self.clusters_df.loc[self.clusters_df['group']=='good'].index,
+                            columns=self.columns_df.loc[idx, 'regressor'].values)
+
+    # plotting ===============================================================================================================
+    def plt_kernels(self, cluster, events=None):
+        """event kernels of one cluster as gain
+
+        Args:
+            cluster (int): cluster id
+            events (list, optional): kernels to plot. Defaults to all.
+
+        Returns:
+            fig, ax:
+        """
+        kernels = self.get_kernels()
+        events = list(kernels.keys()) if events is None else events
+        fig, ax = plt.subplots(nrows=1, ncols=len(events), figsize=(2*len(events), 2), sharey=True, squeeze=False)
+        for a, name in zip(ax[0], events):
+            a.plot(kernels[name].index, np.exp(kernels[name][cluster].values), color='k')
+            a.axvline(0, color='grey', linewidth=0.5)
+            a.axhline(1, color='grey', linewidth=0.5, linestyle='--')
+            a.set_title(name, fontsize=8)
+            a.set_xlabel('time [ms]')
+        ax[0, 0].set_ylabel('gain')
+        return fig, ax
@@ -0,0 +1,247 @@
+import numpy as np
+import multiprocessing as mp
+from multiprocessing import shared_memory
+
+from eda_class import search_spike_buffer
+from sda_class import surrogate_test, tile_spike_buffer, jitter_spike_buffer, shuffle_isi_buffer
+
+
+# trial table columns placed in shared memory, sampling points
+TRIAL_COLUMNS = ['start', 'cue', 'sound', 'openloop', 'reward', 'iti', 'end']
+
+
+# shared memory ###########################################################################################################
+def create_shared(ar):
+    """copy array into a new shared memory block
+
+    Returns:
+        tuple: (SharedMemory, spec) spec = (name, shape, dtype) to attach in other processes
+    """
+    ar = np.ascontiguousarray(ar)
+    shm = shared_memory.SharedMemory(create=True, size=max(1, ar.nbytes))
+    np.ndarray(ar.shape, dtype=ar.dtype, buffer=shm.buf)[...] = ar
+    return shm, (shm.name, ar.shape, ar.dtype.str)
+
+
+def attach_shared(spec):
+    """attach to a shared memory block of create_shared
+
+    Returns:
+        tuple: (SharedMemory, np ar view), the view is only valid as long as the SharedMemory is referenced
+    """
+    name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+
+
+# worker ##################################################################################################################
+# shared arrays attached in the worker process, name -> (SharedMemory, np ar)
+worker_dict = dict()
+
+
+def init_worker(specs):
+    """pool initializer, attaches the arrays that live as long as the pool"""
+    worker_dict.clear()
+    for key, spec in specs.items():
+        worker_dict[key] = attach_shared(spec)
+
+
+def get_worker_array(key, spec=None):
+    """shared array of the worker, arrays of a single call are attached on first use"""
+    if key not in worker_dict or (spec is not None and worker_dict[key][0].name != spec[0]):
+        worker_dict[key] = attach_shared(spec)
+    return worker_dict[key][1]
+
+
+def count_task(task):
+    """surrogate counts of a cluster range and an iteration chunk, written into the shared output cube
+
+    Args:
+        task (tuple): (c0, c1, k0, k1, call dict), clusters [c0, c1), iterations [k0, k1)
+    """
+    c0, c1, k0, k1, call = task
+    out_ar = get_worker_array('out', call['out'])
+    edges = call['edges']
+
+    if call['null'] == 'window':
+        spikes_ar, offsets_ar = get_worker_array('spikes'), get_worker_array('offsets')
+        centers = get_worker_array('centers', call['centers'])
+        times = centers[:, k0:k1, None] + edges[None, None, :]
+    else:
+        spikes_ar, offsets_ar = get_worker_array('range_spikes', call['range_spikes']), get_worker_array('range_offsets', call['range_offsets'])
+        trials_ar = get_worker_array('trials')
+        times = trials_ar[call['trials_mask'], call['event_idx'], None] + edges[None, :]
+
+    # clusters of the range are contiguous in the buffer, no copy
+    cluster_offsets = offsets_ar[c0:c1+1]-offsets_ar[c0]
+    cluster_spikes = spikes_ar[offsets_ar[c0]:offsets_ar[c1]]
+    n_clusters, n_bins = c1-c0, edges.size-1
+
+    if call['null'] == 'window':
+        counts = np.diff(search_spike_buffer(cluster_spikes, cluster_offsets, times, call['span']), axis=3).sum(axis=1)
+        out_ar[c0:c1, :, k0:k1] = counts.transpose(0, 2, 1)
+        return
+
+    # random stream of the task only depends on seed and task position, not on the worker
+    rng = np.random.default_rng([call['seed'], c0, k0])
+    n = k1-k0
+    tiled_ar, tiled_offsets = tile_spike_buffer(cluster_spikes, cluster_offsets, n)
+    if call['null'] == 'jitter':
+        tiled_ar = jitter_spike_buffer(tiled_ar, tiled_offsets, call['shift'], rng)
+    else:
+        bounds_ar = trials_ar[:, [TRIAL_COLUMNS.index('start'), TRIAL_COLUMNS.index('end')]]
+        tiled_ar = shuffle_isi_buffer(tiled_ar, tiled_offsets, bounds_ar, rng)
+    counts = np.diff(search_spike_buffer(tiled_ar, tiled_offsets, times, call['span']), axis=2).sum(axis=1)
+    out_ar[c0:c1, :, k0:k1] = counts.reshape(n, n_clusters, n_bins).transpose(1, 2, 0)
+
+
+# class ###################################################################################################################
+class ParallelSDA():
+    """[# surrogate tests of SpikesSDA on a process pool, spike buffer and trial table are shared memory]
+
+    spike buffer, offsets and trial table of the selected trials are copied into shared memory once, tasks
+    are (cluster range, iteration chunk) tuples and every worker writes its counts into a shared output cube:
+
+        with ParallelSDA(sda_obj, processes=32) as parallel:
+            result = parallel.test_event('reward', 200, iterations=10000)
+    """
+    def __init__(self, sda_obj, processes=None, start_method=None):
+        """[summary]
+
+        Args:
+            sda_obj (SpikesSDA): sda object, current selection of its SpikesEDA object is used
+            processes (int, optional): number of worker processes. Defaults to os.cpu_count().
+            start_method (str, optional): multiprocessing start method. Defaults to 'forkserver' or 'spawn',
+                a forked child of a process that ran numba parallel functions can hang the parent at exit.
+        """
+        self.sda_obj = sda_obj
+        self.spikes_obj = sda_obj.spikes_obj
+        # trial table in shared memory is the selection at construction
+        self.select_ar = self.spikes_obj.select_ar.copy()
+        self.selected_trials_df = self.spikes_obj.selected_trials_df
+        self.processes = processes or mp.cpu_count()
+        self.test_dict = dict()
+
+        self.shared_dict = dict()
+        specs = dict()
+        trials_ar = self.selected_trials_df[TRIAL_COLUMNS].values.astype(np.int64)
+        for key, ar in [('spikes', self.spikes_obj.spikes_buffer_ar), ('offsets', self.spikes_obj.spikes_offsets_ar), ('trials', trials_ar)]:
+            self.shared_dict[key], specs[key] = create_shared(ar)
+        if start_method is None:
+            start_method = 'forkserver' if 'forkserver' in mp.get_all_start_methods() else 'spawn'
+        self.pool = mp.get_context(start_method).Pool(self.processes, initializer=init_worker, initargs=(specs,))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """stop pool and free shared memory"""
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        for shm in self.shared_dict.values():
+            shm.close()
+            shm.unlink()
+        self.shared_dict = dict()
+
+    def check_selection(self):
+        """shared trial table has to match the current selection of spikes_obj"""
+        if not np.array_equal(self.select_ar, self.spikes_obj.select_ar):
+            raise ValueError("selection of spikes_obj changed, create a new ParallelSDA after set_selection")
+
+    def get_tasks(self, n_clusters, iterations, chunk_size, clusters_per_task, values_per_cluster):
+        """(c0, c1, k0, k1) of all tasks, about 4 tasks per worker and ~20M values per task if not given"""
+        if clusters_per_task is None:
+            clusters_per_task = max(1, -(-n_clusters//self.processes))
+        if chunk_size is None:
+            n_cluster_tasks = -(-n_clusters//clusters_per_task)
+            chunk_size = max(1, -(-iterations*n_cluster_tasks//(4*self.processes)))
+            chunk_size = min(chunk_size, max(1, int(2e7//max(1, clusters_per_task*values_per_cluster))))
+        return [(c0, min(c0+clusters_per_task, n_clusters), k0, min(k0+chunk_size, iterations))
+                for c0 in range(0, n_clusters, clusters_per_task) for k0 in range(0, iterations, chunk_size)]
+
+    def gen_surrogate_cube(self, event, window, iterations, n_bins=60, null='window', jitter=10, trials_mask=None,
+                           seed=0, chunk_size=None, clusters_per_task=None):
+        """surrogate count cube computed by the pool, see SpikesSDA.iter_null_chunks
+
+        'window' gives the same cube as SpikesSDA for the same seed, 'isi' and 'jitter' use one random stream per task
+
+        Args:
+            event (str): trial event, one of TRIAL_COLUMNS, not used for 'window'
+            window (int): 1/2 window width in ms
+            iterations (int): number of surrogates
+            n_bins (int, optional): number of bins over the whole window. Defaults to 60.
+            null (str, optional): 'window', 'isi' or 'jitter'. Defaults to 'window'.
+            jitter (int, optional): max spike shift in ms for 'jitter'. Defaults to 10.
+            trials_mask (np ar, optional): bool mask over selected trials. Defaults to all selected trials.
+            seed (int, optional): random seed. Defaults to 0.
+            chunk_size (int, optional): iterations per task. Defaults to ~4 tasks per worker.
+            clusters_per_task (int, optional): clusters per task. Defaults to n_clusters/processes.
+
+        Returns:
+            np ar: int32 array (i=good cluster, j=bin, k=iteration)
+        """
+        if null not in ('window', 'isi', 'jitter'):
+            raise ValueError(f"unknown null '{null}', use 'window', 'isi' or 'jitter'")
+        self.check_selection()
+        n_trials = self.selected_trials_df.shape[0]
+        mask = np.ones(n_trials, dtype=bool) if trials_mask is None else np.asarray(trials_mask, dtype=bool)
+        n_clusters = self.spikes_obj.spikes_offsets_ar.size-1
+        edges = self.spikes_obj.get_psth_edges(window, n_bins)
+        call = dict(null=null, edges=edges, seed=seed)
+
+        # arrays of this call, freed at the end
+        call_dict = dict()
+        try:
+            call_dict['out'], call['out'] = create_shared(np.zeros((n_clusters, n_bins, iterations), dtype=np.int32))
+            if null == 'window':
+                centers = self.sda_obj.get_random_centers(window, iterations, seed, trials_mask)
+                call_dict['centers'], call['centers'] = create_shared(centers)
+                call['span'] = int(max(self.spikes_obj.spikes_buffer_ar.max(initial=0), centers.max(initial=0)+edges[-1]))+2
+                values_per_cluster = centers.shape[0]*edges.size
+            else:
+                # same spike range as SpikesSDA.iter_null_chunks
+                times = self.selected_trials_df[event].values.astype(np.int64)[mask, None] + edges[None, :]
+                shift = jitter*20 if null == 'jitter' else 0
+                start, end = times.min()-shift, times.max()+shift
+                if null == 'isi':
+                    start = min(start, self.selected_trials_df['start'].min())
+                    end = max(end, self.selected_trials_df['end'].max())
+                spikes_ar, offsets_ar = self.spikes_obj.get_spike_buffer_range(start, end)
+                call_dict['range_spikes'], call['range_spikes'] = create_shared(spikes_ar)
+                call_dict['range_offsets'], call['range_offsets'] = create_shared(offsets_ar)
+                call.update(trials_mask=mask, event_idx=TRIAL_COLUMNS.index(event), shift=shift,
+                            span=int(max(spikes_ar.max(initial=0), times.max()))+shift+2)
+                values_per_cluster = spikes_ar.size/n_clusters + times.size
+
+            tasks = [task+(call,) for task in self.get_tasks(n_clusters, iterations, chunk_size, clusters_per_task, values_per_cluster)]
+            for _ in self.pool.imap_unordered(count_task, tasks):
+                pass
+            return np.ndarray((n_clusters, n_bins, iterations), dtype=np.int32, buffer=call_dict['out'].buf).copy()
+        finally:
+            for shm in call_dict.values():
+                shm.close()
+                shm.unlink()
+
+    def test_event(self, event, window, iterations=1000, n_bins=60, tail='greater', null='window', jitter=10,
+                   trials_mask=None, seed=0, chunk_size=None, clusters_per_task=None):
+        """SpikesSDA.test_event with the surrogate cube of the pool, cached in test_dict
+
+        Returns:
+            dict: surrogate_test output + 'edges' in ms and 'summary_df' with one row per good cluster
+        """
+        # before the cache lookup, cached results belong to the selection of construction
+        self.check_selection()
+        mask_key = None if trials_mask is None else np.asarray(trials_mask, dtype=bool).tobytes()
+        key = (event, window, iterations, n_bins, tail, seed, null, jitter if null == 'jitter' else None, mask_key)
+        if key not in self.test_dict:
+            cube = self.gen_surrogate_cube(event, window, iterations, n_bins, null, jitter, trials_mask, seed, chunk_size, clusters_per_task)
+            result = surrogate_test(self.sda_obj.get_event_counts(event, window, n_bins, trials_mask), cube, tail=tail)
+            result['edges'] = self.spikes_obj.get_psth_edges(window, n_bins)/20
+            result['summary_df'] = self.sda_obj.get_test_summary(result, tail)
+            self.test_dict[key] = result
+        return self.test_dict[key]
@@ -0,0 +1,330 @@
+import numpy as np
+import pandas as pd
+import matplotlib.pyplot as plt
+import itertools
+import os
+
+
+# pca #####################################################################################################################
+def randomized_pca(X, n_components, n_oversamples=10, n_iter=4, seed=0):
+    """principal axes of centered data with a randomized range finder
+
+    Args:
+        X (np ar): centered data (i=sample, j=feature)
+        n_components (int): number of components
+        n_oversamples (int, optional): extra random vectors. Defaults to 10.
+        n_iter (int, optional): power iterations. Defaults to 4.
+        seed (int, optional): random seed. Defaults to 0.
+
+    Returns:
+        tuple: (components (i=component, j=feature), explained variance (i=component))
+    """
+    rng = np.random.default_rng(seed)
+    k = min(n_components+n_oversamples, *X.shape)
+    Q = np.linalg.qr(X @ rng.normal(size=(X.shape[1], k)).astype(X.dtype))[0]
+    for _ in range(n_iter):
+        Q = np.linalg.qr(X.T @ Q)[0]
+        Q = np.linalg.qr(X @ Q)[0]
+    _, s, Vt = np.linalg.svd(Q.T @ X, full_matrices=False)
+    return Vt[:n_components], (s[:n_components]**2)/max(X.shape[0]-1, 1)
+
+
+class IncrementalCovariance():
+    """[# mean and covariance of features accumulated over sample chunks, pca from the covariance]
+    """
+    def __init__(self, n_features):
+        self.n = 0
+        self.sum_ar = np.zeros(n_features)
+        self.cross_ar = np.zeros((n_features, n_features))
+
+    def update(self, X):
+        """add samples (i=sample, j=feature)"""
+        X = np.asarray(X, dtype=np.float64)
+        self.n += X.shape[0]
+        self.sum_ar += X.sum(axis=0)
+        self.cross_ar += X.T @ X
+
+    def get_mean(self):
+        return self.sum_ar/self.n
+
+    def get_pca(self, n_components):
+        """(components (i=component, j=feature), explained variance (i=component))"""
+        mean = self.get_mean()
+        cov = (self.cross_ar - self.n*np.outer(mean, mean))/max(self.n-1, 1)
+        variance, vectors = np.linalg.eigh(cov)
+        order = np.argsort(variance)[::-1][:n_components]
+        return vectors[:, order].T, variance[order]
+
+
+# class ###################################################################################################################
+class SpikesPopulation():
+    """[# condition averaged population activity and its low dimensional trajectories]
+
+    conditions are combinations of the trial flags of get_trials ('side', 'reward_given', 'probability'),
+    projections are fitted once and kept in projection_dict, new conditions or trial subsets are projected
+    without refitting:
+
+        population_obj = SpikesPopulation(spikes_obj)
+        population_obj.fit_pca('reward', events=['cue', 'sound', 'openloop', 'reward'])
+        trajectory_df = population_obj.project('reward', 'reward', by=['side'])
+    """
+    def __init__(self, spikes_obj, cache_folder=None):
+        """[summary]
+
+        Args:
+            spikes_obj (SpikesEDA): spikes object
+            cache_folder (str, optional): folder to save fitted projections as .npz. Defaults to None.
+        """
+        self.session = spikes_obj.session
+        self.folder = spikes_obj.folder
+        self.gamble_side = spikes_obj.gamble_side
+
+        # trial table and psth cubes are read from spikes_obj on every call, set_selection of spikes_obj applies
+        self.clusters_df = spikes_obj.clusters_df
+        self.spikes_obj = spikes_obj
+        self.cache_folder = cache_folder
+
+        self.tensor_dict = dict()
+        self.projection_dict = dict()
+
+    # conditions =============================================================================================================
+    def get_condition_values(self, factor):
+        """condition label of every selected trial for one factor, '' = trial without label
+
+        Args:
+            factor (str): 'side' (gamble / save), 'reward_given' (reward / no reward), 'probability' or any trial column
+
+        Returns:
+            np ar: object array of labels
+        """
+        trials_df = self.spikes_obj.selected_trials_df
+        if factor == 'side':
+            save = 'left' if self.gamble_side == 'right' else 'right'
+            return np.where(trials_df[self.gamble_side].values.astype(bool), 'gamble',
+                            np.where(trials_df[save].values.astype(bool), 'save', '')).astype(object)
+        if factor == 'reward_given':
+            return np.where(trials_df['reward_given'].values.astype(bool), 'reward', 'no reward').astype(object)
+        return trials_df[factor].astype(str).values.astype(object)
+
+    def get_conditions(self, by=['side', 'reward_given'], min_trials=3, trials_mask=None):
+        """all combinations of the factor labels with at least min_trials selected trials
+
+        Args:
+            by (list, optional): factors, see get_condition_values. Defaults to ['side', 'reward_given'].
+            min_trials (int, optional): min trials of a condition. Defaults to 3.
+            trials_mask (np ar, optional): bool mask over selected trials. Defaults to all selected trials.
+
+        Returns:
+            pd.DataFrame: one row per condition, columns = factors + ['trials'], index = condition name
+        """
+        values = {factor: self.get_condition_values(factor) for factor in by}
+        mask = np.ones(self.spikes_obj.selected_trials_df.shape[0], dtype=bool) if trials_mask is None else np.asarray(trials_mask, dtype=bool)
+        for factor in by:
+            mask &= values[factor] != ''
+        rows = []
+        for combination in itertools.product(*[sorted(set(values[factor][mask])) for factor in by]):
+            condition_mask = mask.copy()
+            for factor, label in zip(by, combination):
+                condition_mask &= values[factor] == label
+            if condition_mask.sum() >= min_trials:
+                rows.append(dict(zip(by, combination), trials=int(condition_mask.sum()), mask=condition_mask))
+        conditions_df = pd.DataFrame(rows)
+        conditions_df.index = [' '.join(str(row[factor]) for factor in by) for _, row in conditions_df.iterrows()]
+        return conditions_df
+
+    # tensors ================================================================================================================
+    def gen_condition_tensor(self, event, window=2000, n_bins=60, by=['side', 'reward_given'], min_trials=3,
+                             sigma=None, trials_mask=None):
+        """trial averaged rate of every good cluster per condition, cached in tensor_dict
+
+        Args:
+            event (str): event column of selected_trials_df
+            window (int, optional): 1/2 window width in ms. Defaults to 2000.
+            n_bins (int, optional): number of bins over the whole window. Defaults to 60.
+            by (list, optional): condition factors. Defaults to ['side', 'reward_given'].
+            min_trials (int, optional): min trials of a condition. Defaults to 3.
+            sigma (float, optional): gaussian smoothing in ms. Defaults to None.
+            trials_mask (np ar, optional): bool mask over selected trials. Defaults to all selected trials.
+
+        Returns:
+            tuple: (float32 tensor (i=condition, j=good cluster, k=bin) in Hz, conditions_df)
+        """
+        mask_key = None if trials_mask is None else np.asarray(trials_mask, dtype=bool).tobytes()
+        key = (event, window, n_bins, tuple(by), min_trials, sigma, self.spikes_obj.select_ar.tobytes(), mask_key)
+        if key not in self.tensor_dict:
+            conditions_df = self.get_conditions(by, min_trials, trials_mask)
+            cube = self.spikes_obj.gen_psth_cube(event, window, n_bins)
+            # condition x trial weights, one matrix product for all conditions
+            weights = np.stack(conditions_df['mask'].values).astype(np.float32)
+            weights /= weights.sum(axis=1, keepdims=True)
+            bin_s = 2*window/n_bins/1000
+            tensor = np.einsum('ct,ktb->ckb', weights, cube.astype(np.float32))/bin_s
+            if sigma is not None:
+                shape = tensor.shape
+                tensor = self.spikes_obj.smooth_bin_count(tensor.reshape(-1, shape[2]), 'gaussian', sigma, 2*window/n_bins).reshape(shape)
+            self.tensor_dict[key] = (tensor.astype(np.float32), conditions_df)
+        return self.tensor_dict[key]
+
+    # projections ============================================================================================================
+    def get_samples(self, tensor):
+        """tensor (condition, cluster, bin) as samples (condition x bin, cluster)"""
+        return tensor.transpose(0, 2, 1).reshape(-1, tensor.shape[1])
+
+    def fit_pca(self, name, events=['cue', 'sound', 'openloop', 'reward'], window=2000, n_bins=60, by=['side', 'reward_given'],
+                n_components=10, method='randomized', soft_norm=5.0, sigma=None, min_trials=3, seed=0):
+        """pca of the condition averaged activity around several events, stored as projection name
+
+        Args:
+            name (str): name of the projection
+            events (list, optional): events, all condition x bin samples of all events are fitted together.
+                Defaults to ['cue', 'sound', 'openloop', 'reward'].
+            window (int, optional): 1/2 window width in ms. Defaults to 2000.
+            n_bins (int, optional): number of bins over the whole window. Defaults to 60.
+            by (list, optional): condition factors. Defaults to ['side', 'reward_given'].
+            n_components (int, optional): number of components. Defaults to 10.
+            method (str, optional): 'randomized' (all samples in memory) or 'incremental' (covariance
+                accumulated event by event). Defaults to 'randomized'.
+            soft_norm (float, optional): rates are divided by (rate range + soft_norm) of each cluster. Defaults to 5.0.
+            sigma (float, optional): gaussian smoothing in ms. Defaults to None.
+            min_trials (int, optional): min trials of a condition. Defaults to 3.
+            seed (int, optional): random seed. Defaults to 0.
+
+        Returns:
+            dict: projection with 'components', 'explained_variance', 'explained_ratio', 'mean', 'scale'
+        """
+        tensors = [self.gen_condition_tensor(event, window, n_bins, by, min_trials, sigma)[0] for event in events]
+        rate_range = np.max([tensor.max(axis=(0, 2)) - tensor.min(axis=(0, 2)) for tensor in tensors], axis=0)
+        scale = 1/(rate_range + soft_norm)
+
+        if method == 'incremental':
+            covariance = IncrementalCovariance(scale.size)
+            for tensor in tensors:
+                covariance.update(self.get_samples(tensor)*scale)
+            mean = covariance.get_mean()
+            components, variance = covariance.get_pca(n_components)
+            total = np.trace((covariance.cross_ar - covariance.n*np.outer(mean, mean))/max(covariance.n-1, 1))
+        elif method == 'randomized':
+            X = np.concatenate([self.get_samples(tensor) for tensor in tensors])*scale
+            mean = X.mean(axis=0)
+            X = X - mean
+            components, variance = randomized_pca(X, n_components, seed=seed)
+            total = (X**2).sum()/max(X.shape[0]-1, 1)
+        else:
+            raise ValueError(f"unknown method '{method}', use 'randomized' or 'incremental'")
+
+        # sign convention: largest loading positive, same axes for both methods
+        components = components*np.sign(components[np.arange(components.shape[0]), np.abs(components).argmax(axis=1)])[:, None]
+        projection = dict(components=components.astype(np.float32), explained_variance=variance,
+                          explained_ratio=variance/total, mean=mean.astype(np.float32), scale=scale.astype(np.float32),
+                          window=window, n_bins=n_bins, sigma=sigma, events=list(events), by=list(by))
+        self.projection_dict[name] = projection
+        if self.cache_folder is not None:
+            self.save_projection(name)
+        return projection
+
+    def fit_marginal_pca(self, name, event, window=2000, n_bins=60, by=['side', 'reward_given'], n_components=3,
+                         soft_norm=5.0, sigma=None, min_trials=3, seed=0):
+        """demixed style pca: one pca per marginalization of the condition tensor
+
+        marginalizations are 'time' (condition independent) and one per factor (average over the other factors minus
+        the time marginal), every marginalization is stored as projection '<name>_<marginalization>'
+
+        Returns:
+            dict: marginalization -> projection
+        """
+        tensor, conditions_df = self.gen_condition_tensor(event, window, n_bins, by, min_trials, sigma)
+        scale = 1/(tensor.max(axis=(0, 2)) - tensor.min(axis=(0, 2)) + soft_norm)
+        tensor = tensor*scale[None, :, None]
+        mean = tensor.mean(axis=(0, 2))
+        centered = tensor - mean[None, :, None]
+        total = (centered**2).sum()/max(centered.shape[0]*centered.shape[2]-1, 1)
+
+        marginals = {'time': centered.mean(axis=0, keepdims=True)}
+        for factor in by:
+            # average over the conditions with the same label of the factor
+            labels = conditions_df[factor].values
+            factor_ar = np.stack([centered[labels == label].mean(axis=0) for label in sorted(set(labels))])
+            marginals[factor] = factor_ar - marginals['time']
+
+        projections = dict()
+        for marginal, ar in marginals.items():
+            components, variance = randomized_pca(self.get_samples(ar), n_components, seed=seed)
+            components = components*np.sign(components[np.arange(components.shape[0]), np.abs(components).argmax(axis=1)])[:, None]
+            projection = dict(components=components.astype(np.float32), explained_variance=variance,
+                              explained_ratio=variance/total, mean=mean.astype(np.float32), scale=scale.astype(np.float32),
+                              window=window, n_bins=n_bins, sigma=sigma, events=[event], by=list(by))
+            self.projection_dict[name+'_'+marginal] = projection
+            if self.cache_folder is not None:
+                self.save_projection(name+'_'+marginal)
+            projections[marginal] = projection
+        return projections
+
+    def project(self, name, event, by=['side', 'reward_given'], min_trials=3, trials_mask=None, n_components=None):
+        """project condition averaged activity on a fitted projection, no refit
+
+        Args:
+            name (str): name of a fitted or saved projection
+            event (str): event column of selected_trials_df
+            by (list, optional): condition factors, may differ from the fitted ones. Defaults to ['side', 'reward_given'].
+            min_trials (int, optional): min trials of a condition. Defaults to 3.
+            trials_mask (np ar, optional): bool mask over selected trials. Defaults to all selected trials.
+            n_components (int, optional): number of components. Defaults to all.
+
+        Returns:
+            pd.DataFrame: index (condition, time in ms), one column per component 'pc1', 'pc2', ...
+        """
+        projection = self.get_projection(name)
+        window, n_bins = projection['window'], projection['n_bins']
+        tensor, conditions_df = self.gen_condition_tensor(event, window, n_bins, by, min_trials, projection['sigma'], trials_mask)
+        components = projection['components'][:n_components]
+        scores = (self.get_samples(tensor)*projection['scale'] - projection['mean']) @ components.T
+        edges = self.spikes_obj.get_psth_edges(window, n_bins)/20
+        index = pd.MultiIndex.from_product([conditions_df.index, (edges[:-1]+edges[1:])/2], names=['condition', 'time'])
+        return pd.DataFrame(scores, index=index, columns=[f"pc{i+1}" for i in range(components.shape[0])])
+
+    # cache ==================================================================================================================
+    def get_projection_file(self, name):
+        return os.path.join(self.cache_folder, f"{self.session}_{name}.npz")
+
+    def save_projection(self, name):
+        os.makedirs(self.cache_folder, exist_ok=True)
+        projection = self.projection_dict[name]
+        np.savez(self.get_projection_file(name), **{key: np.asarray(value if value is not None else np.nan) for key, value in projection.items()})
+
+    def get_projection(self, name):
+        """fitted projection from projection_dict or the cache folder"""
+        if name not in self.projection_dict:
+            if self.cache_folder is None or not os.path.isfile(self.get_projection_file(name)):
+                raise KeyError(f"projection '{name}' is not fitted")
+            with np.load(self.get_projection_file(name)) as data:
+                projection = {key: data[key] for key in data.files}
+            for key in ['window', 'n_bins']:
+                projection[key] = int(projection[key])
+            projection['sigma'] = None if np.isnan(projection['sigma']) else float(projection['sigma'])
+            projection['events'] = list(projection['events'])
+            projection['by'] = list(projection['by'])
+            self.projection_dict[name] = projection
+        return self.projection_dict[name]
+
+    # plotting ===============================================================================================================
+    def plt_trajectories(self, trajectory_df, x='pc1', y='pc2', title=None):
+        """trajectories of all conditions in the plane of two components, dot = event time
+
+        Args:
+            trajectory_df (pd.DataFrame): from project
+
+        Returns:
+            fig, ax:
+        """
+        fig, ax = plt.subplots(figsize=(4, 4))
+        for condition, df in trajectory_df.groupby(level='condition', sort=False):
+            line = ax.plot(df[x].values, df[y].values, label=condition)[0]
+            time = df.index.get_level_values('time').values
+            zero = np.abs(time).argmin()
+            ax.plot(df[x].values[zero], df[y].values[zero], 'o', color=line.get_color())
+        ax.set_xlabel(x)
+        ax.set_ylabel(y)
+        ax.legend(loc='best', fontsize=8)
+        if title is not None:
+            ax.set_title(title)
+        return fig, ax
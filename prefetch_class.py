@@ -0,0 +1,214 @@
+import asyncio
+import io
+import os
+import shutil
+import threading
+import time
+
+import matplotlib.pyplot as plt
+
+
+# files of a session read by SyncPhenosys and SpikesEDA
+SESSION_FILES = [
+    'electrophysiology/digitalin.dat',
+    'behavior/output.csv',
+    'electrophysiology/spike_times.npy',
+    'electrophysiology/spike_clusters.npy',
+    'electrophysiology/cluster_info.tsv',
+]
+
+
+def start_loop():
+    """asyncio event loop running in a daemon thread
+
+    Returns:
+        tuple: (loop, thread)
+    """
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    return loop, thread
+
+
+def stop_loop(loop, thread):
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
+
+
+# class ###################################################################################################################
+class SessionPrefetcher():
+    """[# copy session files from a slow (network) drive to a local cache in the background]
+
+    sessions are fetched lookahead sessions ahead of the one that is processed:
+
+        prefetch = SessionPrefetcher(folders, '/tmp/cache')
+        for folder, local_folder in prefetch:
+            sync_obj = SyncPhenosys(session, local_folder)
+            ...
+        prefetch.close()
+    """
+    def __init__(self, folders, cache_folder, lookahead=1, max_concurrent=4, latency=0.0, files=SESSION_FILES):
+        """[summary]
+
+        Args:
+            folders (list): session folders on the (network) drive
+            cache_folder (str): local scratch folder, one sub folder per session
+            lookahead (int, optional): number of sessions fetched ahead of the current one. Defaults to 1.
+            max_concurrent (int, optional): max number of files copied at the same time. Defaults to 4.
+            latency (float, optional): artificial delay per file in seconds, to test with local folders. Defaults to 0.0.
+            files (list, optional): files relative to the session folder. Defaults to SESSION_FILES.
+        """
+        self.folders = list(folders)
+        self.cache_folder = cache_folder
+        self.lookahead = lookahead
+        self.latency = latency
+        self.files = files
+
+        self.loop, self.thread = start_loop()
+        self.semaphore = asyncio.run_coroutine_threadsafe(self.create_semaphore(max_concurrent), self.loop).result()
+        self.futures = dict()
+
+    async def create_semaphore(self, max_concurrent):
+        # semaphore has to be created inside the loop
+        return asyncio.Semaphore(max_concurrent)
+
+    def get_local_folder(self, folder):
+        return os.path.join(self.cache_folder, os.path.basename(os.path.normpath(folder)))
+
+    # copy ===================================================================================================================
+    def copy_file(self, source, destination):
+        """blocking copy, runs in worker thread, file appears complete or not at all"""
+        if self.latency > 0:
+            time.sleep(self.latency)
+        if os.path.isfile(destination) and os.path.getsize(destination) == os.path.getsize(source):
+            return destination
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        shutil.copyfile(source, destination+'.part')
+        os.replace(destination+'.part', destination)
+        return destination
+
+    async def fetch_file(self, source, destination):
+        async with self.semaphore:
+            return await asyncio.to_thread(self.copy_file, source, destination)
+
+    async def fetch_session(self, folder):
+        """copy all files of one session concurrently
+
+        Args:
+            folder (str): session folder
+
+        Returns:
+            str: local session folder
+        """
+        local_folder = self.get_local_folder(folder)
+        await asyncio.gather(*[self.fetch_file(os.path.join(folder, file), os.path.join(local_folder, file))
+                               for file in self.files if os.path.isfile(os.path.join(folder, file))])
+        return local_folder
+
+    # access =================================================================================================================
+    def prefetch(self, idx):
+        """start fetching session idx if not started yet"""
+        if idx < len(self.folders) and idx not in self.futures:
+            self.futures[idx] = asyncio.run_coroutine_threadsafe(self.fetch_session(self.folders[idx]), self.loop)
+
+    def get(self, idx):
+        """local folder of session idx, waits until all files are copied and starts the next sessions
+
+        Args:
+            idx (int): index in folders
+
+        Returns:
+            str: local session folder
+        """
+        for i in range(idx, idx+self.lookahead+1):
+            self.prefetch(i)
+        return self.futures[idx].result()
+
+    def __iter__(self):
+        for idx, folder in enumerate(self.folders):
+            yield folder, self.get(idx)
+
+    def close(self):
+        for future in self.futures.values():
+            future.cancel()
+        stop_loop(self.loop, self.thread)
+
+
+# class ###################################################################################################################
+class FigureWriter():
+    """[# write figures from a bounded queue in the background]
+
+    figures are rendered in the calling thread (matplotlib is not thread safe), only the file write
+    is done in the background. save blocks while max_queue figures are waiting.
+    """
+    def __init__(self, max_queue=8, latency=0.0):
+        """[summary]
+
+        Args:
+            max_queue (int, optional): max number of rendered figures waiting to be written. Defaults to 8.
+            latency (float, optional): artificial delay per file in seconds, to test with local folders. Defaults to 0.0.
+        """
+        self.latency = latency
+        self.errors = []
+        self.loop, self.thread = start_loop()
+        self.queue = asyncio.run_coroutine_threadsafe(self.create_queue(max_queue), self.loop).result()
+        self.worker = asyncio.run_coroutine_threadsafe(self.create_worker(), self.loop).result()
+
+    async def create_queue(self, max_queue):
+        # queue and worker task have to be created inside the loop
+        return asyncio.Queue(max_queue)
+
+    async def create_worker(self):
+        return asyncio.create_task(self.write_files())
+
+    async def stop_worker(self):
+        self.worker.cancel()
+        await asyncio.gather(self.worker, return_exceptions=True)
+
+    def write_file(self, file, data):
+        if self.latency > 0:
+            time.sleep(self.latency)
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        with open(file, 'wb') as f:
+            f.write(data)
+
+    async def write_files(self):
+        while True:
+            file, data = await self.queue.get()
+            try:
+                await asyncio.to_thread(self.write_file, file, data)
+            except Exception as e:
+                self.errors.append((file, e))
+            finally:
+                self.queue.task_done()
+
+    def save(self, fig, file, close=True, **kwargs):
+        """render figure and put it in the write queue
+
+        Args:
+            fig (plt.Figure): figure
+            file (str): file path, format from kwargs or file ending
+            close (bool, optional): close figure after rendering. Defaults to True.
+            kwargs: passed to fig.savefig
+        """
+        if 'format' not in kwargs:
+            kwargs['format'] = os.path.splitext(file)[1][1:] or 'png'
+        buffer = io.BytesIO()
+        fig.savefig(buffer, **kwargs)
+        if close:
+            plt.close(fig)
+        asyncio.run_coroutine_threadsafe(self.queue.put((file, buffer.getvalue())), self.loop).result()
+
+    def flush(self):
+        """wait until all queued figures are written, raise first write error"""
+        asyncio.run_coroutine_threadsafe(self.queue.join(), self.loop).result()
+        if self.errors:
+            file, e = self.errors[0]
+            self.errors = []
+            raise OSError(f"could not write {file}") from e
+
+    def close(self):
+        self.flush()
+        asyncio.run_coroutine_threadsafe(self.stop_worker(), self.loop).result()
+        stop_loop(self.loop, self.thread)
@@ -17,19 +17,27 @@ from pylatex.utils import italic, NoEscape
 
 # class ###################################################################################################################
 class SpikesReport():
-    def __init__(self, spikes_obj):
+    def __init__(self, spikes_obj, figure_writer=None):
+        """[summary]
+
+        Args:
+            spikes_obj (SpikesEDA): [description]
+            figure_writer (prefetch_class.FigureWriter, optional): write figures in the background. Defaults to None.
+        """
         self.session = spikes_obj.session
         self.folder = spikes_obj.folder
         self.gamble_side = spikes_obj.gamble_side
 
         self.all_trials_df = spikes_obj.all_trials_df
         self.good_trials_df = spikes_obj.good_trials_df
-        self.selected_trials_df = spikes_obj.selected_trials_df
         self.skip_clusters = spikes_obj.skip_clusters
         self.spikes_df = spikes_obj.spikes_df
         self.clusters_df = spikes_obj.clusters_df
-        
-        self.spikes_per_trial_ar = spikes_obj.spikes_per_trial_ar
+
+        # plotting functions, selected trials and spikes per trial live in the SpikesEDA object,
+        # they are read at plot time so set_selection of spikes_obj applies to the whole report
+        self.spikes_obj = spikes_obj
+        self.figure_writer = figure_writer
 
         #self.randomized_bins_ar = self.get_randomized_samples(200, 1000)
 
@@ -59,6 +67,9 @@ class SpikesReport():
         return arg
 
     def generate_report(self):
+        # all figures have to be written before latex includes them
+        if self.figure_writer is not None:
+            self.figure_writer.flush()
         # Basic document
         # Document with `\maketitle` command activated
         doc = Document(default_filepath=(self.folder + r"/figures"))
@@ -112,7 +123,7 @@ class SpikesReport():
                     small_table.add_hline()
                     small_table.add_row(["All trials", self.all_trials_df.index.max()])
                     small_table.add_row(["Good trials", self.good_trials_df.index.max()])
-                    small_table.add_row(["Selected trials", self.selected_trials_df.index.max()])
+                    small_table.add_row(["Selected trials", self.spikes_obj.selected_trials_df.index.max()])
                     small_table.add_hline()
                     small_table.add_row(["Probability bins", str(self.all_trials_df['probability'].unique())])
             
@@ -122,6 +133,18 @@ class SpikesReport():
                 doc.append(NoEscape( self.image_box("cluster_hist", last=True) ))
                 doc.append(NewPage())
 
+        # cluster quality section, isi stats are cached in the spikes object
+        with doc.create(Section('Cluster quality')):
+            qc_df = self.spikes_obj.gen_isi_stats()['qc_df']
+            with doc.create(LongTabu("r r r r r r r")) as qc_table:
+                qc_table.add_row(["Cluster", "Spikes", "Rate [Hz]", "Mean ISI [ms]", "CV", "CV2", "ISI < 2ms [%]"])
+                qc_table.add_hline()
+                qc_table.end_table_header()
+                for cluster, row in qc_df.iterrows():
+                    qc_table.add_row([cluster, int(row['n_spikes']), round(row['firing_rate'], 2), round(row['mean_isi_ms'], 1),
+                                      round(row['cv'], 2), round(row['cv2'], 2), round(row['refractory_violations']*100, 2)])
+            doc.append(NewPage())
+
 
         # Add stuff to the document
         with doc.create(Section('Spike Trains and Histogram for Reward Events')):
@@ -176,15 +199,19 @@ class SpikesReport():
         return:
         """
         # batch plot for single cluster all reward configurations
-        # gamble side = right -> reward = 5, no reward = 6
+        # events are categorical names, gamble / save side from self.gamble_side
         # reward
-        sel_tr_rw_all = self.trials_df.loc[ (self.trials_df['select'] == True) & ( (self.trials_df['event']==5) | (self.trials_df['event']==7) ) ][:]
-        sel_tr_rw_gambl = self.trials_df.loc[ (self.trials_df['select'] == True) & ( (self.trials_df['event']==5) ) ][:]
-        sel_tr_rw_save = self.trials_df.loc[ (self.trials_df['select'] == True) & ( (self.trials_df['event']==7) ) ][:]
+        trials_df = self.spikes_obj.selected_trials_df
+        event = trials_df['event']
+        gamble = self.gamble_side
+        save = 'left' if gamble == 'right' else 'right'
+        sel_tr_rw_all = trials_df.loc[event.isin(['right_rw', 'left_rw'])]
+        sel_tr_rw_gambl = trials_df.loc[event == gamble+'_rw']
+        sel_tr_rw_save = trials_df.loc[event == save+'_rw']
         # no reward
-        sel_tr_norw_all = self.trials_df.loc[ (self.trials_df['select'] == True) & ( (self.trials_df['event']==8) | (self.trials_df['event']==6) ) ][:]
-        sel_tr_norw_gambl = self.trials_df.loc[ (self.trials_df['select'] == True) & ( (self.trials_df['event']==6) ) ][:]
-        sel_tr_norw_save = self.trials_df.loc[ (self.trials_df['select'] == True) & ( (self.trials_df['event']==8) ) ][:]
+        sel_tr_norw_all = trials_df.loc[event.isin(['right_norw', 'left_norw'])]
+        sel_tr_norw_gambl = trials_df.loc[event == gamble+'_norw']
+        sel_tr_norw_save = trials_df.loc[event == save+'_norw']
         # title
         tlt_rw_all = ("reward (both sides)")
         tlt_rw_gambl = ("reward gambl side")
@@ -235,7 +262,7 @@ class SpikesReport():
                 # create subplot
                 fig, axs = plt.subplots(nrows=2, ncols=1, sharex=True, gridspec_kw={'hspace': 0})
                 # plot figure
-                fig, axs = self.plt_spike_train_hist(cluster, selected_trials, 'reward', window, fig, axs, title)
+                fig, axs = self.spikes_obj.plt_spike_train_hist(cluster, selected_trials, 'reward', window, fig, axs, title)
                 # save figure
                 plt.savefig(file, dpi=300)
                 plt.close(fig)
@@ -255,15 +282,19 @@ class SpikesReport():
         return:
         """
         # batch plot for single cluster all reward configurations
-        # gamble side = right -> reward = 5, no reward = 6
+        # events are categorical names, gamble / save side from self.gamble_side
         # reward
-        sel_tr_rw_all = self.trials_df.loc[ (self.trials_df['select'] == True) & ( (self.trials_df['event']==5) | (self.trials_df['event']==7) ) ][:]
-        sel_tr_rw_gambl = self.trials_df.loc[ (self.trials_df['select'] == True) & ( (self.trials_df['event']==5) ) ][:]
-        sel_tr_rw_save = self.trials_df.loc[ (self.trials_df['select'] == True) & ( (self.trials_df['event']==7) ) ][:]
+        trials_df = self.spikes_obj.selected_trials_df
+        event = trials_df['event']
+        gamble = self.gamble_side
+        save = 'left' if gamble == 'right' else 'right'
+        sel_tr_rw_all = trials_df.loc[event.isin(['right_rw', 'left_rw'])]
+        sel_tr_rw_gambl = trials_df.loc[event == gamble+'_rw']
+        sel_tr_rw_save = trials_df.loc[event == save+'_rw']
         # no reward
-        sel_tr_norw_all = self.trials_df.loc[ (self.trials_df['select'] == True) & ( (self.trials_df['event']==8) | (self.trials_df['event']==6) ) ][:]
-        sel_tr_norw_gambl = self.trials_df.loc[ (self.trials_df['select'] == True) & ( (self.trials_df['event']==6) ) ][:]
-        sel_tr_norw_save = self.trials_df.loc[ (self.trials_df['select'] == True) & ( (self.trials_df['event']==8) ) ][:]
+        sel_tr_norw_all = trials_df.loc[event.isin(['right_norw', 'left_norw'])]
+        sel_tr_norw_gambl = trials_df.loc[event == gamble+'_norw']
+        sel_tr_norw_save = trials_df.loc[event == save+'_norw']
         # title
         tlt_rw_all = ("reward (both sides)")
         tlt_rw_gambl = ("reward gambl side")
@@ -325,7 +356,7 @@ class SpikesReport():
                 # pack axes
                 axs = (ax1, ax2, ax3)
                 # plot figure
-                fig, axs = self.plt_spike_train_hist_bar(cluster, selected_trials, 'reward', window, fig, axs, title)
+                fig, axs = self.spikes_obj.plt_spike_train_hist_bar(cluster, selected_trials, 'reward', window, fig, axs, title)
                 # save figure
                 plt.savefig(file, dpi=300)
                 plt.close(fig)
@@ -337,99 +368,66 @@ class SpikesReport():
 
     def save_fig(self, name, fig):
         folder = self.folder+"/figures/all_figures"
+        if self.figure_writer is not None:
+            self.figure_writer.save(fig, folder+"/"+name+'.png', dpi=200, format='png', bbox_inches='tight')
+            return
+        os.makedirs(folder, exist_ok=True)
         fig.savefig(folder+"/"+name+'.png',dpi=200, format='png', bbox_inches='tight')
+        plt.close(fig)
     
 
     def generate_plots(self):
         
         #hist and fit
-        fig, ax = self.plt_trial_hist_and_fit(self.selected_trials_df.loc[:,'length'])
+        fig, ax = self.spikes_obj.plt_trial_hist_and_fit(self.spikes_obj.selected_trials_df.loc[:,'length'])
         self.save_fig('hist_fit', fig)
         
         # trial length
         fig, ax = plt.subplots()
-        ax.plot(self.selected_trials_df.loc[:,'length'])
+        ax.plot(self.spikes_obj.selected_trials_df.loc[:,'length'])
         ax.set_ylabel('length [ms]')
         ax.set_xlabel('trial')
         self.save_fig('trial_length', fig)
         
         # cluster histogram
-        fig, ax = self.plt_all_cluster_spikes_hist()
+        fig, ax = self.spikes_obj.plt_all_cluster_spikes_hist()
         self.save_fig('cluster_hist', fig)
         
         # plott all isi for good clustes only focus between selected trials
-        start = self.selected_trials_df.loc[0,'start']
-        end = self.selected_trials_df.iloc[-1]['end']
-
-        for cluster, row in self.clusters_df.loc[self.clusters_df['group']=='good'].iterrows():
-            a = row['spikes']
-            fig, ax = self.plot_single_neuron_isis(a[np.logical_and(a>=start, a<=end)],cluster)
+        for cluster in self.clusters_df.loc[self.clusters_df['group']=='good'].index:
+            fig, ax = self.spikes_obj.plt_isi_acg(cluster)
             self.save_fig('isi_'+str(cluster), fig)
             
         # spike trains
         for cluster in self.clusters_df.loc[self.clusters_df['group']=='good'].index:
-            fig, ax = self.plt_spike_train(cluster)
+            fig, ax = self.spikes_obj.plt_spike_train(cluster)
             self.save_fig('spk_train_'+str(cluster), fig)
             
         # spike train + hist all trials
         for cluster in self.clusters_df.index:
-            fig, ax = self.plt_spike_train_hist_all_events(cluster, self.selected_trials_df, 'cue', 2000)
+            fig, ax = self.spikes_obj.plt_spike_train_hist_all_events(cluster, self.spikes_obj.selected_trials_df, 'cue', 2000)
             self.save_fig('spk_train_hist_all-events_'+str(cluster), fig)
         
         for cluster in self.clusters_df.index:
-            fig, ax = self.plt_spike_train_hist_all_events(cluster, self.selected_trials_df, 'reward', 2000)
+            fig, ax = self.spikes_obj.plt_spike_train_hist_all_events(cluster, self.spikes_obj.selected_trials_df, 'reward', 2000)
             self.save_fig('spk_train_hist_all-events_reward-centered_'+str(cluster), fig)
         
         # plott reward at specific trials
-        
-        # get gambl side
-        if self.gamble_side == 'right':
-            save='left'
-            gamble='right'
-        else:
-            save='right'
-            gamble='left'
-        
-        #spike train + hist reward specific events
-        # reward right
-        selected_trials = self.selected_trials_df[(self.selected_trials_df[gamble])&(self.selected_trials_df['reward_given'])]
-        for cluster in self.clusters_df.index:
-            fig, ax = self.plt_spike_train_hist(cluster, selected_trials, 'reward', 2000)
-            self.save_fig('spk_train_hist_gamble_reward_'+str(cluster), fig)
-        
-        # reward left
-        selected_trials = self.selected_trials_df[(self.selected_trials_df[save])&(self.selected_trials_df['reward_given'])]
-        for cluster in self.clusters_df.index:
-            fig, ax = self.plt_spike_train_hist(cluster, selected_trials, 'reward', 2000)
-            self.save_fig('spk_train_hist_save_reward_'+str(cluster), fig)
-        
-        # not rewarded
-        selected_trials = self.selected_trials_df[(self.selected_trials_df[gamble])&(np.invert(self.selected_trials_df['reward_given']))]
-        for cluster in self.clusters_df.index:
-            fig, ax = self.plt_spike_train_hist(cluster, selected_trials, 'reward', 2000)
-            self.save_fig('spk_train_hist_gamble_no-reward_'+str(cluster), fig)
-        
-        # reward left
-        selected_trials = self.selected_trials_df[(self.selected_trials_df[save])&(np.invert(self.selected_trials_df['reward_given']))]
-        for cluster in self.clusters_df.index:
-            fig, ax = self.plt_spike_train_hist(cluster, selected_trials, 'reward', 2000)
-            self.save_fig('spk_train_hist_save_no-reward_'+str(cluster), fig)
-            
-        
-        # all reward
-        selected_trials = self.selected_trials_df[self.selected_trials_df['reward_given']]
-        for cluster in self.clusters_df.index:
-            fig, ax = self.plt_spike_train_hist(cluster, selected_trials, 'reward', 2000)
-            self.save_fig('spk_train_hist_reward_'+str(cluster), fig)
-            
-        # all right
-        selected_trials = self.selected_trials_df[self.selected_trials_df[gamble]]
-        for cluster in self.clusters_df.index:
-            fig, ax = self.plt_spike_train_hist(cluster, selected_trials, 'reward', 2000)
-            self.save_fig('spk_train_hist_gamble_'+str(cluster), fig)
-
-        # all left
-        selected_trials = self.selected_trials_df[self.selected_trials_df[save]]
-        for cluster in self.clusters_df.index:
-            fig, ax = self.plt_spike_train_hist(cluster, selected_trials, 'reward', 2000)
-            self.save_fig('spk_train_hist_save_'+str(cluster), fig)
\ No newline at end of file
+        # psth cube is calculated once for all good clusters and selected trials,
+        # each trial subset is a mask over the trial axis
+        window = 2000
+        self.spikes_obj.gen_psth_cube('reward', window)
+        subsets = [
+            ('gamble_reward', dict(side='gamble', reward=True)),
+            ('save_reward', dict(side='save', reward=True)),
+            ('gamble_no-reward', dict(side='gamble', reward=False)),
+            ('save_no-reward', dict(side='save', reward=False)),
+            ('reward', dict(reward=True)),
+            ('gamble', dict(side='gamble')),
+            ('save', dict(side='save')),
+        ]
+        for name, conditions in subsets:
+            trials_mask = self.spikes_obj.get_trial_mask(**conditions)
+            for cluster in self.clusters_df.loc[self.clusters_df['group']=='good'].index:
+                fig, ax = self.spikes_obj.plt_psth(cluster, 'reward', window, trials_mask)
+                self.save_fig('spk_train_hist_'+name+'_'+str(cluster), fig)
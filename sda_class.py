@@ -13,37 +13,41 @@ from matplotlib.ticker import LinearLocator, FormatStrFormatter
 from pylatex import Document, Section, Subsection, Command, Package, NewPage, LongTabu, Tabular
 from pylatex.utils import italic, NoEscape
 
+from eda_class import search_spike_buffer
+
 # numba helper functions
 from numba import njit
 @njit()
 
-def create_random_start(trial_nr,iter_nr, trials_df, delta):
+def create_random_start(trial_nr,iter_nr, starts_ar, ends_ar, delta):
     """get random event within trial
 
     Args:
         trial_nr (int): number of trials
         iter_nr (int): number of iterations
-        trials_df (numpy ar): dataframe from spikes class with all trials
+        starts_ar (numpy ar): start of all selected trials
+        ends_ar (numpy ar): end of all selected trials
         delta (float): window = 2*delta
 
     Returns:
         random_li(numpy ar): array with random start points, (i=trial_nr, j=iter_nr)
     """
     #initialize complete dataframe
-    random_li = np.zeros(shape=(trial_nr,iter_nr),dtype=int)
+    random_li = np.zeros(shape=(trial_nr,iter_nr),dtype=np.int64)
     #iterate over trials
-    for index, row in trials_df.iterrows():
+    for index in range(trial_nr):
         #generate iteration x random event from trial range
-        random_li[index,:]=(np.random.randint((row['start']+delta),(row['end']-delta), size=(iter_nr)) )-row['start']
+        random_li[index,:]=(np.random.randint((starts_ar[index]+delta),(ends_ar[index]-delta), size=(iter_nr)) )-starts_ar[index]
     return random_li
 
 
-def get_random_range_spikes(data_ar, range_ar):
+def get_random_range_spikes(data_ar, range_ar, delta):
     """get all spikes that fall in all random generated windows for specific trial
 
     Args:
         data_ar (numpy ar): spikes_per_trial_ar[cluster,trial,:] from spikes class
         range_ar (numpy ar): random_li output from create_random_start function
+        delta (int): 1/2 window width in sampling points
 
     Returns:
         list: list of arrays with spikes for all iterations for specific trial
@@ -60,12 +64,13 @@ def get_random_range_spikes(data_ar, range_ar):
     return results_li#, binned_li#, range_li #np.array(results_li,dtype=object)
 
 
-def get_random_range_spikes_all_trials(spikes_per_trial_df, random_ar):
+def get_random_range_spikes_all_trials(spikes_per_trial_df, random_ar, delta):
     """get spikes for all trials and iterations
 
     Args:
         spikes_per_trial_df (np ar): spikes class matrix from
         random_ar (np ar): random events
+        delta (int): 1/2 window width in sampling points
 
     Returns:
         li: list of lists with all spikes for all trials and all iterations
@@ -74,7 +79,7 @@ def get_random_range_spikes_all_trials(spikes_per_trial_df, random_ar):
     #binnes_li = list()
     for i in range(spikes_per_trial_df.shape[0]):
         #results_li, binned_li = get_random_range_spikes(spikes_per_trial_df[i].values, random_ar[i])
-        spiketimes_li.append(get_random_range_spikes(spikes_per_trial_df[i].values, random_ar[i]))
+        spiketimes_li.append(get_random_range_spikes(spikes_per_trial_df[i], random_ar[i], delta))
         #binnes_li.append(binned_li)
     return spiketimes_li#, binnes_li
 
@@ -101,6 +106,159 @@ def bin_trial_spike_times(input_ar,nr_bins):
     return data_ar
 
 
+def iter_chunks(surrogate, chunk_size=100):
+    """iterate over iteration chunks of a surrogate cube
+
+    Args:
+        surrogate (np ar or callable): cube (i=cluster, j=bin, k=iteration), e.g. memory mapped,
+            or function returning a new iterator over (cluster, bin, chunk) arrays
+        chunk_size (int, optional): iterations per chunk for arrays. Defaults to 100.
+
+    Returns:
+        iterator: (cluster, bin, chunk) arrays
+    """
+    if callable(surrogate):
+        return surrogate()
+    return (surrogate[:, :, k:k+chunk_size] for k in range(0, surrogate.shape[2], chunk_size))
+
+
+def surrogate_test(real_ar, surrogate, chunk_size=100, tail='greater'):
+    """empirical p-values and z-scores of real counts against a surrogate count cube, two passes over the chunks
+
+    max-statistic correction: the z-score of every bin is compared to the distribution of the largest
+    surrogate z-score over all bins of a cluster (p_fwer_bins) or over all bins and clusters (p_fwer)
+
+    Args:
+        real_ar (np ar): real counts (i=cluster, j=bin)
+        surrogate (np ar or callable): surrogate counts, see iter_chunks
+        chunk_size (int, optional): iterations per chunk for arrays. Defaults to 100.
+        tail (str, optional): 'greater', 'less' or 'two-sided'. Defaults to 'greater'.
+
+    Returns:
+        dict: 'p', 'z', 'p_fwer_bins', 'p_fwer', 'mean', 'std' (i=cluster, j=bin),
+              'max_z' (i=iteration) null distribution of the largest z-score, 'iterations'
+    """
+    real_ar = np.asarray(real_ar, dtype=float)
+    # pass 1: moments
+    n = 0
+    sum_ar = np.zeros(real_ar.shape)
+    sumsq_ar = np.zeros(real_ar.shape)
+    for chunk in iter_chunks(surrogate, chunk_size):
+        chunk = np.asarray(chunk, dtype=float)
+        n += chunk.shape[2]
+        sum_ar += chunk.sum(axis=2)
+        sumsq_ar += (chunk**2).sum(axis=2)
+    mean_ar = sum_ar/n
+    std_ar = np.sqrt(np.maximum(sumsq_ar/n - mean_ar**2, 0))
+    # constant surrogate bins: any difference is infinitely large, no difference is 0
+    safe_std = np.where(std_ar > 0, std_ar, 1.0)
+
+    def stat(counts, mean, std, const):
+        z = (counts-mean)/std
+        z = np.where(const, np.sign(counts-mean)*np.inf, z)
+        z = np.nan_to_num(z, nan=0.0, posinf=np.inf, neginf=-np.inf)
+        if tail == 'greater':
+            return z
+        if tail == 'less':
+            return -z
+        return np.abs(z)
+
+    const = std_ar == 0
+    z_ar = (real_ar-mean_ar)/safe_std
+    real_stat = stat(real_ar, mean_ar, safe_std, const)
+
+    # pass 2: exceedances and max statistics
+    n_ge = np.zeros(real_ar.shape, dtype=np.int64)
+    n_ge_bins = np.zeros(real_ar.shape, dtype=np.int64)
+    max_li = []
+    for chunk in iter_chunks(surrogate, chunk_size):
+        chunk = np.asarray(chunk, dtype=float)
+        surrogate_stat = stat(chunk, mean_ar[:, :, None], safe_std[:, :, None], const[:, :, None] & (chunk != mean_ar[:, :, None]))
+        n_ge += (surrogate_stat >= real_stat[:, :, None]).sum(axis=2)
+        max_bins = surrogate_stat.max(axis=1)
+        n_ge_bins += (max_bins[:, None, :] >= real_stat[:, :, None]).sum(axis=2)
+        max_li.append(max_bins.max(axis=0))
+    max_ar = np.concatenate(max_li)
+    n_ge_all = n - np.searchsorted(np.sort(max_ar), real_stat, side='left')
+
+    return {
+        'p': (n_ge+1)/(n+1),
+        'z': np.where(const, 0.0, z_ar),
+        'p_fwer_bins': (n_ge_bins+1)/(n+1),
+        'p_fwer': (n_ge_all+1)/(n+1),
+        'mean': mean_ar,
+        'std': std_ar,
+        'max_z': max_ar,
+        'iterations': n,
+    }
+
+
+# surrogate spike buffers ====================================================================================================
+def tile_spike_buffer(spikes_ar, offsets_ar, n):
+    """n copies of a flat spike buffer, copy k of cluster i is cluster k*n_clusters+i
+
+    Returns:
+        tuple: (spikes_ar, offsets_ar)
+    """
+    total = offsets_ar[-1]
+    tiled_offsets = (offsets_ar[None, :-1] + total*np.arange(n, dtype=np.int64)[:, None]).ravel()
+    return np.tile(spikes_ar, n), np.append(tiled_offsets, n*total)
+
+
+def jitter_spike_buffer(spikes_ar, offsets_ar, jitter, rng):
+    """every spike moved by a uniform random integer in [-jitter, jitter], sorted again within each cluster
+
+    Args:
+        spikes_ar (np ar): flat spike buffer, sorted within each cluster
+        offsets_ar (np ar): cluster i = spikes_ar[offsets_ar[i]:offsets_ar[i+1]]
+        jitter (int): max shift in sampling points
+        rng (np.random.Generator): random generator
+
+    Returns:
+        np ar: jittered flat spike buffer, same offsets_ar
+    """
+    cluster_ar = np.repeat(np.arange(offsets_ar.size-1, dtype=np.int64), np.diff(offsets_ar))
+    span = int(spikes_ar.max(initial=0))+jitter+2
+    jittered = np.maximum(spikes_ar + rng.integers(-jitter, jitter+1, size=spikes_ar.size), 0)
+    return np.sort(cluster_ar*span + jittered) - cluster_ar*span
+
+
+def shuffle_isi_buffer(spikes_ar, offsets_ar, bounds_ar, rng):
+    """inter spike intervals shuffled within each cluster and segment
+
+    the first and last spike and the spike count of every (cluster, segment) stay the same,
+    spikes outside of all segments are not changed
+
+    Args:
+        spikes_ar (np ar): flat spike buffer, sorted within each cluster
+        offsets_ar (np ar): cluster i = spikes_ar[offsets_ar[i]:offsets_ar[i+1]]
+        bounds_ar (np ar): sorted, non overlapping segments (i=segment, j=[start, end)), e.g. trials
+        rng (np.random.Generator): random generator
+
+    Returns:
+        np ar: shuffled flat spike buffer, same offsets_ar
+    """
+    n_segments = bounds_ar.shape[0]
+    cluster_ar = np.repeat(np.arange(offsets_ar.size-1, dtype=np.int64), np.diff(offsets_ar))
+    segment_ar = np.searchsorted(bounds_ar[:, 0], spikes_ar, side='right')-1
+    inside = (segment_ar >= 0) & (spikes_ar < bounds_ar[np.maximum(segment_ar, 0), 1])
+    key_ar = np.where(inside, cluster_ar*n_segments + segment_ar, -1)
+
+    # anchors keep their time: spikes outside of segments and the first spike of every (cluster, segment)
+    anchor = ~inside
+    anchor[0:1] = True
+    anchor[1:] |= key_ar[1:] != key_ar[:-1]
+    isi_ar = np.diff(spikes_ar, prepend=0)
+    isi_ar[anchor] = 0
+    # random order of the intervals within each (cluster, segment)
+    movable = np.flatnonzero(~anchor)
+    isi_ar[movable] = isi_ar[movable[np.argsort(key_ar[movable] + rng.random(movable.size))]]
+
+    cumsum_ar = np.cumsum(isi_ar)
+    anchor_idx = np.maximum.accumulate(np.where(anchor, np.arange(spikes_ar.size), 0))
+    return spikes_ar[anchor_idx] + cumsum_ar - cumsum_ar[anchor_idx]
+
+
 # class ###################################################################################################################
 class SpikesSDA():
     def __init__(self, spikes_obj):
@@ -110,12 +268,14 @@ class SpikesSDA():
 
         self.all_trials_df = spikes_obj.all_trials_df
         self.good_trials_df = spikes_obj.good_trials_df
-        self.selected_trials_df = spikes_obj.selected_trials_df
         self.skip_clusters = spikes_obj.skip_clusters
         self.spikes_df = spikes_obj.spikes_df
         self.clusters_df = spikes_obj.clusters_df
-        
-        self.spikes_per_trial_ar = spikes_obj.spikes_per_trial_ar
+
+        # spike buffer, psth cubes, spikes per trial and the current selection live in the SpikesEDA object, the surrogate tests
+        # read them on every call so set_selection of spikes_obj applies
+        self.spikes_obj = spikes_obj
+        self.test_dict = dict()
 
         #self.randomized_bins_ar = self.get_randomized_samples(200, 1000)
 
@@ -148,11 +308,15 @@ class SpikesSDA():
         Returns:
             np ar: array with spike counts for i=clusters, j=trials, k=iterations, data = spike times
         """
+        # current selection of spikes_obj, same trials as iter_null_chunks
+        spikes_per_trial_ar = self.spikes_obj.spikes_per_trial_ar
+        trials_df = self.spikes_obj.selected_trials_df
+
         # initialize data array 
         #y=clusters
-        y=self.spikes_per_trial_ar.shape[0]
+        y=spikes_per_trial_ar.shape[0]
         #x=trials
-        x=self.spikes_per_trial_ar.shape[1]
+        x=spikes_per_trial_ar.shape[1]
         #z=random_events 
         z=iterations
 
@@ -165,14 +329,390 @@ class SpikesSDA():
         #### create random start point array for all trials 
         # random ar
         random_ar = np.zeros(shape=(x,z),dtype=int)
-        random_ar = create_random_start(x,z, self.selected_trials_df, delta)
+        random_ar = create_random_start(x,z, trials_df['start'].values.astype(np.int64), trials_df['end'].values.astype(np.int64), delta)
 
         #get spikes for all clusters
         for i in range(y):
-            data_ar[i,:,:]=get_random_range_spikes_all_trials(self.spikes_per_trial_ar[i], random_ar)
+            spiketimes_li = get_random_range_spikes_all_trials(spikes_per_trial_ar[i], random_ar, delta)
+            for j in range(x):
+                for k in range(z):
+                    data_ar[i,j,k]=spiketimes_li[j][k]
 
         return data_ar
 
+    def get_random_centers(self, window, iterations, seed=None, trials_mask=None):
+        """random window centers within selected trials, window stays inside the trial
+
+        Args:
+            window (int): 1/2 window width in ms
+            iterations (int): number of random windows per trial
+            seed (int, optional): random seed. Defaults to None.
+            trials_mask (np ar, optional): bool mask over selected trials. Defaults to all selected trials.
+
+        Returns:
+            np ar: int64 array (i=trial, j=iteration) in sampling points
+        """
+        delta = window*20
+        starts = self.spikes_obj.selected_trials_df['start'].values.astype(np.int64)
+        ends = self.spikes_obj.selected_trials_df['end'].values.astype(np.int64)
+        if trials_mask is not None:
+            starts, ends = starts[trials_mask], ends[trials_mask]
+        if np.any(ends-starts <= 2*delta):
+            raise ValueError(f"window of +/-{window}ms does not fit into {(ends-starts <= 2*delta).sum()} selected trials")
+        rng = np.random.default_rng(seed)
+        return rng.integers((starts+delta)[:, None], (ends-delta)[:, None], size=(starts.shape[0], iterations))
+
+    def iter_surrogate_chunks(self, window, iterations, n_bins=60, chunk_size=None, seed=0, neuron_idx=None, trials_mask=None):
+        """surrogate count cube in iteration chunks, same seed gives the same chunks
+
+        Args:
+            window (int): 1/2 window width in ms
+            iterations (int): number of random windows per trial
+            n_bins (int, optional): number of bins over the whole window. Defaults to 60.
+            chunk_size (int, optional): iterations per chunk. Defaults to ~20M searchsorted points.
+            seed (int, optional): random seed. Defaults to 0.
+            neuron_idx (np ar, optional): only these good clusters. Defaults to all good clusters.
+            trials_mask (np ar, optional): bool mask over selected trials. Defaults to all selected trials.
+
+        Returns:
+            iterator: int32 arrays (i=good cluster, j=bin, k=iteration of chunk), counts summed over selected trials
+        """
+        centers = self.get_random_centers(window, iterations, seed, trials_mask)
+        edges = self.spikes_obj.get_psth_edges(window, n_bins)
+        n_clusters = self.spikes_obj.spikes_offsets_ar.size-1 if neuron_idx is None else len(neuron_idx)
+        if chunk_size is None:
+            chunk_size = max(1, int(2e7//max(1, n_clusters*centers.shape[0]*(n_bins+1))))
+        for k in range(0, iterations, chunk_size):
+            times = centers[:, k:k+chunk_size, None] + edges[None, None, :]
+            counts = np.diff(self.spikes_obj.get_spike_idx(times, neuron_idx), axis=3).sum(axis=1)
+            yield counts.transpose(0, 2, 1).astype(np.int32)
+
+    def gen_surrogate_cube(self, window, iterations, n_bins=60, chunk_size=None, seed=0, trials_mask=None):
+        """surrogate count cube (i=good cluster, j=bin, k=iteration), same bins as SpikesEDA.gen_psth_cube"""
+        return np.concatenate(list(self.iter_surrogate_chunks(window, iterations, n_bins, chunk_size, seed, trials_mask=trials_mask)), axis=2)
+
+    def get_event_counts(self, event, window, n_bins=60, trials_mask=None):
+        """real spike counts around event summed over selected trials (i=good cluster, j=bin)"""
+        cube = self.spikes_obj.gen_psth_cube(event, window, n_bins)
+        if trials_mask is not None:
+            cube = cube[:, trials_mask, :]
+        return cube.sum(axis=1)
+
+    def iter_null_chunks(self, event, window, iterations, n_bins=60, null='window', jitter=10, trials_mask=None, chunk_size=None, seed=0):
+        """surrogate count cube of an alternative null model in iteration chunks, same seed gives the same chunks
+
+        null models:
+            'window': random windows of the same trials, see iter_surrogate_chunks
+            'trial': event counts of random trial subsets with the size of trials_mask (trial label shuffling)
+            'isi': event counts with inter spike intervals shuffled within every cluster and selected trial
+            'jitter': event counts with every spike moved by a random shift within +/-jitter ms
+
+        Args:
+            event (str): trial event, column of selected_trials_df
+            window (int): 1/2 window width in ms
+            iterations (int): number of surrogates
+            n_bins (int, optional): number of bins over the whole window. Defaults to 60.
+            null (str, optional): 'window', 'trial', 'isi' or 'jitter'. Defaults to 'window'.
+            jitter (int, optional): max spike shift in ms for 'jitter'. Defaults to 10.
+            trials_mask (np ar, optional): bool mask over selected trials, required for 'trial'. Defaults to all selected trials.
+            chunk_size (int, optional): iterations per chunk. Defaults to ~20M values per chunk.
+            seed (int, optional): random seed. Defaults to 0.
+
+        Returns:
+            iterator: int32 arrays (i=good cluster, j=bin, k=iteration of chunk), counts summed over the trials of trials_mask
+        """
+        if null == 'window':
+            yield from self.iter_surrogate_chunks(window, iterations, n_bins, chunk_size, seed, trials_mask=trials_mask)
+            return
+        if null not in ('trial', 'isi', 'jitter'):
+            raise ValueError(f"unknown null '{null}', use 'window', 'trial', 'isi' or 'jitter'")
+
+        n_trials = self.spikes_obj.selected_trials_df.shape[0]
+        mask = np.ones(n_trials, dtype=bool) if trials_mask is None else np.asarray(trials_mask, dtype=bool)
+        rng = np.random.default_rng(seed)
+        n_clusters = self.spikes_obj.spikes_offsets_ar.size-1
+
+        if null == 'trial':
+            if mask.all():
+                raise ValueError("trial label shuffling needs a trials_mask with a subset of the selected trials")
+            cube = self.spikes_obj.gen_psth_cube(event, window, n_bins).astype(np.float32)
+            if chunk_size is None:
+                chunk_size = max(1, int(2e7//max(1, n_trials*(n_clusters*n_bins+1))))
+            for k in range(0, iterations, chunk_size):
+                n = min(chunk_size, iterations-k)
+                # random subsets of the same size: the mask.sum() trials with the smallest random keys
+                ranks = rng.random((n_trials, n)).argsort(axis=0).argsort(axis=0)
+                labels = (ranks < mask.sum()).astype(np.float32)
+                yield np.einsum('ctb,tk->cbk', cube, labels).round().astype(np.int32)
+            return
+
+        # surrogate buffers only need the spikes around the events
+        edges = self.spikes_obj.get_psth_edges(window, n_bins)
+        times = self.spikes_obj.selected_trials_df[event].values.astype(np.int64)[mask, None] + edges[None, :]
+        shift = jitter*20 if null == 'jitter' else 0
+        spikes_ar, offsets_ar = self.spikes_obj.get_spike_buffer_range(times.min()-shift, times.max()+shift)
+        if null == 'isi':
+            # segments are all selected trials, so that surrogate windows beyond the trial see shuffled spikes too
+            bounds_ar = self.spikes_obj.selected_trials_df[['start', 'end']].values.astype(np.int64)
+            spikes_ar, offsets_ar = self.spikes_obj.get_spike_buffer_range(
+                min(times.min(), bounds_ar[:, 0].min()), max(times.max(), bounds_ar[:, 1].max()))
+        span = int(max(spikes_ar.max(initial=0), times.max()))+shift+2
+        if chunk_size is None:
+            chunk_size = max(1, int(2e7//max(1, spikes_ar.size, n_clusters*times.size)))
+        for k in range(0, iterations, chunk_size):
+            n = min(chunk_size, iterations-k)
+            # n copies of the buffer are one buffer with n*n_clusters clusters
+            tiled_ar, tiled_offsets = tile_spike_buffer(spikes_ar, offsets_ar, n)
+            if null == 'jitter':
+                tiled_ar = jitter_spike_buffer(tiled_ar, tiled_offsets, shift, rng)
+            else:
+                tiled_ar = shuffle_isi_buffer(tiled_ar, tiled_offsets, bounds_ar, rng)
+            counts = np.diff(search_spike_buffer(tiled_ar, tiled_offsets, times, span), axis=2).sum(axis=1)
+            yield counts.reshape(n, n_clusters, n_bins).transpose(1, 2, 0).astype(np.int32)
+
+    def test_event(self, event, window, iterations=1000, n_bins=60, tail='greater', chunk_size=None, seed=0,
+                   null='window', jitter=10, trials_mask=None):
+        """test event aligned counts against a surrogate null model, cached in test_dict
+
+        Args:
+            event (str): trial event, column of selected_trials_df
+            window (int): 1/2 window width in ms
+            iterations (int, optional): number of surrogates. Defaults to 1000.
+            n_bins (int, optional): number of bins over the whole window. Defaults to 60.
+            tail (str, optional): 'greater', 'less' or 'two-sided'. Defaults to 'greater'.
+            chunk_size (int, optional): iterations per surrogate chunk. Defaults to None.
+            seed (int, optional): random seed. Defaults to 0.
+            null (str, optional): 'window', 'trial', 'isi' or 'jitter', see iter_null_chunks. Defaults to 'window'.
+            jitter (int, optional): max spike shift in ms for 'jitter'. Defaults to 10.
+            trials_mask (np ar, optional): bool mask over selected trials, e.g. from SpikesEDA.get_trial_mask. Defaults to None.
+
+        Returns:
+            dict: surrogate_test output + 'edges' in ms and 'summary_df' with one row per good cluster
+        """
+        mask_key = None if trials_mask is None else np.asarray(trials_mask, dtype=bool).tobytes()
+        key = (event, window, iterations, n_bins, tail, seed, null, jitter if null == 'jitter' else None,
+               self.spikes_obj.select_ar.tobytes(), mask_key)
+        if key not in self.test_dict:
+            real_ar = self.get_event_counts(event, window, n_bins, trials_mask)
+            surrogate = lambda: self.iter_null_chunks(event, window, iterations, n_bins, null, jitter, trials_mask, chunk_size, seed)
+            result = surrogate_test(real_ar, surrogate, tail=tail)
+            result['edges'] = self.spikes_obj.get_psth_edges(window, n_bins)/20
+            result['summary_df'] = self.get_test_summary(result, tail)
+            self.test_dict[key] = result
+        return self.test_dict[key]
+
+    def get_test_summary(self, result, tail='greater'):
+        """one row per good cluster with the smallest p-values and the largest z-score of a surrogate_test result"""
+        return pd.DataFrame({
+            'min_p': result['p'].min(axis=1),
+            'min_p_fwer_bins': result['p_fwer_bins'].min(axis=1),
+            'min_p_fwer': result['p_fwer'].min(axis=1),
+            'max_z': result['z'].max(axis=1) if tail != 'less' else result['z'].min(axis=1),
+        }, index=self.clusters_df.loc[self.clusters_df['group']=='good'].index)
+
+    def compare_nulls(self, event, window, nulls=['window', 'isi', 'jitter'], iterations=1000, n_bins=60, tail='greater',
+                      jitter=10, trials_mask=None, seed=0):
+        """test_event of the same event and clusters under several null models
+
+        Returns:
+            pd.DataFrame: one row per good cluster, columns (summary column, null)
+        """
+        summary = {null: self.test_event(event, window, iterations, n_bins, tail, seed=seed, null=null,
+                                         jitter=jitter, trials_mask=trials_mask)['summary_df'] for null in nulls}
+        return pd.concat(summary, axis=1).swaplevel(axis=1).sort_index(axis=1, level=0, sort_remaining=False)
+
+
+    def get_trial_rates(self):
+        """spike rate of each good cluster in each selected trial
+
+        Returns:
+            tuple: (n_spikes (i=good cluster, j=trial), trial length in sampling points (j=trial))
+        """
+        starts = self.spikes_obj.selected_trials_df['start'].values.astype(np.int64)
+        ends = self.spikes_obj.selected_trials_df['end'].values.astype(np.int64)
+        idx = self.spikes_obj.get_spike_idx(np.stack([starts, ends], axis=1))
+        return idx[:, :, 1]-idx[:, :, 0], ends-starts
+
+    def get_expected_counts(self, window, n_bins=60):
+        """expected count per bin summed over selected trials from the rate of each cluster in each trial
+
+        Returns:
+            np ar: (i=good cluster, j=bin)
+        """
+        n_spikes, length = self.get_trial_rates()
+        width = np.diff(self.spikes_obj.get_psth_edges(window, n_bins))
+        return (n_spikes/length[None, :]).sum(axis=1)[:, None]*width[None, :]
+
+    def analytic_test(self, event, window, n_bins=60, null='poisson', tail='greater'):
+        """exact tail probabilities of event aligned counts under an analytic null, no surrogates
+
+        the count of a bin summed over trials is Poisson with the expected count of get_expected_counts,
+        or binomial with all spikes of the selected trials and the same mean ('binomial')
+
+        Args:
+            event (str): trial event, column of selected_trials_df
+            window (int): 1/2 window width in ms
+            n_bins (int, optional): number of bins over the whole window. Defaults to 60.
+            null (str, optional): 'poisson' or 'binomial'. Defaults to 'poisson'.
+            tail (str, optional): 'greater', 'less' or 'two-sided'. Defaults to 'greater'.
+
+        Returns:
+            dict: 'p', 'p_bonferroni', 'z', 'expected', 'counts' (i=good cluster, j=bin)
+        """
+        counts = self.get_event_counts(event, window, n_bins)
+        expected = self.get_expected_counts(window, n_bins)
+        if null == 'poisson':
+            dist = st.poisson(expected)
+            var = expected
+        elif null == 'binomial':
+            n = np.broadcast_to(self.get_trial_rates()[0].sum(axis=1)[:, None], expected.shape)
+            prob = np.where(n > 0, expected/np.maximum(n, 1), 0.0)
+            dist = st.binom(n, prob)
+            var = n*prob*(1-prob)
+        else:
+            raise ValueError(f"unknown null '{null}', use 'poisson' or 'binomial'")
+
+        greater = dist.sf(counts-1)
+        less = dist.cdf(counts)
+        if tail == 'greater':
+            p = greater
+        elif tail == 'less':
+            p = less
+        else:
+            p = np.minimum(1.0, 2*np.minimum(greater, less))
+        return {
+            'p': p,
+            'p_bonferroni': np.minimum(1.0, p*p.size),
+            'z': (counts-expected)/np.sqrt(np.where(var > 0, var, 1.0)),
+            'expected': expected,
+            'counts': counts,
+        }
+
+    def validate_analytic_null(self, window, iterations=1000, n_bins=60, null='poisson', fano_tol=0.2, seed=0):
+        """compare analytic null with random window surrogates of the same trials
+
+        the analytic null can replace surrogates for a cluster when the surrogate counts have the analytic mean
+        and variance (fano factor ~ 1 for poisson) and the tail probabilities of surrogate counts agree
+
+        Args:
+            window (int): 1/2 window width in ms
+            iterations (int, optional): surrogate iterations. Defaults to 1000.
+            n_bins (int, optional): number of bins over the whole window. Defaults to 60.
+            null (str, optional): 'poisson' or 'binomial'. Defaults to 'poisson'.
+            fano_tol (float, optional): max deviation of variance / analytic variance from 1. Defaults to 0.2.
+            seed (int, optional): random seed. Defaults to 0.
+
+        Returns:
+            pd.DataFrame: one row per good cluster, columns ['expected', 'mc_mean', 'variance_ratio',
+                'p95_analytic', 'p95_mc', 'max_tail_diff', 'analytic_ok']
+        """
+        expected = self.get_expected_counts(window, n_bins)
+        cube = self.gen_surrogate_cube(window, iterations, n_bins, seed=seed).astype(float)
+        mc_mean = cube.mean(axis=2)
+        mc_var = cube.var(axis=2)
+        if null == 'binomial':
+            n = self.get_trial_rates()[0].sum(axis=1)[:, None]
+            var = expected*(1-np.where(n > 0, expected/np.maximum(n, 1), 0.0))
+            dist = st.binom(np.broadcast_to(n, expected.shape), np.where(n > 0, expected/np.maximum(n, 1), 0.0))
+        else:
+            var = expected
+            dist = st.poisson(expected)
+        ratio = np.where(var > 0, mc_var/np.where(var > 0, var, 1.0), 1.0)
+
+        # tail probability of the analytic null at the surrogate 95th percentile should be ~0.05
+        mc_p95 = np.percentile(cube, 95, axis=2)
+        tail = dist.sf(mc_p95-1)
+        # empirical tail of the same counts
+        mc_tail = (cube >= mc_p95[:, :, None]).mean(axis=2)
+        max_tail_diff = np.abs(tail-mc_tail).max(axis=1)
+
+        validate_df = pd.DataFrame({
+            'expected': expected.mean(axis=1),
+            'mc_mean': mc_mean.mean(axis=1),
+            'variance_ratio': ratio.mean(axis=1),
+            'p95_analytic': dist.ppf(0.95).mean(axis=1),
+            'p95_mc': mc_p95.mean(axis=1),
+            'max_tail_diff': max_tail_diff,
+        }, index=self.clusters_df.loc[self.clusters_df['group']=='good'].index)
+        validate_df['analytic_ok'] = (np.abs(validate_df['variance_ratio']-1) < fano_tol) & \
+                                     (np.abs(validate_df['mc_mean']/validate_df['expected'].where(validate_df['expected'] > 0)-1) < fano_tol)
+        return validate_df
+
+    def get_max_statistic(self, counts, expected, tail='greater'):
+        """largest poisson standardized count over bins, (counts-expected)/sqrt(expected)
+
+        Args:
+            counts (np ar): (i=cluster, j=bin, ...)
+            expected (np ar): (i=cluster, j=bin)
+            tail (str, optional): 'greater', 'less' or 'two-sided'. Defaults to 'greater'.
+
+        Returns:
+            np ar: (i=cluster, ...)
+        """
+        expected = expected.reshape(expected.shape+(1,)*(counts.ndim-2))
+        z = (counts-expected)/np.sqrt(np.where(expected > 0, expected, 1.0))
+        if tail == 'less':
+            z = -z
+        elif tail == 'two-sided':
+            z = np.abs(z)
+        return z.max(axis=1)
+
+    def sequential_test(self, event, window, alpha=0.05, batch=100, min_iterations=100, max_iterations=10000,
+                        confidence=0.999, n_bins=60, tail='greater', seed=0):
+        """surrogate test with early stopping, only clusters with undecided p-value get more surrogates
+
+        every cluster is tested with its max statistic over bins (see get_max_statistic), a cluster stops when the
+        Clopper-Pearson interval of its p-value is completely below or above alpha
+
+        Args:
+            event (str): trial event, column of selected_trials_df
+            window (int): 1/2 window width in ms
+            alpha (float, optional): significance level. Defaults to 0.05.
+            batch (int, optional): surrogate iterations per batch. Defaults to 100.
+            min_iterations (int, optional): iterations before the first stop. Defaults to 100.
+            max_iterations (int, optional): max iterations per cluster. Defaults to 10000.
+            confidence (float, optional): confidence of the p-value interval. Defaults to 0.999.
+            n_bins (int, optional): number of bins over the whole window. Defaults to 60.
+            tail (str, optional): 'greater', 'less' or 'two-sided'. Defaults to 'greater'.
+            seed (int, optional): random seed. Defaults to 0.
+
+        Returns:
+            pd.DataFrame: one row per good cluster, columns ['statistic', 'exceed', 'iterations', 'p', 'p_low', 'p_high', 'decision']
+        """
+        expected = self.get_expected_counts(window, n_bins)
+        statistic = self.get_max_statistic(self.get_event_counts(event, window, n_bins), expected, tail)
+        n_clusters = statistic.shape[0]
+        exceed = np.zeros(n_clusters, dtype=np.int64)
+        iterations = np.zeros(n_clusters, dtype=np.int64)
+        p_low = np.zeros(n_clusters)
+        p_high = np.ones(n_clusters)
+        active = np.arange(n_clusters)
+
+        rng = np.random.default_rng(seed)
+        while active.shape[0] > 0:
+            chunk = next(self.iter_surrogate_chunks(window, batch, n_bins, chunk_size=batch, seed=rng.integers(2**32), neuron_idx=active))
+            surrogate_stat = self.get_max_statistic(chunk, expected[active], tail)
+            exceed[active] += (surrogate_stat >= statistic[active, None]).sum(axis=1)
+            iterations[active] += batch
+
+            # clopper-pearson interval of the p-value
+            k, n = exceed[active], iterations[active]
+            p_low[active] = np.where(k > 0, st.beta.ppf((1-confidence)/2, k, n-k+1), 0.0)
+            p_high[active] = np.where(k < n, st.beta.ppf(1-(1-confidence)/2, k+1, n-k), 1.0)
+            decided = (n >= min_iterations) & ((p_high[active] < alpha) | (p_low[active] > alpha))
+            active = active[~decided & (n < max_iterations)]
+
+        decision = np.where(p_high < alpha, 'significant', np.where(p_low > alpha, 'not significant', 'undecided'))
+        return pd.DataFrame({
+            'statistic': statistic,
+            'exceed': exceed,
+            'iterations': iterations,
+            'p': (exceed+1)/(iterations+1),
+            'p_low': p_low,
+            'p_high': p_high,
+            'decision': decision,
+        }, index=self.clusters_df.loc[self.clusters_df['group']=='good'].index)
+
 
 
  #Ploting statistical analysis ============================================================================================
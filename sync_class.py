@@ -9,10 +9,168 @@ import sys
 import platform
 import datetime
 
+# numba helper functions
+from numba import njit
+
+# sentinel for missing sampling point times in the trial tables (e.g. wheel not stopping trials)
+MISSING = -1
+
+# categories of the trial 'event' column
+TRIAL_EVENTS = ['right_rw', 'right_norw', 'left_rw', 'left_norw', 'no response in time', 'wheel not stopping']
+
+# dtype of structured trial arrays, see trials_to_array
+TRIAL_DTYPE = np.dtype([
+    ('index_all_trials', np.int64), ('index_good_trials', np.int64),
+    ('start', np.int64), ('cue', np.int64), ('sound', np.int64), ('openloop', np.int64),
+    ('reward', np.int64), ('iti', np.int64), ('end', np.int64),
+    ('event', np.int8), ('probability', np.float32), ('block', np.int16), ('length', np.int64), ('length_ms', np.float32),
+    ('select', np.bool_), ('right', np.bool_), ('left', np.bool_), ('reward_given', np.bool_), ('good', np.bool_),
+])
+
+
+# phenosys block labels that are not label digits / 100
+PROBABILITY_LABELS = {'prob12': 0.125}
+
+
+def parse_probability(labels):
+    """probability of phenosys block labels, 'prob75' -> 0.75, 'prob12' -> 0.125
+
+    Args:
+        labels (np ar): Probability column of output.csv
+
+    Returns:
+        np ar: float probability, nan for rows without label
+    """
+    labels = pd.Series(labels, dtype=object)
+    probability = labels.str.extract(r'(prob\d+)', expand=False)
+    return np.where(probability.isin(PROBABILITY_LABELS.keys()),
+                    probability.map(PROBABILITY_LABELS),
+                    probability.str[4:].astype(float)/100).astype(float)
+
+
+def get_blocks(values):
+    """run length encoded blocks of a column, e.g. probability of trials
+
+    Args:
+        values (np ar): block value per row
+
+    Returns:
+        tuple: (starts, stops, block values) np ar, row positions with stops exclusive
+    """
+    values = np.asarray(values)
+    change = np.flatnonzero(values[1:] != values[:-1]) + 1
+    starts = np.insert(change, 0, 0) if values.shape[0] > 0 else change
+    stops = np.append(change, values.shape[0]) if values.shape[0] > 0 else change
+    return starts, stops, values[starts]
+
+
+def trials_to_array(trials_df):
+    """structured numpy array of a trial table for numpy / numba kernels
+
+    Args:
+        trials_df (pd.DataFrame): all_trials_df, good_trials_df or selected_trials_df
+
+    Returns:
+        np ar: structured array with TRIAL_DTYPE, event as category code of TRIAL_EVENTS
+    """
+    df = trials_df.reset_index()
+    trials_ar = np.zeros(df.shape[0], dtype=TRIAL_DTYPE)
+    for name in TRIAL_DTYPE.names:
+        if name == 'event':
+            trials_ar[name] = df[name].cat.codes.values
+        elif name in df.columns:
+            trials_ar[name] = df[name].values
+        else:
+            # columns not kept in this table, e.g. index_all_trials of good_trials_df
+            trials_ar[name] = MISSING
+    return trials_ar
+
+
+@njit()
+def banded_alignment(csv_codes, csv_times, ttl_codes, ttl_times, band, gap_cost, mismatch_cost, time_scale):
+    """edit distance alignment of csv and ttl event sequences, only cells with |j-i| <= band
+
+    cost of a match is mismatch_cost for different codes + timing cost min(|ttl_time-csv_time|/time_scale, 1)
+
+    Args:
+        csv_codes (np ar): int event codes of csv events
+        csv_times (np ar): csv times converted to ttl clock
+        ttl_codes (np ar): int event codes of ttl pulses
+        ttl_times (np ar): ttl times
+        band (int): max difference of csv and ttl position
+        gap_cost (float): cost of a missing or extra ttl pulse
+        mismatch_cost (float): cost of matching different event codes
+        time_scale (float): time difference in sampling points with timing cost 1
+
+    Returns:
+        tuple: (missing csv indices without ttl pulse, extra ttl indices without csv event, total cost)
+    """
+    n = csv_codes.shape[0]
+    m = ttl_codes.shape[0]
+    width = 2*band+1
+    # cell (i, j) stored at [i, j-i+band]
+    cost = np.full((n+1, width), np.inf)
+    move = np.zeros((n+1, width), dtype=np.int8)
+    cost[0, band] = 0.0
+    for i in range(n+1):
+        for k in range(width):
+            j = i+k-band
+            if j < 0 or j > m or (i == 0 and j == 0):
+                continue
+            best = np.inf
+            step = 0
+            # match (i-1, j-1)
+            if i > 0 and j > 0:
+                c = cost[i-1, k] + min(abs(ttl_times[j-1]-csv_times[i-1])/time_scale, 1.0)
+                if csv_codes[i-1] != ttl_codes[j-1]:
+                    c += mismatch_cost
+                if c < best:
+                    best = c
+                    step = 0
+            # missing ttl pulse (i-1, j)
+            if i > 0 and k+1 < width:
+                c = cost[i-1, k+1] + gap_cost
+                if c < best:
+                    best = c
+                    step = 1
+            # extra ttl pulse (i, j-1)
+            if j > 0 and k > 0:
+                c = cost[i, k-1] + gap_cost
+                if c < best:
+                    best = c
+                    step = 2
+            cost[i, k] = best
+            move[i, k] = step
+
+    missing = np.zeros(n, dtype=np.int64)
+    extra = np.zeros(m, dtype=np.int64)
+    n_missing = 0
+    n_extra = 0
+    i = n
+    j = m
+    total = cost[n, m-n+band] if abs(m-n) <= band else np.inf
+    if total == np.inf:
+        return missing[:0], extra[:0], total
+    while i > 0 or j > 0:
+        step = move[i, j-i+band]
+        if step == 0:
+            i -= 1
+            j -= 1
+        elif step == 1:
+            i -= 1
+            missing[n_missing] = i
+            n_missing += 1
+        else:
+            j -= 1
+            extra[n_extra] = j
+            n_extra += 1
+    return missing[:n_missing][::-1].copy(), extra[:n_extra][::-1].copy(), total
+
+
 class SyncPhenosys():
     """[# synchronisation class for Phenosys Behavior Recording and Neuron Electrophysiology Recording]
     """    
-    def __init__(self, session, folder, channel_no=6, info_channel=1, rows_missing_ttl=[]):
+    def __init__(self, session, folder, channel_no=6, info_channel=1, rows_missing_ttl=[], event_channels=None):
         """[summary]
 
         Args:
@@ -20,16 +178,26 @@ class SyncPhenosys():
             folder ([type]): [description]
             channel_no (int, optional): [description]. Defaults to 6.
             info_channel (int, optional): [description]in. Defaults to 1.
+            rows_missing_ttl (list, optional): csv rows without ttl pulse, 'clock' = find them with align_clocks,
+                'auto' = find them with find_missing_ttl. Defaults to [].
+                rows used by combine_dataframes are stored in rows_missing_ttl_found.
+            event_channels (dict, optional): {channel: duration dict or event name} decoded into ttl_events_df,
+                see decode_channels. Defaults to None (only info_channel).
         """        
         self.session = session
         self.folder = folder
         self.channel_no = channel_no
+        self.info_channel = info_channel
         self.ttl_channels = self.load_digitalin()
         self.ttl_signals = self.ttl_create_ticks()
         self.ttl_event_dict=self.create_dict()
         self.ttl_info_channel = self.convert_ttl_to_event('channel '+str(info_channel))
+        if event_channels is not None:
+            self.ttl_events_df = self.decode_channels(event_channels)
         self.csv = self.load_csv()
         self.rows_missing_ttl = rows_missing_ttl
+        # clock model of align_clocks, only with rows_missing_ttl='clock'
+        self.clock = None
         self.combined_df = self.combine_dataframes()
         self.all_trials_df, self.good_trials_df =  self.get_trials()
 
@@ -121,21 +289,116 @@ class SyncPhenosys():
         return self.ttl_signals[channel]
 
 
+    # multi channel decoding ======================
+    def ttl_find_pulses(self, binary, channels):
+        """pulse onsets and lengths for several channels from one pass over the digital in samples
+
+        only the samples where any channel changes are compared bit by bit
+
+        Args:
+            binary (np ar): uint16 digital in samples, one bit per channel
+            channels (list): channel numbers
+
+        Returns:
+            dict: {channel: (start np ar, length np ar)} in sampling points
+        """
+        change = np.flatnonzero(binary[1:] != binary[:-1]) + 1
+        after = binary[change]
+        before = binary[change-1]
+        pulses = dict()
+        for channel in channels:
+            bit = np.uint16(1 << channel)
+            high_after = (after & bit) > 0
+            high_before = (before & bit) > 0
+            rising = change[high_after & ~high_before]
+            falling = change[~high_after & high_before]
+            # pulse high at start or end of recording
+            if binary[0] & bit:
+                rising = np.insert(rising, 0, 0)
+            if binary[-1] & bit:
+                falling = np.append(falling, binary.shape[0])
+            pulses[channel] = (rising.astype(np.int64), (falling-rising).astype(np.int64))
+        return pulses
+
+    def convert_durations_to_events(self, lengths, durr_range):
+        """vectorized convert_durration_to_event for any duration dict
+
+        Args:
+            lengths (np ar): pulse lengths in sampling points
+            durr_range (dict): {event: (min, max)} inclusive, first match wins
+
+        Returns:
+            np ar: event names, None for lengths outside all ranges
+        """
+        events = np.full(lengths.shape[0], None, dtype=object)
+        for key, (start, stop) in reversed(list(durr_range.items())):
+            events[(lengths>=start) & (lengths<=stop)] = key
+        return events
+
+    def decode_channels(self, event_channels):
+        """decode pulses of several channels into one time sorted event table
+
+        Args:
+            event_channels (dict): {channel: durr_range} with a duration dict like create_dict,
+                or {channel: name} to name every pulse of the channel (lick, valve, camera frames)
+
+        Returns:
+            pd.DataFrame: columns ['Start', 'Length', 'Channel', 'Event'], sorted by Start
+        """
+        binary = np.memmap(self.folder+'/electrophysiology/digitalin.dat', dtype=np.uint16, mode='r')
+        pulses = self.ttl_find_pulses(binary, list(event_channels.keys()))
+
+        frames = []
+        for channel, decode in event_channels.items():
+            start, length = pulses[channel]
+            if isinstance(decode, dict):
+                events = self.convert_durations_to_events(length, decode)
+            else:
+                events = np.full(start.shape[0], decode, dtype=object)
+            frames.append(pd.DataFrame({'Start':start, 'Length':length, 'Channel':channel, 'Event':events}))
+
+        events_df = pd.concat(frames, ignore_index=True)
+        events_df['Channel'] = events_df['Channel'].astype(np.int8)
+        events_df['Event'] = events_df['Event'].astype('category')
+        events_df.sort_values(['Start', 'Channel'], kind='mergesort', inplace=True, ignore_index=True)
+        return events_df
+
+    def get_events_per_trial(self, events_df=None, trials_df=None):
+        """assign every event to the trial it falls in with one merge_asof on the trial start
+
+        Args:
+            events_df (pd.DataFrame, optional): from decode_channels. Defaults to self.ttl_events_df.
+            trials_df (pd.DataFrame, optional): trial table. Defaults to self.all_trials_df.
+
+        Returns:
+            pd.DataFrame: events_df with columns 'trial' (index of trials_df, MISSING outside trials)
+                and 'trial_time' (sampling points since trial start)
+        """
+        if events_df is None:
+            events_df = self.ttl_events_df
+        if trials_df is None:
+            trials_df = self.all_trials_df
+
+        # trial covers start to last ttl event, also for wheel not stopping trials
+        trials = pd.DataFrame({'trial':trials_df.index.values.astype(np.int64),
+                               'trial_start':trials_df['start'].values.astype(np.int64),
+                               'trial_stop':(trials_df['start']+trials_df['length']).values.astype(np.int64)})
+        trials.sort_values('trial_start', inplace=True)
+        merged = pd.merge_asof(events_df, trials, left_on='Start', right_on='trial_start', direction='backward')
+
+        inside = (merged['Start'] <= merged['trial_stop']).values
+        merged['trial'] = np.where(inside, merged['trial'].fillna(MISSING).values, MISSING).astype(np.int64)
+        merged['trial_time'] = np.where(inside, merged['Start'].values-merged['trial_start'].fillna(0).values, MISSING).astype(np.int64)
+        merged.drop(['trial_start', 'trial_stop'], axis=1, inplace=True)
+        return merged
+
+
  # Load & manipulate Neuron binary Data ====================================================================
     # convert to datetime format with ms
     def convert_to_datetime(self, excel_string):
         second = (excel_string-25569)*86400.0
         return datetime.datetime.utcfromtimestamp(second)
 
-    # find probability function
-    def match_probability(self, df, start, stop):
-        if "prob75" in (df.loc[stop]['Probability']):
-            df.loc[ start:stop, 'Probability' ] =0.75
-        elif "prob25" in (df.loc[stop]['Probability']):
-            df.loc[ start:stop, 'Probability' ] =0.25
-        elif "prob12" in (df.loc[stop]['Probability']):
-            df.loc[ start:stop, 'Probability' ] =0.125
-
     #load csv file======================
     def load_csv(self):
         csv_file = self.folder+'/behavior/output.csv'
@@ -161,27 +424,8 @@ class SyncPhenosys():
         csv.insert (1, 'Start', (delta.dt.total_seconds()*20000).astype('uint64') )
 
         # clean up proabability column =====
-        # calculate where prob changes
-        prob = csv.loc[csv['Probability'].notnull(),'Probability']
-        prob_change = np.where(prob.values[:-1] != prob.values[1:])[0]
-        prob_change_idx = prob.iloc[prob_change].index.values
-        prob_change_idx = np.append(prob_change_idx, prob.index[-1])
-        # change 3 bins probability to number
-        # change first bin
-        start = 0
-        stop = prob_change_idx[0]
-        self.match_probability(csv, start, stop)
-        # change second bin
-        start = prob_change_idx[0]+1
-        stop = prob_change_idx[1]
-        self.match_probability(csv, start, stop)
-        # change third bin
-        start = prob_change_idx[1]+1
-        stop = stop = prob_change_idx[2]
-        self.match_probability(csv, start, stop)
-        # add probability to last rows
-        nan = np.where(csv['Probability'].isnull())[0]
-        csv.loc[nan[0]:, 'Probability'] = csv.loc[nan[0]-1, 'Probability']
+        # rows without label belong to the next block, rows after the last label to the last block
+        csv['Probability'] = pd.Series(parse_probability(csv['Probability'].values)).bfill().ffill().values
 
         # cleanup event names
         # new names dict
@@ -232,20 +476,191 @@ class SyncPhenosys():
         # return the dataframe 
         return df 
 
+    # clock alignment ======================
+    def get_clock_knots(self, x, segment, min_points=4):
+        """knots of piecewise linear clock model, equally spaced, fewer if a segment has too few points
+
+        Args:
+            x (np ar): sorted csv times of matched events
+            segment (float): target segment length in sampling points
+            min_points (int, optional): minimal matched events per segment. Defaults to 4.
+
+        Returns:
+            np ar: knots in csv time
+        """
+        n_segments = max(1, int(np.ceil((x[-1]-x[0])/segment)))
+        while n_segments > 1:
+            knots = np.linspace(x[0], x[-1], n_segments+1)
+            if np.diff(np.searchsorted(x, knots[1:-1]), prepend=0, append=x.shape[0]).min() >= min_points:
+                return knots
+            n_segments -= 1
+        return np.array([x[0], x[-1]], dtype=float)
+
+    def clock_basis(self, knots, x):
+        """linear interpolation weights of x between knots (hat functions), linear extrapolation outside"""
+        idx = np.clip(np.searchsorted(knots, x, side='right')-1, 0, knots.shape[0]-2)
+        weight = (x-knots[idx])/(knots[idx+1]-knots[idx])
+        basis = np.zeros((x.shape[0], knots.shape[0]))
+        basis[np.arange(x.shape[0]), idx] = 1-weight
+        basis[np.arange(x.shape[0]), idx+1] = weight
+        return basis
+
+    def fit_clock(self, csv_times, ttl_times, segment):
+        """least squares piecewise linear model ttl = f(csv)
+
+        Args:
+            csv_times (np ar): csv times of matched events, sorted
+            ttl_times (np ar): ttl times of the same events
+            segment (float): segment length in sampling points
+
+        Returns:
+            tuple: (knots, values), ttl time at each knot
+        """
+        csv_times = csv_times.astype(float)
+        knots = self.get_clock_knots(csv_times, segment)
+        values = np.linalg.lstsq(self.clock_basis(knots, csv_times), ttl_times.astype(float), rcond=None)[0]
+        return knots, values
+
+    def apply_clock(self, clock, csv_times):
+        """ttl time for csv times from fit_clock model"""
+        knots, values = clock
+        return self.clock_basis(knots, np.asarray(csv_times, dtype=float)) @ values
+
+    def match_nearest(self, predicted, csv_events, ttl_times, ttl_events, tolerance):
+        """match every predicted time to the nearest ttl pulse with the same event, one to one
+
+        Args:
+            predicted (np ar): predicted ttl times of csv events
+            csv_events (np ar): csv event names
+            ttl_times (np ar): sorted ttl times
+            ttl_events (np ar): ttl event names
+            tolerance (float): max distance in sampling points
+
+        Returns:
+            np ar: index into ttl_times for each csv event, -1 if not matched
+        """
+        pos = np.clip(np.searchsorted(ttl_times, predicted), 1, ttl_times.shape[0]-1)
+        left = pos-1
+        nearest = np.where(np.abs(ttl_times[left]-predicted) <= np.abs(ttl_times[pos]-predicted), left, pos)
+        distance = np.abs(ttl_times[nearest]-predicted)
+        ok = (distance <= tolerance) & (ttl_events[nearest] == csv_events)
+
+        # one to one, closest csv event wins a ttl pulse
+        order = np.flatnonzero(ok)[np.argsort(distance[ok], kind='stable')]
+        _, first = np.unique(nearest[order], return_index=True)
+        match = np.full(predicted.shape[0], -1, dtype=np.int64)
+        match[order[first]] = nearest[order[first]]
+        return match
+
+    def align_clocks(self, tolerance_ms=50, segment_s=300, iterations=3):
+        """match csv task events to ttl pulses of info channel with a piecewise linear clock model
+
+        the offset is found from the first events, then model fit and nearest time matching are repeated.
+        dropped and extra ttl pulses are left unmatched.
+
+        Args:
+            tolerance_ms (int, optional): max distance of ttl pulse to model time in ms. Defaults to 50.
+            segment_s (int, optional): segment length of the clock model in seconds. Defaults to 300.
+            iterations (int, optional): fit / match iterations. Defaults to 3.
+
+        Returns:
+            pd.DataFrame: one row per csv task event, columns ['CSV Start', 'CSV Event', 'TTL index', 'TTL Start', 'Clock Start']
+                'TTL index' -1 if no pulse matched, also sets self.clock
+        """
+        ttl = self.ttl_signals['channel '+str(self.info_channel)]
+        ttl_times = ttl['Start'].values.astype(float)
+        ttl_events = ttl['Event'].values.astype(object)
+        csv = self.csv.loc[self.csv['Event'].isin(self.ttl_event_dict.keys())]
+        csv_times = csv['Start'].values.astype(float)
+        csv_events = csv['Event'].values.astype(object)
+        tolerance = tolerance_ms*20
+        segment = segment_s*20000
+
+        # offset with most matches among the first events
+        n = min(30, csv_times.shape[0], ttl_times.shape[0])
+        same = csv_events[:n,None] == ttl_events[None,:n]
+        offsets = (ttl_times[None,:n]-csv_times[:n,None])[same]
+        hits = [(self.match_nearest(csv_times[:n]+offset, csv_events[:n], ttl_times, ttl_events, tolerance) >= 0).sum() for offset in offsets]
+        clock = (np.array([csv_times[0], csv_times[0]+1.0]), np.array([0.0, 1.0])+csv_times[0]+offsets[int(np.argmax(hits))])
+
+        for _ in range(iterations):
+            match = self.match_nearest(self.apply_clock(clock, csv_times), csv_events, ttl_times, ttl_events, tolerance)
+            matched = match >= 0
+            clock = self.fit_clock(csv_times[matched], ttl_times[match[matched]], segment)
+        self.clock = clock
+        match = self.match_nearest(self.apply_clock(clock, csv_times), csv_events, ttl_times, ttl_events, tolerance)
+
+        aligned_df = pd.DataFrame({'CSV Start':csv_times.astype(np.int64), 'CSV Event':csv_events, 'TTL index':match})
+        aligned_df['TTL Start'] = np.where(match >= 0, ttl_times[match], np.nan)
+        aligned_df['Clock Start'] = self.apply_clock(clock, csv_times).round().astype(np.int64)
+        return aligned_df
+
+    def find_missing_ttl(self, band=50, gap_cost=1.0, mismatch_cost=3.0, time_scale_ms=1000):
+        """find dropped and extra ttl pulses with a banded alignment of csv and ttl event sequences
+
+        csv times are put on the ttl clock with a linear model from both sequences, the timing cost
+        separates equal event codes
+
+        Args:
+            band (int, optional): max number of dropped / extra pulses before a position. Defaults to 50.
+            gap_cost (float, optional): cost of a dropped or extra pulse. Defaults to 1.0.
+            mismatch_cost (float, optional): cost of matching different events. Defaults to 3.0.
+            time_scale_ms (int, optional): time difference with timing cost 1. Defaults to 1000.
+
+        Returns:
+            tuple: (rows_missing_ttl, extra ttl rows), rows_missing_ttl are insert positions for combine_dataframes
+        """
+        ttl = self.ttl_signals['channel '+str(self.info_channel)]
+        ttl_times = ttl['Start'].values.astype(float)
+        csv = self.csv.loc[self.csv['Event'].isin(self.ttl_event_dict.keys())]
+        csv_times = csv['Start'].values.astype(float)
+
+        # same codes for both sequences, unknown ttl lengths get their own code
+        names = list(self.ttl_event_dict.keys())
+        csv_codes = np.array([names.index(event) for event in csv['Event'].values], dtype=np.int64)
+        ttl_codes = np.array([names.index(event) if event in names else -1 for event in ttl['Event'].values], dtype=np.int64)
+
+        # linear clock from span and first events
+        slope = (ttl_times[-1]-ttl_times[0])/(csv_times[-1]-csv_times[0])
+        k = min(20, csv_times.shape[0], ttl_times.shape[0])
+        offset = np.median(ttl_times[:k]-slope*csv_times[:k])
+
+        missing, extra, total = banded_alignment(csv_codes, slope*csv_times+offset, ttl_codes, ttl_times,
+                                                 band, gap_cost, mismatch_cost, time_scale_ms*20)
+        if total == np.inf:
+            raise ValueError(f"csv ({csv_codes.shape[0]}) and ttl ({ttl_codes.shape[0]}) events differ by more than band={band}")
+        return [int(row) for row in missing], [int(row) for row in extra]
+
     # create combined dataframe
     def combine_dataframes(self, align=False):
 
-        ttl_combined = self.ttl_signals['channel 1'].copy()
+        ttl_combined = self.ttl_signals['channel '+str(self.info_channel)].copy()
         ttl_combined.columns=(['TTL Start', 'TTL Length', 'TTL Event'])
 
-        for row in self.rows_missing_ttl:
-            ttl_combined = self.insert_row(row, ttl_combined, np.nan, column='all')
+        # rows_missing_ttl is the mode given by the user, rows of this call go to rows_missing_ttl_found
+        self.rows_extra_ttl = []
+        if isinstance(self.rows_missing_ttl, str) and self.rows_missing_ttl == 'auto':
+            # remove extra pulses, insert nan rows for dropped pulses
+            self.rows_missing_ttl_found, self.rows_extra_ttl = self.find_missing_ttl()
+            ttl_combined = ttl_combined.drop(ttl_combined.index[self.rows_extra_ttl]).reset_index(drop=True)
+            for row in self.rows_missing_ttl_found:
+                ttl_combined = self.insert_row(row, ttl_combined, np.nan, column='all')
+        elif isinstance(self.rows_missing_ttl, str) and self.rows_missing_ttl == 'clock':
+            # ttl pulse matched to each csv row, nan rows for dropped pulses, extra pulses are removed
+            aligned_df = self.align_clocks()
+            match = aligned_df['TTL index'].values
+            ttl_combined = ttl_combined.iloc[np.where(match >= 0, match, 0)].reset_index(drop=True)
+            ttl_combined.loc[match < 0, :] = np.nan
+            self.rows_missing_ttl_found = [int(row) for row in np.flatnonzero(match < 0)]
+        else:
+            self.rows_missing_ttl_found = list(self.rows_missing_ttl)
+            for row in self.rows_missing_ttl_found:
+                ttl_combined = self.insert_row(row, ttl_combined, np.nan, column='all')
 
         ttl_combined.reset_index(inplace=True, drop=True)
-        ttl_combined['TTL Start norm'] = ttl_combined['TTL Start']-ttl_combined.loc[0, 'TTL Start']
         ttl_combined['TTL index']=ttl_combined.index
 
-        not_in_ttl = self.csv['Event'].unique()[~np.isin(self.csv['Event'].unique(), self.ttl_signals['channel 1']['Event'].unique())]
+        not_in_ttl = self.csv['Event'].unique()[~np.isin(self.csv['Event'].unique(), self.ttl_signals['channel '+str(self.info_channel)]['Event'].unique())]
         csv_combined = self.csv.loc[ (self.csv['Event']!=not_in_ttl[0]) & (self.csv['Event']!=not_in_ttl[1]) & (self.csv['Event']!=not_in_ttl[2]) ].copy()
         csv_combined.drop('Event Time', axis=1, inplace=True)
         csv_combined.columns=(['CSV Start', 'CSV Event', 'CSV Probability'])
@@ -253,6 +668,12 @@ class SyncPhenosys():
         csv_combined['CSV Start norm'] = csv_combined['CSV Start']-csv_combined.loc[0, 'CSV Start']
         csv_combined['CSV index']=csv_combined.index
 
+        # ttl normalized so that the first row with a matched pulse has the same norm time as its csv row
+        matched = np.flatnonzero(ttl_combined['TTL Start'].notna().values[:csv_combined.shape[0]])
+        first = matched[0] if matched.shape[0] > 0 else 0
+        ttl_combined['TTL Start norm'] = ttl_combined['TTL Start']-ttl_combined.loc[first, 'TTL Start']+csv_combined.loc[first, 'CSV Start norm']
+        ttl_combined = ttl_combined[['TTL Start', 'TTL Length', 'TTL Event', 'TTL Start norm', 'TTL index']]
+
         combined = pd.merge(ttl_combined, csv_combined, how='outer', left_index=True, right_index=True)
         combined['Delta (TTL-CSV)'] = combined['TTL Start norm']-combined['CSV Start norm']
         combined['Compare'] = combined['TTL Event']==combined['CSV Event']
@@ -376,21 +797,31 @@ class SyncPhenosys():
     # get trials
     # convert combined to trials including wheel not stopping
     def get_trials(self,incl_wheel_ns=True):
-        #fix combined
-        ttl_norm = self.combined_df.loc[pd.IndexSlice[0,:,:,0],'TTL Start'].values[0]-self.combined_df.loc[pd.IndexSlice[0,:,:,0],'CSV Start'].values[0]
-        current_delta = 0
-        for index, row in self.combined_df.iterrows():
-            # patch ttl missing values
-            if np.isnan(row['TTL Start']):
-                self.combined_df.loc[index,'TTL Start'] = row['CSV Start']+ttl_norm+current_delta
-            else:
-                current_delta = row['Delta (TTL-CSV)']
-
+        #fix combined, patch ttl missing values
+        missing = self.combined_df['TTL Start'].isnull().values
+        if self.clock is not None:
+            # from clock model of align_clocks
+            patch = self.apply_clock(self.clock, self.combined_df['CSV Start'].values[missing]).round()
+        else:
+            # with last seen delta, relative to the first row with a matched pulse (delta 0 there)
+            matched = ~missing & self.combined_df['CSV Start'].notna().values
+            ttl_norm = (self.combined_df['TTL Start'].values-self.combined_df['CSV Start'].values)[matched][0]
+            current_delta = self.combined_df['Delta (TTL-CSV)'].where(~missing).ffill().fillna(0).values
+            current_delta = np.where(missing, current_delta, 0)
+            patch = self.combined_df['CSV Start'].values[missing]+ttl_norm+current_delta[missing]
+        ttl_start = self.combined_df['TTL Start'].values.copy()
+        ttl_start[missing] = patch
+        self.combined_df['TTL Start'] = ttl_start
+
+
+        # collect columns, all times in sampling points, MISSING for events that did not happen
+        times_li = []
+        index_all_li = []
+        index_good_li = []
+        event_li = []
+        probability_li = []
+        length_li = []
 
-        trials_df = pd.DataFrame(columns=['index_all_trials','index_good_trials','start', 'cue', 'sound', 'openloop', 'reward', 'iti', 'end', 'event',
-                                'probability', 'length', 'select'])
-        trials_df['select']=True
-        
         # iterate overall grouped frames
         for group, frame in self.combined_df.groupby(level=0):
             ttl_start = frame['TTL Start'].values
@@ -401,51 +832,57 @@ class SyncPhenosys():
             
             if not np.isnan(index_good):
                 index_good = int(index_good)
+            else:
+                index_good = MISSING
 
             if ttl_start.shape[0]==7:
                 event  = frame.loc[pd.IndexSlice[:,:,:,4],'CSV Event'].values[0]
-                #times = [int(i) if not np.isnan(i) else i for i in ttl_start ] 
-                
                 
             elif ttl_start.shape[0]==2:
                 event = 'wheel not stopping'
-                times = times + [np.nan, np.nan, np.nan, np.nan, np.nan]
-                #csv_start = frame.loc[pd.IndexSlice[:,:,:,1],'CSV Start'].values[0]
-                #delta = frame.loc[pd.IndexSlice[:,:,:,0],'Delta (TTL-CSV)'].values[0]
-                #length = int(csv_start + delta)
+                times = times + [MISSING]*5
 
             probability = frame.loc[pd.IndexSlice[:,:,:,0],'CSV Probability'].values[0]
 
-            new_row = [index_all, index_good] + times + [event, probability, length, True]
-
-            trials_df.loc[trials_df.shape[0] + 1] = new_row
+            times_li.append(times)
+            index_all_li.append(index_all)
+            index_good_li.append(index_good)
+            event_li.append(event)
+            probability_li.append(probability)
+            length_li.append(length)
+
+        times_ar = np.array(times_li, dtype=np.int64).reshape(-1, 7)
+        trials_df = pd.DataFrame({'index_all_trials':np.array(index_all_li, dtype=np.int64),
+                                  'index_good_trials':np.array(index_good_li, dtype=np.int64)})
+        for i, column in enumerate(['start', 'cue', 'sound', 'openloop', 'reward', 'iti', 'end']):
+            trials_df[column] = times_ar[:, i]
+        trials_df['event'] = pd.Categorical(event_li, categories=TRIAL_EVENTS)
+        trials_df['probability'] = np.array(probability_li, dtype=np.float32)
+        # running block number over all trials
+        starts, stops, _ = get_blocks(trials_df['probability'].values)
+        trials_df['block'] = np.repeat(np.arange(starts.shape[0]), stops-starts).astype(np.int16)
+        trials_df['length'] = np.array(length_li, dtype=np.int64)
+        trials_df['select'] = True
 
         # convert 20khz sampling point length to ms length
-        trials_df['length_ms']=trials_df['length']*0.05
+        trials_df['length_ms'] = (trials_df['length']*0.05).astype(np.float32)
 
         # set index_all_trials as dataframe index
         trials_df.set_index('index_all_trials', inplace=True)
 
         # right left and reward big column
-        trials_df['right']=False
-        trials_df['left']=False
-        trials_df['reward_given']=False
-
-        trials_df
-        trials_df.loc[trials_df['event']=='right_rw',['right','reward_given']]=True
-        trials_df.loc[trials_df['event']=='right_norw','right']=True
-        trials_df.loc[trials_df['event']=='left_rw',['left','reward_given']]=True
-        trials_df.loc[trials_df['event']=='left_norw','left']=True
-
-        trials_df['good']=False
-        trials_df.loc[trials_df['index_good_trials'].notna(),'good']=True
-
-        # change to numeric
-        trials_df[['start','cue','sound','openloop','reward','iti','end','probability','length']] = trials_df[['start','cue','sound','openloop','reward','iti','end','probability','length']].apply(pd.to_numeric)
+        event = trials_df['event']
+        trials_df['right'] = event.isin(['right_rw', 'right_norw']).values
+        trials_df['left'] = event.isin(['left_rw', 'left_norw']).values
+        trials_df['reward_given'] = event.isin(['right_rw', 'left_rw']).values
+        trials_df['good'] = (trials_df['index_good_trials'] != MISSING).values
 
         # create good trials dataframe
-        good_trials_df = trials_df.loc[trials_df['good'],:]
-        good_trials_df.set_index('index_good_trials',inplace=True)
+        good_trials_df = trials_df.loc[trials_df['good'],:].set_index('index_good_trials')
+
+        # structured arrays for numpy / numba kernels
+        self.all_trials_ar = trials_to_array(trials_df)
+        self.good_trials_ar = trials_to_array(good_trials_df)
 
 
 
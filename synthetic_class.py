@@ -0,0 +1,279 @@
+import numpy as np
+import pandas as pd
+import os
+
+from sync_class import SyncPhenosys
+
+
+# class ###################################################################################################################
+class SyntheticSession():
+    """[# synthetic session generator, writes Phenosys + Intan + Kilosort files that SyncPhenosys and SpikesEDA can load]
+    """
+    def __init__(self, folder, session='synthetic', session_length=600, n_trials=100, n_clusters=30,
+                 channel_no=6, info_channel=1, gamble_side='right', block_probabilities=(0.75, 0.25, 0.125),
+                 wheel_rate=0.1, no_response_rate=0.05, lick_channel=None, lick_rate=2.0, dropped_ttl=0, extra_ttl=0,
+                 drop_first_ttl=False, seed=0):
+        """create generator for one synthetic session
+
+        Args:
+            folder (str): session folder, electrophysiology/ behavior/ and figures/ are created inside
+            session (str, optional): session name. Defaults to 'synthetic'.
+            session_length (int, optional): length of the behavior session in seconds. Defaults to 600.
+            n_trials (int, optional): number of trials (incl. wheel not stopping trials). Defaults to 100.
+            n_clusters (int, optional): number of kilosort clusters. Defaults to 30.
+            channel_no (int, optional): number of digital in channels written to digitalin.dat. Defaults to 6.
+            info_channel (int, optional): channel with the event ttl codes. Defaults to 1.
+            gamble_side (str, optional): 'right' or 'left'. Defaults to 'right'.
+            block_probabilities (tuple, optional): reward probability of the gamble side for each block. Defaults to (0.75, 0.25, 0.125).
+            wheel_rate (float, optional): fraction of wheel not stopping trials. Defaults to 0.1.
+            no_response_rate (float, optional): fraction of no response in time trials. Defaults to 0.05.
+            lick_channel (int, optional): channel with 5-10ms lick pulses, None = no lick channel. Defaults to None.
+            lick_rate (float, optional): licks per second on lick_channel. Defaults to 2.0.
+            dropped_ttl (int, optional): number of task event pulses missing on info_channel. Defaults to 0.
+            extra_ttl (int, optional): number of spurious pulses with valid event length on info_channel. Defaults to 0.
+            drop_first_ttl (bool, optional): pulse of the first task event is missing too. Defaults to False.
+            seed (int, optional): random seed. Defaults to 0.
+        """
+        self.folder = folder
+        self.session = session
+        self.session_length = session_length
+        self.n_trials = n_trials
+        self.n_clusters = n_clusters
+        self.channel_no = channel_no
+        self.info_channel = info_channel
+        self.gamble_side = gamble_side
+        self.block_probabilities = block_probabilities
+        self.wheel_rate = wheel_rate
+        self.no_response_rate = no_response_rate
+        self.lick_channel = lick_channel
+        self.lick_rate = lick_rate
+        self.dropped_ttl = dropped_ttl
+        self.extra_ttl = extra_ttl
+        self.drop_first_ttl = drop_first_ttl
+        self.seed = seed
+        self.rng = np.random.default_rng(seed)
+
+        # sampling rate of the intan recording
+        self.sampling_rate = 20000
+        # ttl clock runs slightly fast compared to the phenosys clock + starts later
+        self.ttl_drift = 20e-6
+        self.ttl_offset = 0.5
+
+        self.ttl_event_dict = SyncPhenosys.__new__(SyncPhenosys).create_dict()
+
+    def generate(self):
+        """write all files for the session
+
+        Returns:
+            str: session folder
+        """
+        for sub in ['electrophysiology', 'behavior', 'figures/all_figures']:
+            os.makedirs(self.folder+'/'+sub, exist_ok=True)
+        self.events_df = self.create_events()
+        self.write_digitalin()
+        self.write_csv()
+        self.write_kilosort()
+        return self.folder
+
+
+ # Trial schedule ==========================================================================================================
+    # probability label as written by phenosys
+    def probability_label(self, probability):
+        return 'prob'+str(int(probability*100))
+
+    def create_events(self):
+        """create event table for all trials, times on phenosys (csv) and intan (ttl) clock
+
+        Returns:
+            pd.DataFrame: one row per event, columns ['time', 'event', 'trial', 'probability', 'in_ttl', 'ttl_start']
+        """
+        slot = self.session_length / (self.n_trials+1)
+        if slot < 6:
+            raise ValueError(f"session_length {self.session_length}s is too short for {self.n_trials} trials")
+
+        # block of each trial
+        blocks = np.array_split(np.arange(self.n_trials), len(self.block_probabilities))
+        trial_prob = np.zeros(self.n_trials)
+        for block, probability in zip(blocks, self.block_probabilities):
+            trial_prob[block] = probability
+
+        # trial type, first and last trial are always good trials
+        kind = self.rng.random(self.n_trials)
+        wheel = kind < self.wheel_rate
+        no_response = (kind >= self.wheel_rate) & (kind < self.wheel_rate+self.no_response_rate)
+        wheel[[0, -1]] = False
+        no_response[[0, -1]] = False
+
+        save_side = 'left' if self.gamble_side == 'right' else 'right'
+        gamble = self.rng.random(self.n_trials) < 0.6
+        reward = np.where(gamble, self.rng.random(self.n_trials) < trial_prob, self.rng.random(self.n_trials) < 0.75)
+
+        rows = [(0.0, 'session start', -1, trial_prob[0])]
+        for trial in range(self.n_trials):
+            t = (trial+1)*slot + self.rng.uniform(0, 0.5)
+            p = trial_prob[trial]
+            rows.append((t, 'start', trial, p))
+            if wheel[trial]:
+                rows.append((t+self.rng.uniform(0.2, 0.5), 'wheel is not stopping', trial, p))
+                continue
+            t += self.rng.uniform(0.4, 0.6)
+            rows.append((t, 'cue', trial, p))
+            t += self.rng.uniform(0.4, 0.6)
+            rows.append((t, 'sound', trial, p))
+            t += self.rng.uniform(0.4, 0.6)
+            rows.append((t, 'openloop', trial, p))
+            if no_response[trial]:
+                t += 1.5
+                outcome = 'no response in time'
+            else:
+                t += self.rng.uniform(0.3, 1.5)
+                side = self.gamble_side if gamble[trial] else save_side
+                outcome = side+('_rw' if reward[trial] else '_norw')
+            rows.append((t, outcome, trial, p))
+            t += self.rng.uniform(0.1, 0.3)
+            rows.append((t, 'iti', trial, p))
+            t += self.rng.uniform(1.0, 2.0)
+            rows.append((t, 'end', trial, p))
+        rows.append((rows[-1][0]+1.0, 'session end', -1, np.nan))
+
+        events_df = pd.DataFrame(rows, columns=['time', 'event', 'trial', 'probability'])
+        # only task events are send as ttl
+        events_df['in_ttl'] = events_df['event'].isin(self.ttl_event_dict.keys())
+        events_df['ttl_start'] = ((events_df['time']*(1+self.ttl_drift)+self.ttl_offset)*self.sampling_rate).round().astype('int64')
+        # dropped pulses, the first event only with drop_first_ttl
+        events_df['dropped'] = False
+        in_ttl = np.flatnonzero(events_df['in_ttl'].values)
+        if self.dropped_ttl > 0:
+            rng = np.random.default_rng([self.seed, self.info_channel])
+            dropped = rng.choice(in_ttl[1:], size=self.dropped_ttl, replace=False)
+            events_df.loc[dropped, 'dropped'] = True
+        if self.drop_first_ttl:
+            events_df.loc[in_ttl[0], 'dropped'] = True
+        return events_df
+
+
+ # Write files =============================================================================================================
+    def write_digitalin(self):
+        """write digitalin.dat, uint16 per sample with one bit per channel"""
+        ttl = self.events_df.loc[self.events_df['in_ttl']]
+        # pulse length in sampling points from event duration codes
+        low = ttl['event'].map(lambda event: self.ttl_event_dict[event][0]).values
+        high = ttl['event'].map(lambda event: self.ttl_event_dict[event][1]).values
+        length = self.rng.integers(low, high, endpoint=True)
+        starts = ttl['ttl_start'].values
+        # own random stream for dropped / extra pulses so other files stay the same
+        keep = ~ttl['dropped'].values
+        starts, length = starts[keep], length[keep]
+        if self.extra_ttl > 0:
+            rng = np.random.default_rng([self.seed, self.info_channel, 1])
+            # in the middle of the iti, 'start' pulse length
+            iti = self.events_df.loc[self.events_df['event']=='iti', 'ttl_start'].values
+            extra = np.sort(rng.choice(iti, size=self.extra_ttl, replace=False)) + self.sampling_rate//2
+            starts = np.concatenate([starts, extra])
+            length = np.concatenate([length, rng.integers(*self.ttl_event_dict['start'], size=self.extra_ttl, endpoint=True)])
+
+        self.n_samples = int(self.events_df['ttl_start'].max()+self.sampling_rate)
+        binary = np.zeros(self.n_samples, dtype=np.uint16)
+        # all sampling points covered by a pulse
+        idx = np.repeat(starts, length) + (np.arange(length.sum()) - np.repeat(np.cumsum(length)-length, length))
+        binary[idx] |= np.uint16(1 << self.info_channel)
+        if self.lick_channel is not None:
+            self.lick_ar = self.write_lick_pulses(binary)
+        binary.tofile(self.folder+'/electrophysiology/digitalin.dat')
+
+    def write_lick_pulses(self, binary):
+        """add poisson lick pulses on lick_channel, own random stream so other files stay the same
+
+        Args:
+            binary (np ar): uint16 digital in samples, changed in place
+
+        Returns:
+            np ar: (start, length) of all lick pulses in sampling points
+        """
+        rng = np.random.default_rng([self.seed, self.lick_channel])
+        # 5-10ms pulses, at least 5ms low in between
+        n = rng.poisson(self.lick_rate*self.n_samples/self.sampling_rate)
+        gap = rng.exponential(self.sampling_rate/self.lick_rate, size=n).astype(np.int64) + 300
+        starts = np.cumsum(gap)
+        starts = starts[starts < self.n_samples-300]
+        length = rng.integers(100, 200, size=starts.shape[0], endpoint=True)
+        idx = np.repeat(starts, length) + (np.arange(length.sum()) - np.repeat(np.cumsum(length)-length, length))
+        binary[idx] |= np.uint16(1 << self.lick_channel)
+        return np.stack([starts, length], axis=1)
+
+    def write_csv(self):
+        """write utf-16 phenosys output.csv, event times as excel serial date"""
+        # invert event name cleanup of SyncPhenosys.load_csv
+        replace = dict()
+        replace['start'] = 'TIstarts'
+        replace['cue'] = 'IND-CUE_pres_start'
+        replace['sound'] = 'SOUND_start'
+        replace['openloop'] = 'resp-time-window_start'
+        replace['right_rw'] = 'right_rewarded'
+        replace['right_norw'] = 'right_NOreward'
+        replace['left_rw'] = 'left_rewarded'
+        replace['left_norw'] = 'left_NOreward'
+        replace['iti'] = 'ITIstarts'
+        replace['end'] = 'ITIends'
+        replace['session start'] = 'start'
+        replace['session end'] = 'end'
+
+        # excel serial date, days since 1899-12-30
+        session_start = 1561939200.0
+        csv = pd.DataFrame()
+        csv['DateTime'] = (session_start + self.events_df['time'])/86400.0 + 25569
+        csv['Event'] = self.events_df['event'].map(lambda event: replace.get(event, event))
+        csv['Probability'] = self.events_df['probability'].map(lambda p: self.probability_label(p) if not np.isnan(p) else np.nan)
+        csv['Side'] = pd.Series(np.nan, index=csv.index, dtype=object)
+        csv.loc[0, 'Side'] = 'GAMBLE_'+self.gamble_side.upper()
+
+        # second row is skipped by load_csv
+        header = pd.DataFrame([['[day]', '[name]', '[block]', '[side]']], columns=csv.columns)
+        csv = pd.concat([header, csv], ignore_index=True)
+        csv.to_csv(self.folder+'/behavior/output.csv', index=False, encoding='utf-16', float_format='%.12f')
+
+    def write_kilosort(self):
+        """write spike_times.npy, spike_clusters.npy and cluster_info.tsv"""
+        # reward times of all trials with a reward event on the ttl clock
+        outcome = self.events_df['event'].isin(['right_rw', 'right_norw', 'left_rw', 'left_norw'])
+        reward_times = self.events_df.loc[outcome, 'ttl_start'].values
+
+        group = self.rng.choice(['good', 'mua', 'noise'], size=self.n_clusters, p=[0.5, 0.3, 0.2])
+        group[0] = 'good'
+        rate = self.rng.lognormal(np.log(5), 0.8, size=self.n_clusters)
+
+        times_li = []
+        clusters_li = []
+        for cluster in range(self.n_clusters):
+            # background firing
+            n = self.rng.poisson(rate[cluster]*self.n_samples/self.sampling_rate)
+            times = self.rng.integers(0, self.n_samples, size=n)
+            # reward locked response for good clusters, 300ms after reward
+            if group[cluster] == 'good':
+                n_evoked = self.rng.poisson(rate[cluster]*3*0.3, size=reward_times.size)
+                evoked = np.repeat(reward_times, n_evoked) + self.rng.integers(0, int(0.3*self.sampling_rate), size=n_evoked.sum())
+                times = np.concatenate([times, evoked[evoked < self.n_samples]])
+            times_li.append(times)
+            clusters_li.append(np.full(times.size, cluster))
+
+        spike_times = np.concatenate(times_li).astype(np.uint64)
+        spike_clusters = np.concatenate(clusters_li).astype(np.int32)
+        order = np.argsort(spike_times, kind='stable')
+        np.save(self.folder+'/electrophysiology/spike_times.npy', spike_times[order].reshape(-1, 1))
+        np.save(self.folder+'/electrophysiology/spike_clusters.npy', spike_clusters[order])
+
+        n_spikes = np.bincount(spike_clusters, minlength=self.n_clusters)
+        clusters_df = pd.DataFrame({
+            'id': np.arange(self.n_clusters),
+            'Amplitude': self.rng.uniform(500, 3000, size=self.n_clusters).round(1),
+            'ContamPct': self.rng.uniform(0, 100, size=self.n_clusters).round(1),
+            'KSLabel': np.where(group == 'good', 'good', 'mua'),
+            'amp': self.rng.uniform(20, 120, size=self.n_clusters).round(4),
+            'ch': self.rng.integers(0, 32, size=self.n_clusters),
+            'depth': self.rng.integers(0, 800, size=self.n_clusters),
+            'fr': (n_spikes/(self.n_samples/self.sampling_rate)).round(4),
+            'group': group,
+            'n_spikes': n_spikes,
+            'sh': 0,
+        })
+        clusters_df.to_csv(self.folder+'/electrophysiology/cluster_info.tsv', sep='\t', index=False)